@@ -28,11 +28,15 @@ import bpy
 import math
 
 from . import riggenerator
+from . import profiling
+from . import rigidity
+from . import constraintgraph
 from .riggenerator import WIDGET_CUBE
+from bpy.app.handlers import persistent
 from mathutils import Vector, Matrix
 
 from bpy.props import FloatProperty, FloatVectorProperty, BoolProperty, StringProperty, IntProperty, BoolVectorProperty, \
-    PointerProperty
+    PointerProperty, EnumProperty
 
 import keyingsets_builtins
 
@@ -70,83 +74,176 @@ class BEPUikAutoRigOperator():
         return False
 
 
-import re
+def role_bone(pchans, side, role):
+    name = side.get(role)
+    return pchans[name] if name else None
 
 
-def get_toes(pchans, suffix):
-    p = re.compile(r"toe[0-9]+-[0-9]+")
-    toes = []
-    for pchan in pchans:
-        if pchan.name.endswith(suffix) and p.match(pchan.name):
-            toes.append(pchan)
+def role_bones(pchans, side, role):
+    return [pchans[name] for name in side.get(role, ())]
+
 
-    return toes
+def clear_rigidities_and_selection(state, pchans, foot, toes):
+    state.clear(foot.name)
 
+    for toe in toes:
+        state.clear(toe.name)
 
-def get_finger_rotators(pchans, suffix):
-    p = re.compile(r"finger[0-9]+-[0-9]+ rot")
-    finger_rotators = []
     for pchan in pchans:
-        if pchan.name.endswith(suffix) and p.match(pchan.name):
-            finger_rotators.append(pchan)
+        pchan.bone.select = False
 
-    return finger_rotators
 
+def find_control_with_target(pchan, target_name, roles=None):
+    """The BEPUIK_CONTROL of pchan targeting target_name, looked up in the role manifest roles when given"""
+    if roles:
+        constraint_name = roles['controls'].get(pchan.name, {}).get(target_name)
+        constraint = pchan.constraints.get(constraint_name) if constraint_name else None
+        if constraint and constraint.type == 'BEPUIK_CONTROL' and constraint.connection_subtarget == target_name:
+            return constraint
 
-def get_fingers(pchans, suffix):
-    p = re.compile(r"finger[0-9]+-[0-9]+")
-    fingers = []
-    for pchan in pchans:
-        if pchan.name.endswith(suffix) and p.match(pchan.name):
-            fingers.append(pchan)
+    for constraint in pchan.constraints:
+        if constraint.type == 'BEPUIK_CONTROL' and constraint.connection_subtarget == target_name:
+            return constraint
 
-    return fingers
+    return None
 
 
-def get_palm_bones(pchans, suffix):
-    p_rot = re.compile(r"finger[0-9]+-[0-9]+ rot")
-    p = re.compile(r"finger[0-9]+-1")
-    palm_bones = []
-    for pchan in pchans:
-        if pchan.name.endswith(suffix) and p.match(pchan.name) and not p_rot.match(pchan.name):
-            palm_bones.append(pchan)
+def apply_rigidity_state(ob, name, state, use_keyframe=False):
+    """Store state on ob under name, so it can be recalled, and apply it"""
+    rigidity.rigidity_state_store(ob, name, state)
+    state.apply(ob, use_keyframe, name)
 
-    return palm_bones
 
+class StoreRigidityState(BEPUikAutoRigOperator, bpy.types.Operator):
+    """Store the rigidities of all BEPUik Controls under a name"""
+    bl_idname = "bepuik_tools.store_rigidity_state"
+    bl_label = "Store Rigidity State"
+    bl_options = {'REGISTER', 'UNDO'}
 
-def get_bone(pchans, name, suffix):
-    bone_name = "%s%s" % (name, suffix)
+    name = StringProperty(name="Name", description="Name of the rigidity state", default="rigidity state")
 
-    if bone_name in pchans:
-        return pchans[bone_name]
+    def execute(self, context):
+        ob = get_armature_ob(context)
+        rigidity.rigidity_state_store(ob, self.name, rigidity.RigidityState.capture(ob))
+        return {'FINISHED'}
 
-    return None
+    def invoke(self, context, event):
+        return context.window_manager.invoke_props_dialog(self)
 
 
-def clear_pchan_control_rigidities(pchan):
-    for constraint in pchan.constraints:
-        if constraint.type == 'BEPUIK_CONTROL':
-            constraint.bepuik_rigidity = 0
-            constraint.orientation_rigidity = 0
-            constraint.use_hard_rigidity = 0
+class RecallRigidityState(BEPUikAutoRigOperator, bpy.types.Operator):
+    """Switch the rigidities of the BEPUik Controls of a stored state"""
+    bl_idname = "bepuik_tools.recall_rigidity_state"
+    bl_label = "Recall Rigidity State"
+    bl_options = {'REGISTER', 'UNDO'}
 
+    name = StringProperty(name="Name", description="Name of the rigidity state", default="")
+    use_keyframe = BoolProperty(name="Keyframe", description="Keyframe all rigidities of the state",
+                                default=False)
 
-def clear_rigidities_and_selection(pchans, foot, toes):
-    clear_pchan_control_rigidities(foot)
+    def execute(self, context):
+        ob = get_armature_ob(context)
+        state = rigidity.rigidity_state_recall(ob, self.name)
+        if not state:
+            self.report({'ERROR'}, "No rigidity state named %s" % self.name)
+            return {'CANCELLED'}
 
-    for toe in toes:
-        clear_pchan_control_rigidities(toe)
+        num_changed = state.apply(ob, self.use_keyframe, self.name)
+        self.report({'INFO'}, "Changed %s rigidities" % num_changed)
+        return {'FINISHED'}
 
-    for pchan in pchans:
-        pchan.bone.select = False
 
+class AnalyzeConstraintGraph(BEPUikAutoRigOperator, bpy.types.Operator):
+    """Report the BEPUik constraints of the rig, its solver components and estimated solver work"""
+    bl_idname = "bepuik_tools.analyze_constraint_graph"
+    bl_label = "Analyze Constraints"
+    bl_options = {'REGISTER'}
 
-def find_control_with_target(pchan, target_name):
-    for constraint in pchan.constraints:
-        if constraint.type == 'BEPUIK_CONTROL' and constraint.connection_subtarget == target_name:
-            return constraint
+    json_filepath = StringProperty(name="Json File",
+                                   description="Optional json file the constraint graph is written to",
+                                   default="",
+                                   subtype='FILE_PATH')
 
-    return None
+    dot_filepath = StringProperty(name="GraphViz File",
+                                  description="Optional GraphViz file the constraint graph is written to",
+                                  default="",
+                                  subtype='FILE_PATH')
+
+    def execute(self, context):
+        ob = get_armature_ob(context)
+        graph = constraintgraph.ConstraintGraph.from_ob(ob)
+
+        for line in graph.report_lines():
+            self.report({'INFO'}, line)
+
+        if self.json_filepath:
+            graph.write_json(bpy.path.abspath(self.json_filepath))
+
+        if self.dot_filepath:
+            graph.write_dot(bpy.path.abspath(self.dot_filepath), ob.name)
+
+        return {'FINISHED'}
+
+    def invoke(self, context, event):
+        return context.window_manager.invoke_props_dialog(self)
+
+
+class PurgeUnusedWidgets(bpy.types.Operator):
+    """Remove the widget objects and meshes that no rig uses as custom shape anymore"""
+    bl_idname = "bepuik_tools.purge_unused_widgets"
+    bl_label = "Purge Unused Widgets"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    @classmethod
+    def poll(cls, context):
+        return context.mode in {'OBJECT', 'POSE'}
+
+    def execute(self, context):
+        num_objects, num_meshes, num_vertices = riggenerator.widgets_purge()
+        users = riggenerator.widget_users()
+        rig_names = set().union(*users.values())
+
+        self.report({'INFO'}, "Removed %s widget objects and %s meshes with %s vertices, %s widgets are used by %s "
+                              "rigs" % (num_objects, num_meshes, num_vertices, len(users), len(rig_names)))
+        return {'FINISHED'}
+
+
+class ImportWidgetLibrary(bpy.types.Operator):
+    """Use the selected mesh objects as custom shapes of the generated rigs, in place of the default widgets with the same name"""
+    bl_idname = "bepuik_tools.import_widget_library"
+    bl_label = "Import Widgets"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    prefix = StringProperty(name="Prefix",
+                            description="Removed from the object names to get the names of the widgets they replace",
+                            default="WGT-")
+
+    use_normalize = BoolProperty(name="Normalize",
+                                 description="Scale the widgets to fit a bone of length 1",
+                                 default=False)
+
+    use_replace = BoolProperty(name="Replace Library",
+                               description="Remove the previously imported widgets first",
+                               default=False)
+
+    @classmethod
+    def poll(cls, context):
+        return context.mode == 'OBJECT' and len(context.selected_objects) > 0
+
+    def execute(self, context):
+        if self.use_replace:
+            riggenerator.USER_WIDGET_LIBRARY.clear()
+
+        names = riggenerator.widget_library_import(context.selected_objects, use_normalize=self.use_normalize,
+                                                   prefix=self.prefix)
+        riggenerator.widget_library_save()
+
+        self.report({'INFO'}, "Imported %s widgets, %s in the library" %
+                    (len(names), len(riggenerator.USER_WIDGET_LIBRARY)))
+        return {'FINISHED'}
+
+    def invoke(self, context, event):
+        return context.window_manager.invoke_props_dialog(self)
 
 
 class BEPUikAutoRigTweakFingers(BEPUikAutoRigOperator, bpy.types.Operator):
@@ -155,32 +252,39 @@ class BEPUikAutoRigTweakFingers(BEPUikAutoRigOperator, bpy.types.Operator):
     bl_description = "Setup pose rigidities so the fingers are easily tweakable"
 
     suffix = StringProperty(name="Suffix", description="Suffix of the foot bone, (.L,.R,...)", default=".L")
+    use_keyframe = BoolProperty(name="Keyframe", description="Keyframe the rigidities of the resulting state",
+                                default=False)
 
     def execute(self, context):
         ob = get_armature_ob(context)
 
         pchans = ob.pose.bones
+        roles = riggenerator.rig_roles_get(ob)
+        side = roles['sides'].get(self.suffix, {})
 
-        hand = get_bone(pchans, "hand", self.suffix)
-        fingers = get_fingers(pchans, self.suffix)
+        hand = role_bone(pchans, side, "hand")
+        fingers = role_bones(pchans, side, "fingers")
 
-        palm_bones = get_palm_bones(pchans, self.suffix)
+        palm_bones = role_bones(pchans, side, "palm bones")
+
+        state = rigidity.RigidityState.capture(ob, [pchan.name for pchan in fingers + palm_bones + [hand] if pchan])
 
         for pchan in fingers:
             pchan.bone.select = False
-            clear_pchan_control_rigidities(pchan)
+            state.clear(pchan.name)
 
         for pchan in palm_bones:
-            con = find_control_with_target(pchan, riggenerator.split_suffix(pchan.name)[0] + " rot%s" % self.suffix)
+            con = find_control_with_target(pchan, riggenerator.split_suffix(pchan.name)[0] + " rot%s" % self.suffix,
+                                           roles)
             if con:
-                con.orientation_rigidity = 1.0
+                state.set(pchan.name, con.name, orientation_rigidity=1.0)
 
         if hand:
-            con = find_control_with_target(hand, "hand target%s" % self.suffix)
+            con = find_control_with_target(hand, "hand target%s" % self.suffix, roles)
             if con:
-                con.bepuik_rigidity = 0
-                con.orientation_rigidity = 0
-                con.use_hard_rigidity = True
+                state.set(hand.name, con.name, bepuik_rigidity=0, orientation_rigidity=0, use_hard_rigidity=True)
+
+        apply_rigidity_state(ob, "finger tweak%s" % self.suffix, state, self.use_keyframe)
 
         return {'FINISHED'}
 
@@ -191,37 +295,42 @@ class BEPUikAutoRigPivotHeel(BEPUikAutoRigOperator, bpy.types.Operator):
     bl_description = "Setup the pose so the foot pivots on the heel"
 
     suffix = StringProperty(name="Suffix", description="Suffix of the foot bone, (.L,.R,...)", default=".L")
+    use_keyframe = BoolProperty(name="Keyframe", description="Keyframe the rigidities of the resulting state",
+                                default=False)
 
     def execute(self, context):
         ob = get_armature_ob(context)
 
         pchans = ob.pose.bones
+        roles = riggenerator.rig_roles_get(ob)
+        side = roles['sides'].get(self.suffix, {})
 
-        foot = get_bone(pchans, "foot", self.suffix)
-        foot_target = get_bone(pchans, "foot target", self.suffix)
-        toes = get_toes(pchans, self.suffix)
+        foot = role_bone(pchans, side, "foot")
+        foot_target = role_bone(pchans, side, "foot target")
+        toes = role_bones(pchans, side, "toes")
 
         if foot and foot_target and toes:
             pass
         else:
             return {'CANCELLED'}
 
-        clear_rigidities_and_selection(pchans, foot, toes)
+        floor = role_bone(pchans, side, "floor")
+        state = rigidity.RigidityState.capture(ob, [pchan.name for pchan in [foot, floor] + toes if pchan])
+        clear_rigidities_and_selection(state, pchans, foot, toes)
 
-        constraint = find_control_with_target(foot, foot_target.name)
-        constraint.use_hard_rigidity = True
+        constraint = find_control_with_target(foot, foot_target.name, roles)
+        state.set(foot.name, constraint.name, use_hard_rigidity=True)
 
         foot_target.bone.select = True
         ob.data.bones.active = foot_target.bone
 
-        floor_target = get_bone(pchans, "foot floor target", self.suffix)
+        floor_target = role_bone(pchans, side, "foot floor target")
 
-        if floor_target:
-            floor = get_bone(pchans, "floor", self.suffix)
+        if floor_target and floor:
+            constraint = find_control_with_target(floor, floor_target.name, roles)
+            state.set(floor.name, constraint.name, use_hard_rigidity=True)
 
-            if floor:
-                constraint = find_control_with_target(floor, floor_target.name)
-                constraint.use_hard_rigidity = True
+        apply_rigidity_state(ob, "heel pivot%s" % self.suffix, state, self.use_keyframe)
 
         return {'FINISHED'}
 
@@ -232,43 +341,48 @@ class BEPUikAutoRigPivotToes(BEPUikAutoRigOperator, bpy.types.Operator):
     bl_description = "Setup the pose so the foot pivots on the toes"
 
     suffix = StringProperty(name="Suffix", description="Suffix of the foot bone, (.L,.R,...)", default=".L")
+    use_keyframe = BoolProperty(name="Keyframe", description="Keyframe the rigidities of the resulting state",
+                                default=False)
 
     def execute(self, context):
         ob = get_armature_ob(context)
 
         pchans = ob.pose.bones
+        roles = riggenerator.rig_roles_get(ob)
+        side = roles['sides'].get(self.suffix, {})
 
-        foot = get_bone(pchans, "foot", self.suffix)
-        toes_target = get_bone(pchans, "toes target", self.suffix)
-        foot_ball_target = get_bone(pchans, "foot ball target", self.suffix)
-        toes = get_toes(pchans, self.suffix)
+        foot = role_bone(pchans, side, "foot")
+        toes_target = role_bone(pchans, side, "toes target")
+        foot_ball_target = role_bone(pchans, side, "foot ball target")
+        toes = role_bones(pchans, side, "toes")
 
         if foot and foot_ball_target and toes_target and toes:
             pass
         else:
             return {'CANCELLED'}
 
-        clear_rigidities_and_selection(pchans, foot, toes)
+        floor = role_bone(pchans, side, "floor")
+        state = rigidity.RigidityState.capture(ob, [pchan.name for pchan in [foot, floor] + toes if pchan])
+        clear_rigidities_and_selection(state, pchans, foot, toes)
 
-        constraint = find_control_with_target(foot, foot_ball_target.name)
-        constraint.orientation_rigidity = 1
+        constraint = find_control_with_target(foot, foot_ball_target.name, roles)
+        state.set(foot.name, constraint.name, orientation_rigidity=1)
 
         for toe in toes:
-            constraint = find_control_with_target(toe, toes_target.name)
+            constraint = find_control_with_target(toe, toes_target.name, roles)
             if constraint:
-                constraint.use_hard_rigidity = True
+                state.set(toe.name, constraint.name, use_hard_rigidity=True)
 
         foot_ball_target.bone.select = True
         ob.data.bones.active = foot_ball_target.bone
 
 
-        floor_target = get_bone(pchans, "foot floor target", self.suffix)
-        if floor_target:
-            floor = get_bone(pchans, "floor", self.suffix)
+        floor_target = role_bone(pchans, side, "foot floor target")
+        if floor_target and floor:
+            constraint = find_control_with_target(floor, floor_target.name, roles)
+            state.set(floor.name, constraint.name, use_hard_rigidity=True)
 
-            if floor:
-                constraint = find_control_with_target(floor, floor_target.name)
-                constraint.use_hard_rigidity = True
+        apply_rigidity_state(ob, "toe pivot%s" % self.suffix, state, self.use_keyframe)
 
         return {'FINISHED'}
 
@@ -310,6 +424,17 @@ class BEPUikAutoRigLayers(bpy.types.Panel):
         col.operator(BEPUikAutoRigPivotHeel.bl_idname).suffix = ".R"
         col.operator(BEPUikAutoRigPivotToes.bl_idname).suffix = ".R"
 
+        col = layout.column(align=True)
+        col.label("Rigidity States:")
+        for name in rigidity.rigidity_state_names(ob):
+            row = col.row(align=True)
+            row.operator(RecallRigidityState.bl_idname, text=name).name = name
+            op = row.operator(RecallRigidityState.bl_idname, text="", icon='KEY_HLT')
+            op.name = name
+            op.use_keyframe = True
+        col.operator(StoreRigidityState.bl_idname)
+        layout.operator(AnalyzeConstraintGraph.bl_idname)
+
         riggenerator.layout_rig_layers(self.layout, ob)
 
 
@@ -365,6 +490,9 @@ class BEPUikTools(bpy.types.Panel):
         col.separator()
 
         col.operator(CreateFullBodyRig.bl_idname, text="Generate Rig")
+        col.operator(CreateFullBodyRig.bl_idname, text="Update Rig").use_incremental = True
+        col.operator(PurgeUnusedWidgets.bl_idname)
+        col.operator(ImportWidgetLibrary.bl_idname)
         col.separator()
         col.label("Create Control with Target:")
 
@@ -511,24 +639,9 @@ class CreateFullBodyMetaArmature(bpy.types.Operator):
         return context.mode == 'OBJECT'
 
     def execute(self, context):
-        bpy.ops.object.select_all(action='DESELECT')
-        data = bpy.data.armatures.new(name="MetaBones")
-        ob = bpy.data.objects.new(name="Meta Armature", object_data=data)
-        bpy.context.scene.objects.link(ob)
-        context.scene.objects.active = ob
-        bpy.ops.object.mode_set(mode='EDIT')
+        riggenerator.new_meta_armature_ob(context.scene, **self.as_keywords())
 
-        riggenerator.meta_create_full_body(ob, self.num_fingers, self.num_toes, self.foot_width, self.wrist_width, self.wrist_yaw, self.wrist_pitch, self.wrist_roll,
-                          self.use_thumb, self.finger_curl, self.toe_curl, self.finger_splay, self.thumb_splay, self.thumb_tilt, self.arm_yaw, self.arm_pitch, self.arm_roll, self.shoulder_head_vec,
-                          self.shoulder_tail_vec, self.elbow_vec, self.wrist_vec, self.spine_start_vec, self.spine_pitch, self.spine_lengths, self.upleg_vec, self.knee_vec,
-                          self.ankle_vec, self.toe_vec, self.head_length, self.head_pitch, self.eye_center, self.eye_radius, self.chin_vec, self.jaw_vec, self.use_simple_toe, self.num_tail_bones, self.tail_length, self.use_ears, self.use_belly, self.use_bepuik_tail, self.use_simple_hand)
-
-        ob.select = True
-        ob.show_x_ray = True
-
-        bpy.ops.object.mode_set(mode='OBJECT')
-
-        if bpy.context.area.type == 'VIEW_3D':
+        if context.area and context.area.type == 'VIEW_3D':
             bpy.context.area.spaces[0].show_relationship_lines = False
 
         return {'FINISHED'}
@@ -541,20 +654,69 @@ class CreateFullBodyRig(bpy.types.Operator):
     bl_description = "Use selected meta armature as input to generate a new animation-ready armature"
     bl_options = {'REGISTER', 'UNDO'}
 
+    use_incremental = BoolProperty(name="Update Existing Rig",
+                                   description="Only rebuild the bones of the rig last generated from this meta "
+                                               "armature that are affected by changes to the meta armature",
+                                   default=False)
+
+    use_mirror = BoolProperty(name="Mirror",
+                              description="Derive the right side from the left side when the meta armature is "
+                                          "symmetric, instead of rigging both sides",
+                              default=True)
+
+    use_prune = BoolProperty(name="Prune Constraints",
+                             description="Leave out the BEPUik constraints whose limits are already enforced by "
+                                         "other constraints, so the rig solves faster",
+                             default=False)
+
+    detail_level = EnumProperty(name="Detail",
+                                description="Coarser rigs solve faster and keep the target names of finer rigs, "
+                                            "so animation transfers between them",
+                                items=[(riggenerator.RIG_DETAIL_FULL, "Full", "Jointed fingers and toes, solved tail"),
+                                       (riggenerator.RIG_DETAIL_MEDIUM, "Medium",
+                                        "Single segment toes, rigid tail"),
+                                       (riggenerator.RIG_DETAIL_LOW, "Low",
+                                        "Mitten hands, single segment toes, rigid tail")],
+                                default=riggenerator.RIG_DETAIL_FULL)
+
+    use_baked_subsurface = BoolProperty(name="Bake Widget Subdivision",
+                                        description="Give widgets smooth geometry instead of Subdivision Surface "
+                                                    "modifiers, which are evaluated on every redraw",
+                                        default=False)
+
+    use_profile = BoolProperty(name="Profile",
+                               description="Report the time spent in each phase of the rig generation",
+                               default=False)
+
+    profile_filepath = StringProperty(name="Profile File",
+                                      description="Optional json file the phase timings are written to",
+                                      default="",
+                                      subtype='FILE_PATH')
+
     @classmethod
     def poll(cls, context):
         return context.object and context.object.bepuik_autorig.is_meta_armature and context.mode == 'OBJECT' and bpy.context.object.type == 'ARMATURE'
 
     def execute(self, context):
         context.object.hide = False
+        profiler = profiling.RigProfiler() if self.use_profile else None
+
         riggenerator.widgetdata_refresh_defaults()
-        rig_obj = riggenerator.rig_full_body(bpy.context.object, self)
-        rig_obj.show_x_ray = True
-        rig_obj.data.show_bepuik_controls = True
-        rig_obj.use_bepuik_inactive_targets_follow = True
-        rig_obj.use_bepuik_dynamic = True
+        rig_ob = riggenerator.rig_full_body(context.object, self, use_incremental=self.use_incremental,
+                                            scene=context.scene, profiler=profiler, use_mirror=self.use_mirror,
+                                            use_prune=self.use_prune, detail_level=self.detail_level,
+                                            use_baked_subsurface=self.use_baked_subsurface)
+        if rig_ob:
+            control_index_clear(rig_ob)
+
+        if profiler:
+            for line in profiler.report_lines():
+                self.report({'INFO'}, line)
 
-        if bpy.context.area.type == 'VIEW_3D':
+            if self.profile_filepath:
+                profiler.write_json(bpy.path.abspath(self.profile_filepath))
+
+        if context.area and context.area.type == 'VIEW_3D':
             bpy.context.area.spaces[0].show_relationship_lines = False
 
         return {'FINISHED'}
@@ -675,6 +837,9 @@ class CreateControl(BEPUikAutoRigOperator, bpy.types.Operator):
 
         metabones = riggenerator.MetaBoneDict.from_ob(ob)
 
+        #the selection and name checks below work on the edit bones
+        bpy.ops.object.mode_set(mode='EDIT', toggle=False)
+
         if "root" in metabones:
             root = metabones["root"]
         else:
@@ -761,6 +926,7 @@ class CreateControl(BEPUikAutoRigOperator, bpy.types.Operator):
         if previous_mode != ob.mode:
             bpy.ops.object.mode_set(mode=previous_mode)
 
+        control_index_clear(ob)
         return {'FINISHED'}
 
 
@@ -822,43 +988,103 @@ class BEPUikObjectProperties(bpy.types.PropertyGroup):
     use_simple_toe = BoolProperty(default=False, options=set())
     use_bepuik_tail = BoolProperty(default=False, options=set())
     use_simple_hand = BoolProperty(default=False, options=set())
+    rig_name = StringProperty(default="", options=set())
+
+#object name -> BEPUikControlIndex, see control_index_get
+control_indices = {}
 
-def find_selected_controls_and_targets(ob):
-        selected_controls = set()
-        selected_targets = set()
-        targets_to_controls = {}
-        valid_bepuik_controls = set()
 
-        for pchan in ob.pose.bones:
+class BEPUikControlIndex():
+    """
+    The BEPUIK_CONTROL constraints of an armature by target bone and by owner bone. A control is stored as
+    (owner name, constraint name, target name), constraints themselves don't outlive undo.
+    """
+    def __init__(self, ob):
+        self.by_target = {}
+        self.by_owner = {}
+        self.signature = BEPUikControlIndex.controls_signature(ob)
+
+        pose_bones = ob.pose.bones
+        for pchan in pose_bones:
             if pchan.use_bepuik:
                 for con in pchan.constraints:
                     if con.type == 'BEPUIK_CONTROL':
-                        if con.connection_subtarget and con.connection_subtarget in ob.pose.bones:
-                            valid_bepuik_controls.add(con)
+                        if con.connection_subtarget and con.connection_subtarget in pose_bones:
+                            control = (pchan.name, con.name, con.connection_subtarget)
+                            self.by_target.setdefault(con.connection_subtarget, set()).add(control)
+                            self.by_owner.setdefault(pchan.name, set()).add(control)
+
+    @staticmethod
+    def controls_signature(ob):
+        """
+        The number of bones and every BEPUIK_CONTROL of ob with its owner and target, in one pass that doesn't build
+        the index. Controls added, removed or retargeted on any bone change it.
+        """
+        return len(ob.pose.bones), tuple((pchan.name, pchan.use_bepuik, con.name, con.connection_subtarget)
+                                         for pchan in ob.pose.bones for con in pchan.constraints
+                                         if con.type == 'BEPUIK_CONTROL')
+
+
+def control_index_get(ob):
+    if ob.name not in control_indices:
+        control_indices[ob.name] = BEPUikControlIndex(ob)
+
+    return control_indices[ob.name]
+
+
+@persistent
+def control_index_clear_all(dummy=None):
+    control_indices.clear()
+
+
+def control_index_clear(ob):
+    """Drop the index of ob, for operators that add or remove controls"""
+    control_indices.pop(ob.name, None)
 
-                            if con.connection_subtarget not in targets_to_controls:
-                                targets_to_controls[con.connection_subtarget] = set()
 
-                            targets_to_controls[con.connection_subtarget].add(con)
+def find_selected_controls_and_targets(ob, selected_pchans):
+    """
+    The controls owned by or targeting selected_pchans and the targets of those controls. The lookups take time
+    proportional to the selection, the index is checked against BEPUikControlIndex.controls_signature and rebuilt when
+    the controls changed. Controls are (owner name, constraint name, target name), see BEPUikControlIndex.
+    """
+    selected_names = {pchan.name for pchan in selected_pchans}
 
-        for pchan in ob.pose.bones:
-            if pchan.bone.select:
-                if pchan.name in targets_to_controls:
-                    selected_targets.add(pchan.name)
+    index = control_index_get(ob)
+    if index.signature != BEPUikControlIndex.controls_signature(ob):
+        index = control_indices[ob.name] = BEPUikControlIndex(ob)
 
-                if pchan.use_bepuik:
-                    for con in pchan.constraints:
-                        if con in valid_bepuik_controls:
-                            selected_controls.add(con)
+    selected_controls = set()
+    selected_targets = set()
 
-        for selected_control in selected_controls:
-            selected_targets.add(selected_control.connection_subtarget)
+    for name in selected_names:
+        if name in index.by_target:
+            selected_targets.add(name)
 
-        for selected_target in selected_targets:
-            for control in targets_to_controls[selected_target]:
-                selected_controls.add(control)
+        selected_controls |= index.by_owner.get(name, set())
+
+    for selected_control in selected_controls:
+        selected_targets.add(selected_control[2])
+
+    for selected_target in selected_targets:
+        selected_controls |= index.by_target[selected_target]
+
+    return selected_controls, selected_targets
+
+
+def keyingset_selected_pchans(context, ob):
+    return [pchan for pchan in (context.selected_pose_bones or []) if pchan.id_data == ob]
+
+
+def keyingset_generate_pchans(ksi, context, ks, ob):
+    """Call generate for the pose bones of ksi's selected targets and controls"""
+    ksi.selected_controls_by_owner = {}
+    for owner_name, constraint_name, target_name in ksi.selected_controls:
+        ksi.selected_controls_by_owner.setdefault(owner_name, []).append(constraint_name)
+
+    for name in ksi.selected_targets | set(ksi.selected_controls_by_owner.keys()):
+        ksi.generate(context, ks, ob.pose.bones[name])
 
-        return selected_controls, selected_targets
 
 class BUILTIN_KSI_BEPUikLocRotRigidities(bpy.types.KeyingSetInfo):
     """Insert a keyframe for selected bones location, rotation and their associated BEPUik Control rigidities"""
@@ -869,17 +1095,14 @@ class BUILTIN_KSI_BEPUikLocRotRigidities(bpy.types.KeyingSetInfo):
 
     def iterator(ksi, context, ks):
         ob = context.active_object
+        selected_pchans = keyingset_selected_pchans(context, ob)
 
-        ksi.selected_controls, ksi.selected_targets = find_selected_controls_and_targets(ob)
-
-        for pchan in ob.pose.bones:
-            if pchan.bone.select:
-                ksi.selected_targets.add(pchan.name)
-
-        for pchan in ob.pose.bones:
-            ksi.generate(context, ks, pchan)
+        ksi.selected_controls, ksi.selected_targets = find_selected_controls_and_targets(ob, selected_pchans)
 
+        for pchan in selected_pchans:
+            ksi.selected_targets.add(pchan.name)
 
+        keyingset_generate_pchans(ksi, context, ks, ob)
 
     def generate(ksi, context, ks, pchan):
         if pchan.name in ksi.selected_targets:
@@ -891,11 +1114,11 @@ class BUILTIN_KSI_BEPUikLocRotRigidities(bpy.types.KeyingSetInfo):
             else:
                 ksi.doRot3d(ks, pchan)
 
-        for con in pchan.constraints:
-            if con in ksi.selected_controls:
-                ksi.addProp(ks, con, 'bepuik_rigidity')
-                ksi.addProp(ks, con, 'orientation_rigidity')
-                ksi.addProp(ks, con, 'use_hard_rigidity')
+        for constraint_name in ksi.selected_controls_by_owner.get(pchan.name, ()):
+            con = pchan.constraints[constraint_name]
+            ksi.addProp(ks, con, 'bepuik_rigidity')
+            ksi.addProp(ks, con, 'orientation_rigidity')
+            ksi.addProp(ks, con, 'use_hard_rigidity')
 
     addProp = keyingsets_builtins.BUILTIN_KSI_WholeCharacter.addProp
     doLoc = keyingsets_builtins.BUILTIN_KSI_WholeCharacter.doLoc
@@ -914,11 +1137,10 @@ class BUILTIN_KSI_BEPUikTargetsLocRotRigidities(bpy.types.KeyingSetInfo):
     def iterator(ksi, context, ks):
         ob = context.active_object
 
-        ksi.selected_controls, ksi.selected_targets = find_selected_controls_and_targets(ob)
-
-        for pchan in ob.pose.bones:
-            ksi.generate(context, ks, pchan)
+        ksi.selected_controls, ksi.selected_targets = find_selected_controls_and_targets(
+            ob, keyingset_selected_pchans(context, ob))
 
+        keyingset_generate_pchans(ksi, context, ks, ob)
 
     def generate(ksi, context, ks, pchan):
         if pchan.name in ksi.selected_targets:
@@ -930,11 +1152,11 @@ class BUILTIN_KSI_BEPUikTargetsLocRotRigidities(bpy.types.KeyingSetInfo):
             else:
                 ksi.doRot3d(ks, pchan)
 
-        for con in pchan.constraints:
-            if con in ksi.selected_controls:
-                ksi.addProp(ks, con, 'bepuik_rigidity')
-                ksi.addProp(ks, con, 'orientation_rigidity')
-                ksi.addProp(ks, con, 'use_hard_rigidity')
+        for constraint_name in ksi.selected_controls_by_owner.get(pchan.name, ()):
+            con = pchan.constraints[constraint_name]
+            ksi.addProp(ks, con, 'bepuik_rigidity')
+            ksi.addProp(ks, con, 'orientation_rigidity')
+            ksi.addProp(ks, con, 'use_hard_rigidity')
 
     addProp = keyingsets_builtins.BUILTIN_KSI_WholeCharacter.addProp
     doLoc = keyingsets_builtins.BUILTIN_KSI_WholeCharacter.doLoc
@@ -951,25 +1173,40 @@ class BUILTIN_KSI_BEPUikRigidities(bpy.types.KeyingSetInfo):
     def iterator(ksi, context, ks):
         ob = context.active_object
 
-        ksi.selected_controls, ksi.selected_targets = find_selected_controls_and_targets(ob)
-
-        for pchan in ob.pose.bones:
-            ksi.generate(context, ks, pchan)
+        ksi.selected_controls, ksi.selected_targets = find_selected_controls_and_targets(
+            ob, keyingset_selected_pchans(context, ob))
 
+        #only the rigidities are keyed, the targets don't need to be visited
+        ksi.selected_targets = set()
+        keyingset_generate_pchans(ksi, context, ks, ob)
 
     def generate(ksi, context, ks, pchan):
-        for con in pchan.constraints:
-            if con in ksi.selected_controls:
-                ksi.addProp(ks, con, 'bepuik_rigidity')
-                ksi.addProp(ks, con, 'orientation_rigidity')
-                ksi.addProp(ks, con, 'use_hard_rigidity')
+        for constraint_name in ksi.selected_controls_by_owner.get(pchan.name, ()):
+            con = pchan.constraints[constraint_name]
+            ksi.addProp(ks, con, 'bepuik_rigidity')
+            ksi.addProp(ks, con, 'orientation_rigidity')
+            ksi.addProp(ks, con, 'use_hard_rigidity')
 
     addProp = keyingsets_builtins.BUILTIN_KSI_WholeCharacter.addProp
 
 def register():
     bpy.utils.register_module(__name__)
     bpy.types.Object.bepuik_autorig = PointerProperty(type=BEPUikObjectProperties)
+    bpy.app.handlers.load_post.append(riggenerator.widget_cache_clear)
+    bpy.app.handlers.load_post.append(riggenerator.widget_library_load)
+    bpy.app.handlers.load_post.append(control_index_clear_all)
+    bpy.app.handlers.undo_post.append(riggenerator.widget_library_load)
+    bpy.app.handlers.undo_post.append(control_index_clear_all)
+    bpy.app.handlers.redo_post.append(riggenerator.widget_library_load)
+    bpy.app.handlers.redo_post.append(control_index_clear_all)
 
 
 def unregister():
     bpy.utils.unregister_module(__name__)
+    bpy.app.handlers.load_post.remove(riggenerator.widget_cache_clear)
+    bpy.app.handlers.load_post.remove(riggenerator.widget_library_load)
+    bpy.app.handlers.load_post.remove(control_index_clear_all)
+    bpy.app.handlers.undo_post.remove(riggenerator.widget_library_load)
+    bpy.app.handlers.undo_post.remove(control_index_clear_all)
+    bpy.app.handlers.redo_post.remove(riggenerator.widget_library_load)
+    bpy.app.handlers.redo_post.remove(control_index_clear_all)
@@ -0,0 +1,187 @@
+# ====================== BEGIN GPL LICENSE BLOCK ======================
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+#  The Original Code is Copyright (C) 2013 by: 
+#  Harrison Nordby and Ross Nordby
+#  All rights reserved.
+#
+#  The Original Code is: all of this file
+#  
+#  Contributor(s): none yet.
+#
+#
+#======================= END GPL LICENSE BLOCK ========================
+"""
+Context free generation of meta armatures and rigs from parameter files, for use in background blender,
+see batch_generate.py.
+
+A parameter file is a json object using the property names of the Create Full Body Meta Armature operator,
+any property left out keeps the operator's default. An optional "rig_options" object is passed on to
+riggenerator.rig_full_body as keyword arguments.
+"""
+import bpy
+import argparse
+import json
+import os
+import subprocess
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from mathutils import Vector
+
+from . import riggenerator
+from . import profiling
+from . import CreateFullBodyMetaArmature
+
+RIG_OPTIONS_KEY = "rig_options"
+
+DRIVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "batch_generate.py")
+
+
+def meta_armature_params(overrides=None):
+    """
+    Arguments for riggenerator.new_meta_armature_ob, the defaults of CreateFullBodyMetaArmature updated with
+    overrides
+    """
+    if overrides is None:
+        overrides = {}
+
+    params = {}
+    for prop in CreateFullBodyMetaArmature.bl_rna.properties:
+        if prop.identifier == 'rna_type':
+            continue
+
+        if getattr(prop, 'array_length', 0) > 0:
+            val = tuple(overrides.get(prop.identifier, prop.default_array))
+            if prop.subtype == 'TRANSLATION':
+                val = Vector(val)
+        else:
+            val = overrides.get(prop.identifier, prop.default)
+
+        params[prop.identifier] = val
+
+    unknown = set(overrides.keys()) - set(params.keys()) - {RIG_OPTIONS_KEY}
+    if unknown:
+        raise ValueError("Unknown meta armature parameters: %s" % ", ".join(sorted(unknown)))
+
+    return params
+
+
+def generate_character(params, filepath=None, scene=None, profiler=None):
+    """
+    Generate a meta armature and its rig in scene, optionally saving the blend file to filepath
+
+    :arg params: parameter file contents, see the module documentation
+    :type params: dict
+    :arg profiler: collects the time spent in each phase of the rig generation
+    :type profiler: profiling.RigProfiler
+    :return: the meta armature and the rig objects
+    """
+    if scene is None:
+        scene = bpy.context.scene
+
+    meta_ob = riggenerator.new_meta_armature_ob(scene, **meta_armature_params(params))
+
+    riggenerator.widgetdata_refresh_defaults()
+    rig_ob = riggenerator.rig_full_body(meta_ob, scene=scene, profiler=profiler, **params.get(RIG_OPTIONS_KEY, {}))
+    bpy.ops.object.mode_set(mode='OBJECT')
+
+    if filepath:
+        bpy.ops.wm.save_as_mainfile(filepath=filepath, check_existing=False)
+
+    return meta_ob, rig_ob
+
+
+def generate_character_file(params_filepath, output_dir, use_profile=False):
+    """Generate the character of a parameter file, with use_profile its phase timings go next to the blend file"""
+    with open(params_filepath) as f:
+        params = json.load(f)
+
+    name = os.path.splitext(os.path.basename(params_filepath))[0]
+    profiler = profiling.RigProfiler() if use_profile else None
+    result = generate_character(params, os.path.join(output_dir, name + ".blend"), profiler=profiler)
+
+    if profiler:
+        profiler.write_json(os.path.join(output_dir, name + ".profile.json"))
+
+    return result
+
+
+def params_filepaths(paths):
+    filepaths = []
+    for path in paths:
+        if os.path.isdir(path):
+            filepaths.extend(sorted(os.path.join(path, filename) for filename in os.listdir(path)
+                                    if filename.endswith(".json")))
+        else:
+            filepaths.append(path)
+
+    return filepaths
+
+
+def generate_character_subprocess(params_filepath, output_dir, use_profile=False):
+    """Generate one character in a separate background blender, returns its exit code"""
+    #without --python-exit-code an exception in the driver script still exits blender with 0
+    args = [bpy.app.binary_path, "--background", "--factory-startup", "--python-exit-code", "1",
+            "--python", DRIVER_SCRIPT, "--", params_filepath, "--output", output_dir, "--jobs", "1"]
+    if use_profile:
+        args.append("--profile")
+
+    return subprocess.call(args)
+
+
+def main(argv):
+    """
+    Entry point of batch_generate.py. A single parameter file is generated in this blender, several are spread
+    over a pool of background blender processes, one character per process.
+
+    :return: the number of characters that failed
+    """
+    parser = argparse.ArgumentParser(prog="blender --background --python batch_generate.py --",
+                                     description="Generate a meta armature and rig for each parameter file")
+    parser.add_argument("params", nargs='+', help="parameter json files, or directories of them")
+    parser.add_argument("--output", "-o", default=os.getcwd(), help="directory for the generated blend files")
+    parser.add_argument("--jobs", "-j", type=int, default=os.cpu_count() or 1,
+                        help="number of blender processes generating characters at once")
+    parser.add_argument("--profile", action='store_true',
+                        help="write the phase timings of each rig generation to a .profile.json next to its blend file")
+    args = parser.parse_args(argv)
+
+    filepaths = params_filepaths(args.params)
+    if not os.path.isdir(args.output):
+        os.makedirs(args.output)
+
+    start = time.time()
+
+    if len(filepaths) == 1:
+        generate_character_file(filepaths[0], args.output, args.profile)
+        failed = []
+    else:
+        #each character gets a fresh blender, the pool threads only wait on the processes
+        with ThreadPoolExecutor(max_workers=max(args.jobs, 1)) as pool:
+            exit_codes = list(pool.map(lambda filepath: generate_character_subprocess(filepath, args.output,
+                                                                                      args.profile),
+                                       filepaths))
+
+        failed = [filepath for filepath, exit_code in zip(filepaths, exit_codes) if exit_code != 0]
+
+    for filepath in failed:
+        print("Failed to generate %s" % filepath)
+
+    print("Generated %s of %s characters in %.2f seconds" % (len(filepaths) - len(failed), len(filepaths),
+                                                            time.time() - start))
+
+    return len(failed)
@@ -0,0 +1,232 @@
+# ====================== BEGIN GPL LICENSE BLOCK ======================
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+#  The Original Code is Copyright (C) 2013 by: 
+#  Harrison Nordby and Ross Nordby
+#  All rights reserved.
+#
+#  The Original Code is: all of this file
+#  
+#  Contributor(s): none yet.
+#
+#
+#======================= END GPL LICENSE BLOCK ========================
+"""
+Scaling benchmark of meta armature and rig generation, for use in background blender, see run_benchmark.py.
+
+Every configuration of the sweep is generated in the context scene, timed over a number of repeats, measured once
+more with tracemalloc for the peak python memory and removed again. Results are json, keyed by configuration name,
+and can be compared with the results of an earlier run to catch regressions.
+"""
+import bpy
+import argparse
+import json
+import time
+import tracemalloc
+
+from collections import OrderedDict
+
+from . import riggenerator
+from . import profiling
+from . import constraintgraph
+from .batch import meta_armature_params, RIG_OPTIONS_KEY
+
+DRIVER_SCRIPT = "run_benchmark.py"
+
+NUM_TAIL_BONES_SWEEP = (0, 1, 5, 10, 15, 20)
+
+#results that are a measurement, compared against the baseline with a tolerance, the rest must match exactly
+MEASURED_KEYS = ('meta_seconds', 'rig_seconds', 'peak_memory')
+
+
+def benchmark_configurations():
+    """
+    Parameter overrides of the sweep, see batch.meta_armature_params
+
+    :rtype: OrderedDict
+    """
+    configs = OrderedDict()
+    configs["default"] = {}
+
+    for num_fingers in range(1, 6):
+        configs["num_fingers %s" % num_fingers] = {'num_fingers': num_fingers}
+        configs["num_fingers %s simple hand" % num_fingers] = {'num_fingers': num_fingers, 'use_simple_hand': True}
+
+    for num_toes in range(1, 6):
+        configs["num_toes %s" % num_toes] = {'num_toes': num_toes, 'use_simple_toe': False}
+        configs["num_toes %s simple toe" % num_toes] = {'num_toes': num_toes, 'use_simple_toe': True}
+
+    for num_tail_bones in NUM_TAIL_BONES_SWEEP:
+        configs["num_tail_bones %s" % num_tail_bones] = {'num_tail_bones': num_tail_bones}
+
+    for detail_level in riggenerator.RIG_DETAIL_LEVELS[1:]:
+        configs["detail %s" % detail_level.lower()] = {'num_toes': 5, 'use_simple_toe': False, 'num_tail_bones': 5,
+                                                        RIG_OPTIONS_KEY: {'detail_level': detail_level}}
+
+    return configs
+
+
+def remove_generated(meta_ob, rig_ob):
+    for ob in (rig_ob, meta_ob):
+        armature = ob.data
+        riggenerator.unlink_ob_from_all_scenes(ob)
+        bpy.data.objects.remove(ob)
+        bpy.data.armatures.remove(armature)
+
+
+def generate_once(params, scene, profiler=None):
+    """Generate and remove one character, returns the seconds spent on the meta armature, the rig and the counts"""
+    start = time.perf_counter()
+    meta_ob = riggenerator.new_meta_armature_ob(scene, **meta_armature_params(params))
+    meta_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    riggenerator.widgetdata_refresh_defaults()
+    rig_ob = riggenerator.rig_full_body(meta_ob, scene=scene, profiler=profiler, **params.get(RIG_OPTIONS_KEY, {}))
+    rig_seconds = time.perf_counter() - start
+
+    bpy.ops.object.mode_set(mode='OBJECT')
+
+    counts = {'meta_bones': len(meta_ob.data.bones),
+              'rig_bones': len(rig_ob.data.bones),
+              'constraints': sum(len(pchan.constraints) for pchan in rig_ob.pose.bones),
+              'solver_rows': constraintgraph.ConstraintGraph.from_ob(rig_ob).solver_rows()}
+
+    remove_generated(meta_ob, rig_ob)
+
+    return meta_seconds, rig_seconds, counts
+
+
+def benchmark_configuration(params, scene, repeat=3):
+    """
+    Benchmark one configuration. The times are the fastest of repeat runs, the peak memory is measured in a
+    separate run so that tracing doesn't slow down the timed ones.
+    """
+    meta_times = []
+    rig_times = []
+    profiler = profiling.RigProfiler()
+
+    for i in range(max(repeat, 1)):
+        meta_seconds, rig_seconds, counts = generate_once(params, scene, profiler if i == 0 else None)
+        meta_times.append(meta_seconds)
+        rig_times.append(rig_seconds)
+
+    tracemalloc.start()
+    try:
+        generate_once(params, scene)
+        peak_memory = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    result = OrderedDict()
+    result['meta_seconds'] = min(meta_times)
+    result['rig_seconds'] = min(rig_times)
+    result['peak_memory'] = peak_memory
+    result.update(sorted(counts.items()))
+    result['phases'] = profiler.to_dict()
+    return result
+
+
+def run(configs=None, scene=None, repeat=3, log=print):
+    if configs is None:
+        configs = benchmark_configurations()
+
+    if scene is None:
+        scene = bpy.context.scene
+
+    results = OrderedDict()
+    for name, params in configs.items():
+        results[name] = result = benchmark_configuration(params, scene, repeat)
+        log("%-32s meta %.3fs  rig %.3fs  peak %.1f MiB  %s bones  %s constraints" %
+            (name, result['meta_seconds'], result['rig_seconds'], result['peak_memory'] / 1048576.0,
+             result['rig_bones'], result['constraints']))
+
+    return results
+
+
+def compare(results, baseline, tolerance=.25):
+    """
+    Compare results with the results of an earlier run.
+
+    :arg tolerance: relative increase of a measurement that counts as a regression
+    :return: messages for each regression, changed count and configuration missing from either side
+    :rtype: list of str
+    """
+    messages = []
+
+    for name in baseline.keys() - results.keys():
+        messages.append("%s: missing from the results" % name)
+
+    for name, result in results.items():
+        if name not in baseline:
+            messages.append("%s: missing from the baseline" % name)
+            continue
+
+        base = baseline[name]
+        for key, val in result.items():
+            if key == 'phases' or key not in base:
+                continue
+
+            if key in MEASURED_KEYS:
+                if val > base[key] * (1.0 + tolerance):
+                    messages.append("%s: %s regressed from %.4g to %.4g (%+.0f%%)" %
+                                    (name, key, base[key], val, (val / base[key] - 1.0) * 100.0))
+            elif val != base[key]:
+                messages.append("%s: %s changed from %s to %s" % (name, key, base[key], val))
+
+    return messages
+
+
+def main(argv):
+    """
+    Entry point of run_benchmark.py
+
+    :return: the number of regressions against the baseline
+    """
+    parser = argparse.ArgumentParser(prog="blender --background --python %s --" % DRIVER_SCRIPT,
+                                     description="Benchmark meta armature and rig generation over a parameter sweep")
+    parser.add_argument("--output", "-o", help="json file the results are written to")
+    parser.add_argument("--baseline", "-b", help="json results of an earlier run to compare with")
+    parser.add_argument("--tolerance", "-t", type=float, default=.25,
+                        help="relative slowdown or memory increase that counts as a regression")
+    parser.add_argument("--repeat", "-r", type=int, default=3, help="timed runs per configuration")
+    parser.add_argument("--filter", "-f", default="", help="only run configurations whose name contains this")
+    args = parser.parse_args(argv)
+
+    configs = OrderedDict((name, params) for name, params in benchmark_configurations().items()
+                          if args.filter in name)
+
+    results = run(configs, repeat=args.repeat)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if not args.baseline:
+        return 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+
+    if args.filter:
+        baseline = {name: result for name, result in baseline.items() if name in configs}
+
+    messages = compare(results, baseline, args.tolerance)
+    for message in messages:
+        print(message)
+
+    print("%s differences from the baseline" % len(messages))
+    return len(messages)
@@ -0,0 +1,303 @@
+# ====================== BEGIN GPL LICENSE BLOCK ======================
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+#  The Original Code is Copyright (C) 2013 by:
+#  Harrison Nordby and Ross Nordby
+#  All rights reserved.
+#
+#  The Original Code is: all of this file
+#
+#  Contributor(s): none yet.
+#
+#
+#======================= END GPL LICENSE BLOCK ========================
+"""
+Constraint graph of a BEPUik rig: the bones solved by BEPUik connected by their BEPUIK_* constraints, with counts
+per constraint type and body region, the connected components the solver works on and an estimate of the solver
+work per iteration. A graph is built from a rig object or from a RigPlan, and can be exported as json or GraphViz.
+
+The solver work is estimated by the number of constraint rows, the degrees of freedom each constraint removes, which
+the solver goes thru once per iteration.
+"""
+import json
+import re
+
+from collections import OrderedDict
+
+from .riggenerator import split_suffix, BEPUIK_CONSTRAINT_ROWS
+
+#bones with use_bepuik and a ball socket rigidity are held to their parent by a ball socket joint the solver adds on
+#its own, see PlanPruner.is_parent_ball_socket
+IMPLICIT_BALL_SOCKET = 'IMPLICIT_BALL_SOCKET'
+
+#BEPUIK_CONTROL depends on its rigidities, see constraint_rows
+CONSTRAINT_ROWS = dict(BEPUIK_CONSTRAINT_ROWS)
+CONSTRAINT_ROWS[IMPLICIT_BALL_SOCKET] = 3
+
+#first match wins, tested against bone names without MCH- prefix and side suffix
+REGION_PATTERNS = (('tail', re.compile(r"^tail")),
+                   ('hand', re.compile(r"^(hand|finger|palm)")),
+                   ('foot', re.compile(r"^(foot|toe|heel)")),
+                   ('arm', re.compile(r"^(shoulder|uparm|loarm)")),
+                   ('leg', re.compile(r"^(upleg|loleg|leg)")),
+                   ('head', re.compile(r"^(head|neck|jaw|eye|ear)")),
+                   ('spine', re.compile(r"^(hips|spine|chest|ribs|belly|torso)")),
+                   ('root', re.compile(r"^root")))
+
+
+def bone_region(bone_name):
+    """body region of a bone, e.g. "hand.L" for "finger2-1.L" and "spine" for "chest target" """
+    name, suffix = split_suffix(bone_name)
+    if name.startswith("MCH-"):
+        name = name[len("MCH-"):]
+
+    for region, pattern in REGION_PATTERNS:
+        if pattern.match(name):
+            return region + suffix
+
+    return "other" + suffix
+
+
+def constraint_rows(constraint_type, position_rigidity=0, orientation_rigidity=0, use_hard_rigidity=False):
+    """Estimated rows of a constraint, a control only counts the parts with rigidity"""
+    if constraint_type == 'BEPUIK_CONTROL':
+        rows = 0
+        if use_hard_rigidity or position_rigidity > 0:
+            rows += 3
+
+        if use_hard_rigidity or orientation_rigidity > 0:
+            rows += 3
+
+        return rows
+
+    return CONSTRAINT_ROWS.get(constraint_type, 1)
+
+
+class ConstraintEdge():
+    def __init__(self, owner, other, type, name, rows, max_rows):
+        self.owner = owner
+        self.other = other
+        self.type = type
+        self.name = name
+        self.rows = rows
+        #rows once every control has rigidity
+        self.max_rows = max_rows
+
+    def is_control(self):
+        return self.type == 'BEPUIK_CONTROL'
+
+    def to_dict(self):
+        return OrderedDict((('owner', self.owner), ('other', self.other), ('type', self.type), ('name', self.name),
+                            ('region', bone_region(self.owner)), ('rows', self.rows)))
+
+
+class ConstraintGraph():
+    def __init__(self):
+        #bone name -> (use_bepuik, use_bepuik_always_solve)
+        self.bones = OrderedDict()
+        self.edges = []
+
+    def add_bone(self, name, use_bepuik, use_bepuik_always_solve, parent_name=None, ball_socket_rigidity=0):
+        self.bones[name] = (use_bepuik, use_bepuik_always_solve)
+
+        if use_bepuik and parent_name and ball_socket_rigidity > 0:
+            self.edges.append(ConstraintEdge(name, parent_name, IMPLICIT_BALL_SOCKET, "", 3, 3))
+
+    def add_constraint(self, owner, other, type, name, position_rigidity=0, orientation_rigidity=0,
+                       use_hard_rigidity=False):
+        rows = constraint_rows(type, position_rigidity, orientation_rigidity, use_hard_rigidity)
+        max_rows = constraint_rows(type, 1, 1) if type == 'BEPUIK_CONTROL' else rows
+        self.edges.append(ConstraintEdge(owner, other or None, type, name, rows, max_rows))
+
+    def finish(self):
+        #the implicit ball socket needs both bones solved, which is only known once all bones are added
+        self.edges = [edge for edge in self.edges
+                      if edge.type != IMPLICIT_BALL_SOCKET or self.bones.get(edge.other, (False,))[0]]
+
+    @classmethod
+    def from_ob(cls, ob):
+        graph = cls()
+        for pchan in ob.pose.bones:
+            graph.add_bone(pchan.name, pchan.use_bepuik, pchan.use_bepuik_always_solve,
+                           pchan.parent.name if pchan.parent else None, pchan.bepuik_ball_socket_rigidity)
+
+            for con in pchan.constraints:
+                if con.type.startswith('BEPUIK_'):
+                    if con.type == 'BEPUIK_CONTROL':
+                        graph.add_constraint(pchan.name, con.connection_subtarget, con.type, con.name,
+                                             con.bepuik_rigidity, con.orientation_rigidity, con.use_hard_rigidity)
+                    else:
+                        graph.add_constraint(pchan.name, con.connection_subtarget, con.type, con.name)
+
+        graph.finish()
+        return graph
+
+    @classmethod
+    def from_plan(cls, plan):
+        """graph of the rig plan.apply_rig_plan would build, without building it"""
+        graph = cls()
+        for metabone in plan.metabones.values():
+            if not metabone.is_valid():
+                continue
+
+            graph.add_bone(metabone.name, metabone.use_bepuik, metabone.use_bepuik_always_solve,
+                           metabone.parent.name if metabone.parent else None, metabone.bepuik_ball_socket_rigidity)
+
+            for mbc in metabone.meta_blender_constraints:
+                if mbc.type.startswith('BEPUIK_'):
+                    other = getattr(mbc, 'connection_b', None)
+                    graph.add_constraint(metabone.name, other.name if other else None, mbc.type, mbc.name,
+                                         getattr(mbc, 'bepuik_rigidity', 0), getattr(mbc, 'orientation_rigidity', 0),
+                                         getattr(mbc, 'use_hard_rigidity', False))
+
+        graph.finish()
+        return graph
+
+    def counts_by_type(self):
+        counts = {}
+        for edge in self.edges:
+            counts[edge.type] = counts.get(edge.type, 0) + 1
+
+        return OrderedDict(sorted(counts.items()))
+
+    def counts_by_region(self):
+        """region -> constraint type -> count, constraints belong to the region of their owner"""
+        counts = {}
+        for edge in self.edges:
+            region_counts = counts.setdefault(bone_region(edge.owner), {})
+            region_counts[edge.type] = region_counts.get(edge.type, 0) + 1
+
+        return OrderedDict((region, OrderedDict(sorted(region_counts.items())))
+                           for region, region_counts in sorted(counts.items()))
+
+    def always_solve_bones(self):
+        return [name for name, (use_bepuik, use_bepuik_always_solve) in self.bones.items()
+                if use_bepuik_always_solve]
+
+    def solved_bones(self):
+        """bones the solver moves: bones with use_bepuik and bones joined to them by anything but a control"""
+        solved = {name for name, (use_bepuik, use_bepuik_always_solve) in self.bones.items() if use_bepuik}
+        for edge in self.edges:
+            if not edge.is_control() and edge.other in self.bones:
+                solved.add(edge.owner)
+                solved.add(edge.other)
+
+        return [name for name in self.bones.keys() if name in solved]
+
+    def components(self):
+        """
+        Groups of solved bones connected by constraints other than controls, which the solver can work on
+        independently. Largest first, bones in rig order.
+
+        :rtype: list of list of str
+        """
+        solved = self.solved_bones()
+        roots = {name: name for name in solved}
+
+        def find(name):
+            while roots[name] != name:
+                roots[name] = roots[roots[name]]
+                name = roots[name]
+
+            return name
+
+        for edge in self.edges:
+            if not edge.is_control() and edge.owner in roots and edge.other in roots:
+                roots[find(edge.owner)] = find(edge.other)
+
+        components = OrderedDict()
+        for name in solved:
+            components.setdefault(find(name), []).append(name)
+
+        return sorted(components.values(), key=len, reverse=True)
+
+    def solver_rows(self, use_max_rows=False):
+        """Estimated constraint rows per solver iteration, with use_max_rows as if every control had rigidity"""
+        return sum(edge.max_rows if use_max_rows else edge.rows for edge in self.edges)
+
+    def to_dict(self):
+        components = self.components()
+        component_of = {name: i for i, component in enumerate(components) for name in component}
+        component_rows = [0] * len(components)
+        for edge in self.edges:
+            if edge.owner in component_of:
+                component_rows[component_of[edge.owner]] += edge.rows
+
+        summary = OrderedDict((('bones', len(self.bones)),
+                               ('solved_bones', len(component_of)),
+                               ('constraints', len(self.edges)),
+                               ('components', len(components)),
+                               ('solver_rows', self.solver_rows()),
+                               ('max_solver_rows', self.solver_rows(use_max_rows=True))))
+
+        return OrderedDict((('summary', summary),
+                            ('counts_by_type', self.counts_by_type()),
+                            ('counts_by_region', self.counts_by_region()),
+                            ('components', [OrderedDict((('bones', component), ('solver_rows', rows)))
+                                            for component, rows in zip(components, component_rows)]),
+                            ('always_solve', self.always_solve_bones()),
+                            ('constraints', [edge.to_dict() for edge in self.edges])))
+
+    def report_lines(self):
+        d = self.to_dict()
+        summary = d['summary']
+        lines = ["%s constraints on %s bones, %s solved in %s components" %
+                 (summary['constraints'], summary['bones'], summary['solved_bones'], summary['components']),
+                 "%s solver rows per iteration, %s once every control has rigidity" %
+                 (summary['solver_rows'], summary['max_solver_rows']),
+                 "always solved: %s" % (", ".join(d['always_solve']) or "none")]
+
+        for constraint_type, count in d['counts_by_type'].items():
+            lines.append("%-28s %5d" % (constraint_type, count))
+
+        return lines
+
+    def write_json(self, filepath):
+        with open(filepath, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    def to_dot(self, graph_name="rig"):
+        """GraphViz source, controls are dashed edges to their targets and always solved bones are bold"""
+        def quoted(s):
+            return '"%s"' % s.replace('\\', '\\\\').replace('"', '\\"')
+
+        solved = set(self.solved_bones())
+        always_solve = set(self.always_solve_bones())
+        lines = ["graph %s {" % quoted(graph_name), "    node [shape=box];"]
+
+        for name in self.bones.keys():
+            if name in solved:
+                style = ' [style=bold]' if name in always_solve else ''
+                lines.append("    %s%s;" % (quoted(name), style))
+
+        for edge in self.edges:
+            if not edge.other:
+                continue
+
+            attrs = ['label=%s' % quoted(edge.type.replace('BEPUIK_', '').lower())]
+            if edge.is_control():
+                attrs.append('style=dashed')
+                if edge.other not in solved:
+                    lines.append("    %s [shape=ellipse];" % quoted(edge.other))
+
+            lines.append("    %s -- %s [%s];" % (quoted(edge.owner), quoted(edge.other), ", ".join(attrs)))
+
+        lines.append("}")
+        return "\n".join(lines) + "\n"
+
+    def write_dot(self, filepath, graph_name="rig"):
+        with open(filepath, 'w') as f:
+            f.write(self.to_dot(graph_name))
@@ -0,0 +1,117 @@
+# ====================== BEGIN GPL LICENSE BLOCK ======================
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+#  The Original Code is Copyright (C) 2013 by: 
+#  Harrison Nordby and Ross Nordby
+#  All rights reserved.
+#
+#  The Original Code is: all of this file
+#  
+#  Contributor(s): none yet.
+#
+#
+#======================= END GPL LICENSE BLOCK ========================
+import json
+import time
+
+from collections import OrderedDict
+
+
+class PhaseStats():
+    def __init__(self):
+        self.seconds = 0.0
+        self.calls = 0
+        self.objects = 0
+
+    def to_dict(self):
+        return {'seconds': self.seconds, 'calls': self.calls, 'objects': self.objects}
+
+
+class ProfilerPhase():
+    def __init__(self, stats, objects):
+        self.stats = stats
+        self.objects = objects
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stats.seconds += time.perf_counter() - self.start
+        self.stats.calls += 1
+        self.stats.objects += self.objects
+        return False
+
+
+class RigProfiler():
+    """
+    Records wall time, call counts and object counts per named phase of rig generation, in the order the phases
+    are first entered.
+
+        with profiler.phase("edit bones") as phase:
+            phase.objects = len(created_bones)
+    """
+    enabled = True
+
+    def __init__(self):
+        self.phases = OrderedDict()
+
+    def stats(self, name):
+        if name not in self.phases:
+            self.phases[name] = PhaseStats()
+
+        return self.phases[name]
+
+    def phase(self, name, objects=0):
+        return ProfilerPhase(self.stats(name), objects)
+
+    def report_lines(self):
+        return ["%s: %.4fs, %s calls, %s objects" % (name, stats.seconds, stats.calls, stats.objects)
+                for name, stats in self.phases.items()]
+
+    def to_dict(self):
+        return OrderedDict((name, stats.to_dict()) for name, stats in self.phases.items())
+
+    def write_json(self, filepath):
+        with open(filepath, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+
+class NullProfilerPhase():
+    #shared by every phase, so counts written to it are dropped
+    objects = property(lambda self: 0, lambda self, value: None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+class NullProfiler():
+    """Stands in for RigProfiler when profiling is disabled, every phase is the same do nothing context manager"""
+    enabled = False
+    phase_instance = NullProfilerPhase()
+
+    def phase(self, name, objects=0):
+        return NullProfiler.phase_instance
+
+    def report_lines(self):
+        return []
+
+
+NULL_PROFILER = NullProfiler()
@@ -28,13 +28,19 @@
 
 import bpy
 
+from bpy.app.handlers import persistent
 from mathutils import Vector, Matrix, geometry
 from rna_prop_ui import rna_idprop_ui_prop_get
 
 import math
+import functools
+import hashlib
 import inspect
+import json
 import re
 
+from .profiling import NULL_PROFILER
+
 AL_ANIMATABLE = 0
 AL_TARGET = 1
 AL_DEFORMER = 2
@@ -79,6 +85,7 @@ TARGET_SUBSTRINGS = ('target',)
 SUBSTRING_SETS = [HAND_SUBSTRINGS, ARM_SUBSTRINGS, LEG_SUBSTRINGS, FOOT_SUBSTRINGS, TORSO_SUBSTRINGS, RIB_SUBSTRINGS,
                   HEAD_SUBSTRINGS, ROOT_SUBSTRINGS, TARGET_SUBSTRINGS, FACE_SUBSTRINGS]
 
+#(substring set, suffix letter) -> armature layer, filled on first use by layer_map_build
 MAP_SUBSTRING_SET_TO_ARMATURELAYER = {}
 
 def map_substring_set(substring_set, suffixletter_layer_pairs):
@@ -90,18 +97,18 @@ def map_substring_set(substring_set, suffixletter_layer_pairs):
 def map_substring_set_all_suffix_go_to_same_layer(substring_set, layer):
     map_substring_set(substring_set, (('L', layer), ('R', layer), (None, layer), ('', layer)))
 
-map_substring_set(ARM_SUBSTRINGS, (('L', AL_ARM_L), ('R', AL_ARM_R)))
-map_substring_set(LEG_SUBSTRINGS, (('L', AL_LEG_L), ('R', AL_LEG_R)))
-map_substring_set(FOOT_SUBSTRINGS, (('L', AL_FOOT_L), ('R', AL_FOOT_R)))
-map_substring_set(RIB_SUBSTRINGS, (('L', AL_RIB_L), ('R', AL_RIB_R)))
-map_substring_set(HAND_SUBSTRINGS, (('L', AL_HAND_L), ('R', AL_HAND_R)))
-
+def layer_map_build():
+    map_substring_set(ARM_SUBSTRINGS, (('L', AL_ARM_L), ('R', AL_ARM_R)))
+    map_substring_set(LEG_SUBSTRINGS, (('L', AL_LEG_L), ('R', AL_LEG_R)))
+    map_substring_set(FOOT_SUBSTRINGS, (('L', AL_FOOT_L), ('R', AL_FOOT_R)))
+    map_substring_set(RIB_SUBSTRINGS, (('L', AL_RIB_L), ('R', AL_RIB_R)))
+    map_substring_set(HAND_SUBSTRINGS, (('L', AL_HAND_L), ('R', AL_HAND_R)))
 
-map_substring_set_all_suffix_go_to_same_layer(TORSO_SUBSTRINGS, AL_SPINE)
-map_substring_set_all_suffix_go_to_same_layer(HEAD_SUBSTRINGS, AL_HEAD)
-map_substring_set_all_suffix_go_to_same_layer(FACE_SUBSTRINGS, AL_FACE)
-map_substring_set_all_suffix_go_to_same_layer(TARGET_SUBSTRINGS, AL_TARGET)
-map_substring_set_all_suffix_go_to_same_layer(ROOT_SUBSTRINGS, AL_ROOT)
+    map_substring_set_all_suffix_go_to_same_layer(TORSO_SUBSTRINGS, AL_SPINE)
+    map_substring_set_all_suffix_go_to_same_layer(HEAD_SUBSTRINGS, AL_HEAD)
+    map_substring_set_all_suffix_go_to_same_layer(FACE_SUBSTRINGS, AL_FACE)
+    map_substring_set_all_suffix_go_to_same_layer(TARGET_SUBSTRINGS, AL_TARGET)
+    map_substring_set_all_suffix_go_to_same_layer(ROOT_SUBSTRINGS, AL_ROOT)
 
 FINGER_TOE_RIGIDITY = 3
 
@@ -126,40 +133,234 @@ WIDGET_STIFF_CIRCLE = "widget stiff circle"
 WIDGET_STIFF_TRIANGLE = "widget stiff triangle"
 WIDGET_STIFF_SWITCH = "widget stiff switch"
 
+WIDGET_HASH_PROP = "bepuik_widget_hash"
+WIDGET_HASH_PRECISION = 5
+
+#the numpy module once numpy_get imported it, loading it takes longer than the rest of the add-on and it is only needed
+#for widgets
+numpy_module = None
+
+
+def numpy_get():
+    global numpy_module
+    if numpy_module is None:
+        import numpy
+        numpy_module = numpy
+
+    return numpy_module
+
+
+def widget_vertex_array(vertices):
+    numpy = numpy_get()
+    return numpy.array(vertices if vertices is not None else (), dtype=numpy.float32).reshape(-1, 3)
+
+
+def widget_index_array(indices, num_columns=1):
+    numpy = numpy_get()
+    return numpy.array(indices if indices is not None else (), dtype=numpy.int32).reshape(-1, num_columns)
+
 
 class WidgetData():
+    """
+    Geometry of a custom shape in bone space, in contiguous arrays that are handed to the mesh with foreach_set:
+    vertices as float32 rows of (x, y, z), edges as int32 rows of vertex indices, faces as the int32 vertex indices of
+    all their loops with the loop start and loop total of each face. Any sequence can be assigned to vertices, edges
+    and faces.
+    """
     def __init__(self, vertices=None, edges=None, faces=None):
-        if not faces:
-            faces = []
-        if not edges:
-            edges = []
-        if not vertices:
-            vertices = []
         self.vertices = vertices
         self.edges = edges
         self.faces = faces
         self.subsurface_levels = 0
-        self.ob = None
+
+        #name of the object made from this widget, only used while that object has the geometry hash of this widget
+        self.ob_name = None
+
+    @property
+    def vertices(self):
+        return self._vertices
+
+    @vertices.setter
+    def vertices(self, vertices):
+        self._vertices = widget_vertex_array(vertices)
+
+    @property
+    def edges(self):
+        return self._edges
+
+    @edges.setter
+    def edges(self, edges):
+        self._edges = widget_index_array(edges, 2)
+
+    @property
+    def faces(self):
+        return [self.loop_vertices[start:start + total].tolist()
+                for start, total in zip(self.loop_starts.tolist(), self.loop_totals.tolist())]
+
+    @faces.setter
+    def faces(self, faces):
+        numpy = numpy_get()
+
+        faces = faces if faces is not None else ()
+        self.loop_totals = numpy.array([len(f) for f in faces], dtype=numpy.int32)
+        self.loop_starts = numpy.zeros(len(faces), dtype=numpy.int32)
+        numpy.cumsum(self.loop_totals[:-1], out=self.loop_starts[1:])
+        self.loop_vertices = numpy.array([i for f in faces for i in f], dtype=numpy.int32)
+
+    def add_vertices(self, vertices):
+        """Append vertices, returns the index of the first one"""
+        numpy = numpy_get()
+
+        first = len(self._vertices)
+        self._vertices = numpy.concatenate((self._vertices, widget_vertex_array(vertices)))
+        return first
+
+    def add_edges(self, edges):
+        numpy = numpy_get()
+        self._edges = numpy.concatenate((self._edges, widget_index_array(edges, 2)))
 
     def create_ob(self, name):
         mesh = bpy.data.meshes.new(name + " mesh")
+
+        mesh.vertices.add(len(self._vertices))
+        mesh.vertices.foreach_set("co", self._vertices.ravel())
+        mesh.edges.add(len(self._edges))
+        mesh.edges.foreach_set("vertices", self._edges.ravel())
+
+        if len(self.loop_totals):
+            mesh.loops.add(len(self.loop_vertices))
+            mesh.loops.foreach_set("vertex_index", self.loop_vertices)
+            mesh.polygons.add(len(self.loop_totals))
+            mesh.polygons.foreach_set("loop_start", self.loop_starts)
+            mesh.polygons.foreach_set("loop_total", self.loop_totals)
+
+        #like from_pydata, faces given without edges get their edges calculated
+        mesh.update(calc_edges=bool(len(self.loop_totals)) and not len(self._edges))
+
         ob = bpy.data.objects.new(name, mesh)
-        ob.data.from_pydata(self.vertices, self.edges, self.faces)
-        ob.data.update()
 
         if self.subsurface_levels > 0:
             ob.modifiers.new(name="Subsurface", type='SUBSURF').levels = self.subsurface_levels
 
-        self.ob = ob
+        #the mesh is marked too, so it can be found once it has no object anymore
+        ob[WIDGET_HASH_PROP] = mesh[WIDGET_HASH_PROP] = self.geometry_hash()
+
+        self.ob_name = ob.name
         return ob
 
+    def rounded_vertices(self):
+        numpy = numpy_get()
+
+        #+ 0.0 turns -0.0 into 0.0, mirrored widgets often have both
+        return numpy.round(self._vertices.astype(numpy.float64), WIDGET_HASH_PRECISION) + 0.0
+
+    def geometry_hash(self):
+        """Hash of the geometry and subsurface levels, widgets with the same hash share their object"""
+        numpy = numpy_get()
+
+        h = hashlib.sha1()
+        for array in (self.rounded_vertices(), self._edges, self.loop_vertices, self.loop_totals):
+            h.update(repr(array.shape).encode())
+            h.update(numpy.ascontiguousarray(array).tobytes())
+
+        h.update(repr(self.subsurface_levels).encode())
+        return h.hexdigest()
+
+    def mirrored(self):
+        """
+        Copy for the bone on the other side of the rig, the vertices are in bone space so only x is negated. Widgets
+        that are symmetric already are copied unchanged so both sides keep sharing one object.
+        """
+        numpy = numpy_get()
+
+        widgetdata = self.copy()
+        widgetdata._vertices[:, 0] = 0 - widgetdata._vertices[:, 0]
+
+        def sorted_rows(vertices):
+            return vertices[numpy.lexsort(vertices.T[::-1])]
+
+        if numpy.array_equal(sorted_rows(widgetdata.rounded_vertices()), sorted_rows(self.rounded_vertices())):
+            widgetdata._vertices = self._vertices.copy()
+
+        return widgetdata
+
+    def copy(self):
+        widgetdata = WidgetData()
+        widgetdata._vertices = self._vertices.copy()
+        widgetdata._edges = self._edges.copy()
+        widgetdata.loop_vertices = self.loop_vertices.copy()
+        widgetdata.loop_starts = self.loop_starts.copy()
+        widgetdata.loop_totals = self.loop_totals.copy()
+        widgetdata.subsurface_levels = self.subsurface_levels
+        return widgetdata
+
+    def subsurface_baked(self):
+        """
+        Copy with the subsurface levels applied to its geometry, so its object needs no SUBSURF modifier. Each level
+        splits every edge at its middle and moves every vertex with two edges to (previous + 6 * vertex + next) / 8,
+        the cubic B-spline subdivision the modifier does to loose edges, ends and junctions stay in place. Only
+        widgets made of edges are baked, widgets with faces are copied unchanged.
+        """
+        numpy = numpy_get()
+
+        widgetdata = self.copy()
+        if len(self.loop_totals):
+            return widgetdata
+
+        vertices = widgetdata._vertices.astype(numpy.float64)
+        edges = widgetdata._edges
+        for level in range(self.subsurface_levels):
+            num_vertices = len(vertices)
+            neighbour_sums = numpy.zeros_like(vertices)
+            numpy.add.at(neighbour_sums, edges[:, 0], vertices[edges[:, 1]])
+            numpy.add.at(neighbour_sums, edges[:, 1], vertices[edges[:, 0]])
+            midpoints = (vertices[edges[:, 0]] + vertices[edges[:, 1]]) / 2
+
+            smooth = numpy.bincount(edges.ravel(), minlength=num_vertices) == 2
+            vertices[smooth] = (neighbour_sums[smooth] + 6 * vertices[smooth]) / 8
+            vertices = numpy.concatenate((vertices, midpoints))
+
+            #each edge becomes two, in the same order so polylines stay in order
+            midpoint_indices = numpy.arange(num_vertices, num_vertices + len(edges), dtype=numpy.int32)
+            split_edges = numpy.empty((len(edges) * 2, 2), dtype=numpy.int32)
+            split_edges[0::2, 0] = edges[:, 0]
+            split_edges[0::2, 1] = midpoint_indices
+            split_edges[1::2, 0] = midpoint_indices
+            split_edges[1::2, 1] = edges[:, 1]
+            edges = split_edges
+
+        widgetdata._vertices = vertices.astype(numpy.float32)
+        widgetdata._edges = edges
+        widgetdata.subsurface_levels = 0
+        return widgetdata
+
     def transform(self, transform):
-        for i in range(len(self.vertices)):
-            v = transform * Vector(self.vertices[i])
-            self.vertices[i] = (v[0], v[1], v[2])
+        """transform the vertices by a 3x3 or 4x4 matrix"""
+        numpy = numpy_get()
+
+        m = numpy.array(transform, dtype=numpy.float64)
+        vertices = numpy.dot(self._vertices, m[:3, :3].T)
+        if m.shape[1] > 3:
+            vertices += m[:3, 3]
+
+        self._vertices = vertices.astype(numpy.float32)
+
+    def to_dict(self):
+        return {'vertices': self._vertices.tolist(),
+                'edges': self._edges.tolist(),
+                'faces': self.faces,
+                'subsurface_levels': self.subsurface_levels}
+
+    @classmethod
+    def from_dict(cls, d):
+        widgetdata = cls(d['vertices'], d['edges'], d['faces'])
+        widgetdata.subsurface_levels = d['subsurface_levels']
+        return widgetdata
 
 
 def widgetdata_circle(radius):
+    numpy = numpy_get()
+
     widgetdata = WidgetData()
     vertices = [(0.7071068286895752, 0, -0.7071065306663513),
                 (0.8314696550369263, 0, -0.5555699467658997),
@@ -198,7 +399,7 @@ def widgetdata_circle(radius):
                         (20, 21), (21, 22), (22, 23), (23, 24), (24, 25), (25, 26), (26, 27), (27, 28), (28, 29),
                         (29, 30), (30, 31), (0, 31)]
     widgetdata.faces = []
-    widgetdata.vertices = [(v[0] * radius, v[1] * radius, v[2] * radius) for v in vertices]
+    widgetdata.vertices = numpy.array(vertices) * radius
     return widgetdata
 
 
@@ -214,56 +415,267 @@ def widgetdata_pad(width=1.0, length=1.0, mid=.5):
 
 
 def widgetdata_refresh_defaults():
+    #an object of the widget's name may be something else, e.g. a widget from before the geometry changed
     for name, widget in WIDGET_DATA_DEFAULTS.items():
-        if name in bpy.data.objects:
-            widget.ob = bpy.data.objects[name]
-        else:
-            widget.ob = None
+        ob = bpy.data.objects.get(name)
+        widget.ob_name = name if ob and ob.get(WIDGET_HASH_PROP) == widget.geometry_hash() else None
+
+    #user widgets are named after the objects they were imported from, their objects are found by geometry hash
+    for widget in USER_WIDGET_LIBRARY.values():
+        widget.ob_name = None
 
 def unlink_ob_from_all_scenes(ob):
     for scene in bpy.data.scenes:
         if ob.name in scene.objects:
             scene.objects.unlink(ob)
 
-def widgetdata_get(name, custom_widget_data=None):
-    if name in bpy.data.objects:
-        old_ob = bpy.data.objects[name]
-    else:
-        old_ob = None
+#geometry hash -> name of the widget object, None until the objects of the current file have been scanned
+widget_cache = None
+
+
+@persistent
+def widget_cache_clear(dummy=None):
+    global widget_cache
+    widget_cache = None
+
+
+def widget_cache_scan():
+    global widget_cache
+    widget_cache = {}
+    for ob in bpy.data.objects:
+        if ob.type == 'MESH' and WIDGET_HASH_PROP in ob:
+            widget_cache.setdefault(ob[WIDGET_HASH_PROP], ob.name)
+
+
+def widget_cache_get(geometry_hash):
+    if widget_cache is None:
+        widget_cache_scan()
+
+    name = widget_cache.get(geometry_hash)
+    if name is None:
+        return None
+
+    #the object may have been renamed or removed since, look again
+    if name not in bpy.data.objects or bpy.data.objects[name].get(WIDGET_HASH_PROP) != geometry_hash:
+        widget_cache_scan()
+        name = widget_cache.get(geometry_hash)
 
+    return bpy.data.objects[name] if name else None
+
+
+def widgetdata_resolve(name, custom_widget_data=None):
+    """
+    The WidgetData of the custom shape name in custom_widget_data, USER_WIDGET_LIBRARY or WIDGET_DATA_DEFAULTS, the
+    first that has it, None when none has it
+    """
     if custom_widget_data and name in custom_widget_data:
-        widgetdata = custom_widget_data[name]
+        return custom_widget_data[name]
+    elif name in USER_WIDGET_LIBRARY:
+        return USER_WIDGET_LIBRARY[name]
     elif name in WIDGET_DATA_DEFAULTS:
-        widgetdata = WIDGET_DATA_DEFAULTS[name]
-    else:
-        widgetdata = None
+        return WIDGET_DATA_DEFAULTS[name]
 
-    if widgetdata and not widgetdata.ob:
-        if old_ob:
-            old_ob.name += "old"
-            unlink_ob_from_all_scenes(old_ob)
+    return None
 
-        assert isinstance(widgetdata, WidgetData)
-        widgetdata.create_ob(name)
-        new_ob = widgetdata.ob
 
-        bpy.context.scene.objects.link(new_ob)
-        new_ob.layers = OB_LAYERS_WIDGET
-        return new_ob
-    else:
-        return old_ob
+def widgetdata_get(name, custom_widget_data=None):
+    """
+    The widget object for the custom shape name, made from the WidgetData widgetdata_resolve finds. Widgets with
+    identical geometry share one object, also across sides and across rigs, the object is only created when there is
+    none with the same geometry hash yet.
+    """
+    widgetdata = widgetdata_resolve(name, custom_widget_data)
+    if not widgetdata:
+        return bpy.data.objects[name] if name in bpy.data.objects else None
+
+    assert isinstance(widgetdata, WidgetData)
+    geometry_hash = widgetdata.geometry_hash()
+
+    #the object of ob_name may have been replaced by another object of the same name since
+    ob = bpy.data.objects.get(widgetdata.ob_name) if widgetdata.ob_name else None
+    if ob and ob.get(WIDGET_HASH_PROP) == geometry_hash:
+        return ob
+
+    ob = widget_cache_get(geometry_hash)
+
+    if ob is None:
+        ob = widgetdata.create_ob(name)
+        bpy.context.scene.objects.link(ob)
+        ob.layers = OB_LAYERS_WIDGET
+        widget_cache[geometry_hash] = ob.name
+
+    widgetdata.ob_name = ob.name
+    return ob
+
+
+def is_widget_ob(ob):
+    """whether ob is a widget object made by widgetdata_get"""
+    return ob.type == 'MESH' and WIDGET_HASH_PROP in ob
+
+
+def widget_users():
+    """
+    The rigs using each widget object: widget object name -> names of the armature objects with a pose bone that
+    shows it as custom shape
+    """
+    users = {ob.name: set() for ob in bpy.data.objects if is_widget_ob(ob)}
+    for ob in bpy.data.objects:
+        if ob.type == 'ARMATURE' and ob.pose:
+            for pchan in ob.pose.bones:
+                custom_shape = pchan.custom_shape
+                if custom_shape and custom_shape.name in users:
+                    users[custom_shape.name].add(ob.name)
+
+    return users
+
+
+def widgets_purge():
+    """
+    Remove the widget objects no rig uses anymore, and their meshes, in one pass. Marked widget meshes that lost
+    their object some other way are removed as well. Widget objects that are still used by something else than a
+    scene, like a group, are kept.
+
+    :return: number of removed objects, number of removed meshes and their number of vertices
+    :rtype: tuple
+    """
+    meshes = set()
+    num_objects = 0
+    for name, rig_names in widget_users().items():
+        ob = bpy.data.objects[name]
+        if rig_names:
+            continue
+
+        #every scene the object is linked in is one of its users, any other user keeps it linked
+        scenes = [scene for scene in bpy.data.scenes if ob.name in scene.objects]
+        if ob.users > len(scenes):
+            continue
+
+        for scene in scenes:
+            scene.objects.unlink(ob)
+
+        meshes.add(ob.data.name)
+        bpy.data.objects.remove(ob)
+        num_objects += 1
+
+    num_meshes = 0
+    num_vertices = 0
+    for mesh in list(bpy.data.meshes):
+        if mesh.users == 0 and (mesh.name in meshes or WIDGET_HASH_PROP in mesh):
+            num_vertices += len(mesh.vertices)
+            bpy.data.meshes.remove(mesh)
+            num_meshes += 1
+
+    widget_cache_clear()
+    return num_objects, num_meshes, num_vertices
+
+
+def mesh_foreach_get(collection, attr, dtype, num_columns=1):
+    """attr of all items of a mesh collection in one call, as rows of num_columns"""
+    numpy = numpy_get()
+
+    array = numpy.empty(len(collection) * num_columns, dtype=dtype)
+    collection.foreach_get(attr, array)
+    return array.reshape(-1, num_columns) if num_columns > 1 else array
+
+
+def widgetdata_from_ob(ob, use_normalize=False):
+    """
+    WidgetData with the geometry of the mesh object ob, read with foreach_get. Like custom shapes the object
+    transform is ignored. With use_normalize the vertices are scaled so the largest side of their bounding box is 1,
+    the length of the bone the custom shape is scaled to. The subsurface levels are taken from a SUBSURF modifier.
+    """
+    numpy = numpy_get()
+
+    mesh = ob.data
+    widgetdata = WidgetData()
+    widgetdata._vertices = mesh_foreach_get(mesh.vertices, "co", numpy.float32, 3)
+    widgetdata._edges = mesh_foreach_get(mesh.edges, "vertices", numpy.int32, 2)
+    widgetdata.loop_vertices = mesh_foreach_get(mesh.loops, "vertex_index", numpy.int32)
+    widgetdata.loop_starts = mesh_foreach_get(mesh.polygons, "loop_start", numpy.int32)
+    widgetdata.loop_totals = mesh_foreach_get(mesh.polygons, "loop_total", numpy.int32)
+
+    if use_normalize and len(widgetdata._vertices):
+        size = numpy.ptp(widgetdata._vertices, axis=0).max()
+        if size > 0:
+            widgetdata._vertices /= size
+
+    for modifier in ob.modifiers:
+        if modifier.type == 'SUBSURF':
+            widgetdata.subsurface_levels = modifier.levels
+            break
+
+    return widgetdata
 
 
 def pydata_get_edges(obj):
-    return [(edge.vertices[0], edge.vertices[1]) for edge in obj.data.edges]
+    numpy = numpy_get()
+    return [tuple(edge) for edge in mesh_foreach_get(obj.data.edges, "vertices", numpy.int32, 2).tolist()]
 
 
 def pydata_get_vertices(obj):
-    return [(v.co[0], v.co[1], v.co[2]) for v in obj.data.vertices]
+    numpy = numpy_get()
+    return [tuple(co) for co in mesh_foreach_get(obj.data.vertices, "co", numpy.float32, 3).tolist()]
 
 
 def pydata_get_faces(obj):
-    return [[v for v in p.vertices] for p in obj.data.polygons]
+    return widgetdata_from_ob(obj).faces
+
+
+#custom shape name -> WidgetData imported by the user, used instead of the WIDGET_DATA_DEFAULTS of the same name. It is
+#saved in the blend file as json in the WIDGET_LIBRARY_TEXT text, see widget_library_save and widget_library_load.
+USER_WIDGET_LIBRARY = {}
+
+WIDGET_LIBRARY_TEXT = "bepuik widget library"
+
+
+def widget_library_save():
+    """Write USER_WIDGET_LIBRARY to the WIDGET_LIBRARY_TEXT text, which is saved with the blend file"""
+    text = bpy.data.texts.get(WIDGET_LIBRARY_TEXT)
+    if text is None:
+        text = bpy.data.texts.new(WIDGET_LIBRARY_TEXT)
+        text.use_fake_user = True
+
+    text.from_string(json.dumps({name: widgetdata.to_dict() for name, widgetdata in USER_WIDGET_LIBRARY.items()},
+                                sort_keys=True))
+
+
+@persistent
+def widget_library_load(dummy=None):
+    """Replace USER_WIDGET_LIBRARY with the library saved in the WIDGET_LIBRARY_TEXT text, if there is one"""
+    USER_WIDGET_LIBRARY.clear()
+
+    text = bpy.data.texts.get(WIDGET_LIBRARY_TEXT)
+    if text is None:
+        return
+
+    for name, widgetdata_dict in json.loads(text.as_string()).items():
+        USER_WIDGET_LIBRARY[name] = WidgetData.from_dict(widgetdata_dict)
+
+
+def widget_library_hashes():
+    """custom shape name -> geometry hash of the widgets of USER_WIDGET_LIBRARY"""
+    return {name: widgetdata.geometry_hash() for name, widgetdata in USER_WIDGET_LIBRARY.items()}
+
+
+def widget_library_import(obs, use_normalize=False, prefix=""):
+    """
+    Add the mesh objects to USER_WIDGET_LIBRARY, named after the object with prefix removed, e.g. an object
+    "WGT-widget cube" imported with prefix "WGT-" replaces the default "widget cube" of the rigs generated after.
+    Generated widget objects are skipped.
+
+    :return: names of the imported widgets
+    :rtype: list of str
+    """
+    names = []
+    for ob in obs:
+        if ob.type != 'MESH' or is_widget_ob(ob):
+            continue
+
+        name = ob.name[len(prefix):] if prefix and ob.name.startswith(prefix) else ob.name
+        USER_WIDGET_LIBRARY[name] = widgetdata_from_ob(ob, use_normalize=use_normalize)
+        names.append(name)
+
+    return names
 
 
 def quat_get_up(v):
@@ -290,193 +702,267 @@ def quat_get_right(v):
     return Vector((1 - 2 * (y * y + z * z), 2 * (x * y + w * z), 2 * (x * z - w * y)))
 
 
-WIDGET_DATA_DEFAULTS = {}
-wd = WIDGET_DATA_DEFAULTS[WIDGET_CUBE] = WidgetData()
-wd.vertices = [(-1.0, -1.0, -1.0), (-1.0, 1.0, -1.0), (1.0, 1.0, -1.0), (1.0, -1.0, -1.0), (-1.0, -1.0, 1.0),
-               (-1.0, 1.0, 1.0), (1.0, 1.0, 1.0), (1.0, -1.0, 1.0)]
-wd.edges = [(4, 5), (5, 1), (1, 0), (0, 4), (5, 6), (6, 2), (2, 1), (6, 7), (7, 3), (3, 2), (7, 4), (0, 3)]
-wd.faces = []  #faces make bmesh wonky? not right format? [[4, 5, 1, 0], [5, 6, 2, 1], [6, 7, 3, 2], [7, 4, 0, 3], [0, 1, 2, 3], [7, 6, 5, 4]]
-
-wd = WIDGET_DATA_DEFAULTS[WIDGET_SPHERE] = WidgetData()
-wd.vertices = [(-0.3826834559440613, 0.0, 0.9238795638084412), (-0.7071068286895752, 0.0, 0.7071067690849304),
-               (-0.9238795638084412, 0.0, 0.3826834261417389), (-1.0, 0.0, -4.371138828673793e-08),
-               (-0.9238795042037964, 0.0, -0.38268351554870605), (-0.7071067690849304, 0.0, -0.7071067690849304),
-               (-0.38268348574638367, 0.0, -0.9238795042037964), (-1.5099580252808664e-07, 0.0, -1.0),
-               (-0.9238795042037964, 0.3826833665370941, -5.960464477539063e-08),
-               (-0.7071067690849304, 0.7071065902709961, -5.960464477539063e-08),
-               (-0.3826834559440613, 0.9238792657852173, -5.960464477539063e-08),
-               (-1.2119348014039133e-07, 0.38268324732780457, 0.9238796234130859),
-               (-1.5099580252808664e-07, 0.7071065902709961, 0.7071068286895752),
-               (-1.2119348014039133e-07, 0.9238792657852173, 0.3826833963394165),
-               (-1.2119348014039133e-07, 0.9999996423721313, -5.960464477539063e-08),
-               (-1.2119348014039133e-07, 0.9238792657852173, -0.38268351554870605),
-               (-1.3609464133423899e-07, 0.7071064710617065, -0.7071067690849304),
-               (-1.3609464133423899e-07, 0.38268327713012695, -0.9238795042037964),
-               (-2.08779383115143e-07, -1.395019069150294e-07, 1.0),
-               (0.3826831579208374, 0.9238791465759277, -5.960464477539063e-08),
-               (0.7071062922477722, 0.7071064710617065, -5.960464477539063e-08),
-               (0.9238789081573486, 0.3826832175254822, -5.960464477539063e-08),
-               (0.38268303871154785, -2.9802322387695312e-08, 0.9238796234130859),
-               (0.7071062922477722, -1.4901161193847656e-08, 0.7071068286895752),
-               (0.9238789677619934, -8.940696716308594e-08, 0.3826833963394165),
-               (0.9999992847442627, -2.9802322387695312e-08, -5.960464477539063e-08),
-               (0.9238789677619934, -8.940696716308594e-08, -0.38268351554870605),
-               (0.7071061730384827, -2.9802322387695312e-08, -0.7071067690849304),
-               (0.38268303871154785, -2.9802322387695312e-08, -0.9238795042037964),
-               (0.9238788485527039, -0.38268324732780457, -5.960464477539063e-08),
-               (0.7071061730384827, -0.7071064114570618, -5.960464477539063e-08),
-               (0.38268303871154785, -0.9238789677619934, -5.960464477539063e-08),
-               (-1.658969637219343e-07, -0.3826831579208374, 0.9238796234130859),
-               (-1.8079812491578195e-07, -0.707106351852417, 0.7071068286895752),
-               (-2.4040275548031786e-07, -0.9238789677619934, 0.3826833963394165),
-               (-1.8079812491578195e-07, -0.9999993443489075, -5.960464477539063e-08),
-               (-2.4040275548031786e-07, -0.9238789677619934, -0.38268351554870605),
-               (-1.658969637219343e-07, -0.707106351852417, -0.7071067690849304),
-               (-1.658969637219343e-07, -0.3826831579208374, -0.9238795042037964),
-               (-0.3826833665370941, -0.9238789081573486, -5.960464477539063e-08),
-               (-0.7071065306663513, -0.7071062326431274, -5.960464477539063e-08),
-               (-0.923879086971283, -0.3826830983161926, -5.960464477539063e-08)]
-wd.edges = [(0, 1), (1, 2), (2, 3), (3, 4), (4, 5), (5, 6), (6, 7), (3, 8), (8, 9), (9, 10), (11, 12), (12, 13),
-            (13, 14), (14, 15), (15, 16), (16, 17), (10, 14), (14, 19), (19, 20), (20, 21), (22, 23), (23, 24),
-            (24, 25),
-            (25, 26), (26, 27), (27, 28), (21, 25), (25, 29), (29, 30), (30, 31), (32, 33), (33, 34), (34, 35),
-            (35, 36),
-            (36, 37), (37, 38), (31, 35), (35, 39), (39, 40), (40, 41), (18, 0), (18, 11), (17, 7), (18, 22), (28, 7),
-            (18, 32), (38, 7), (41, 3)]
-wd.faces = []
-
-wd = WIDGET_DATA_DEFAULTS[WIDGET_EYE_TARGET] = WidgetData()
-wd.vertices = [(-0.5, 2.9802322387695312e-08, 0.5), (-0.5975451469421387, 2.9802322387695312e-08, 0.49039262533187866),
-               (-0.691341757774353, 2.9802322387695312e-08, 0.4619397819042206),
-               (-0.7777851223945618, 2.9802322387695312e-08, 0.41573479771614075),
-               (-0.8535534143447876, 2.9802322387695312e-08, 0.3535533845424652),
-               (-0.9157347679138184, 2.9802322387695312e-08, 0.2777850925922394),
-               (-0.961939811706543, 1.4901161193847656e-08, 0.19134171307086945),
-               (-0.9903926253318787, 7.450580596923828e-09, 0.09754517674446106),
-               (-1.0, 3.552713678800501e-15, 3.774895063202166e-08),
-               (-0.9903926849365234, -7.450580596923828e-09, -0.09754510223865509),
-               (-0.961939811706543, -1.4901161193847656e-08, -0.19134163856506348),
-               (-0.9157348275184631, -2.9802322387695312e-08, -0.2777850925922394),
-               (-0.8535534143447876, -2.9802322387695312e-08, -0.3535533845424652),
-               (-0.777785062789917, -2.9802322387695312e-08, -0.41573482751846313),
-               (-0.6913416385650635, -2.9802322387695312e-08, -0.4619397819042206),
-               (-0.5975450277328491, -2.9802322387695312e-08, -0.49039265513420105),
-               (-0.49999985098838806, -2.9802322387695312e-08, -0.5),
-               (-0.4024546444416046, -2.9802322387695312e-08, -0.4903925955295563),
-               (-0.30865806341171265, -2.9802322387695312e-08, -0.4619396924972534),
-               (-0.22221463918685913, -2.9802322387695312e-08, -0.4157346487045288),
-               (-0.1464463770389557, -2.9802322387695312e-08, -0.3535531461238861),
-               (-0.08426499366760254, -2.9802322387695312e-08, -0.2777848243713379),
-               (-0.03806006908416748, -1.4901161193847656e-08, -0.1913413405418396),
-               (-0.009607285261154175, -7.450580596923828e-09, -0.09754472970962524),
-               (0.0, 5.684341886080802e-14, 4.827995780942729e-07),
-               (-0.009607464075088501, 7.450580596923828e-09, 0.09754567593336105),
-               (-0.03806045651435852, 1.4901161193847656e-08, 0.19134223461151123),
-               (-0.08426553010940552, 2.9802322387695312e-08, 0.27778562903404236),
-               (-0.1464470624923706, 2.9802322387695312e-08, 0.3535538613796234),
-               (-0.2222154438495636, 2.9802322387695312e-08, 0.4157351851463318),
-               (-0.3086589574813843, 2.9802322387695312e-08, 0.46194005012512207),
-               (-0.402455598115921, 2.9802322387695312e-08, 0.490392804145813), (0.5, 2.9802322387695312e-08, 0.5),
-               (0.40245485305786133, 2.9802322387695312e-08, 0.49039262533187866),
-               (0.308658242225647, 2.9802322387695312e-08, 0.4619397819042206),
-               (0.22221487760543823, 2.9802322387695312e-08, 0.41573479771614075),
-               (0.1464465856552124, 2.9802322387695312e-08, 0.3535533845424652),
-               (0.08426523208618164, 2.9802322387695312e-08, 0.2777850925922394),
-               (0.03806018829345703, 1.4901161193847656e-08, 0.19134171307086945),
-               (0.009607374668121338, 7.450580596923828e-09, 0.09754517674446106),
-               (0.0, 3.552713678800501e-15, 3.774895063202166e-08),
-               (0.009607315063476562, -7.450580596923828e-09, -0.09754510223865509),
-               (0.03806018829345703, -1.4901161193847656e-08, -0.19134163856506348),
-               (0.08426517248153687, -2.9802322387695312e-08, -0.2777850925922394),
-               (0.1464465856552124, -2.9802322387695312e-08, -0.3535533845424652),
-               (0.222214937210083, -2.9802322387695312e-08, -0.41573482751846313),
-               (0.3086583614349365, -2.9802322387695312e-08, -0.4619397819042206),
-               (0.4024549722671509, -2.9802322387695312e-08, -0.49039265513420105),
-               (0.5000001192092896, -2.9802322387695312e-08, -0.5),
-               (0.5975453853607178, -2.9802322387695312e-08, -0.4903925955295563),
-               (0.6913419365882874, -2.9802322387695312e-08, -0.4619396924972534),
-               (0.7777853608131409, -2.9802322387695312e-08, -0.4157346487045288),
-               (0.8535536527633667, -2.9802322387695312e-08, -0.3535531461238861),
-               (0.9157350063323975, -2.9802322387695312e-08, -0.2777848243713379),
-               (0.9619399309158325, -1.4901161193847656e-08, -0.1913413405418396),
-               (0.9903926849365234, -7.450580596923828e-09, -0.09754472970962524),
-               (1.0, 5.684341886080802e-14, 4.827995780942729e-07),
-               (0.9903925657272339, 7.450580596923828e-09, 0.09754567593336105),
-               (0.9619395732879639, 1.4901161193847656e-08, 0.19134223461151123),
-               (0.9157344698905945, 2.9802322387695312e-08, 0.27778562903404236),
-               (0.8535529375076294, 2.9802322387695312e-08, 0.3535538613796234),
-               (0.7777845859527588, 2.9802322387695312e-08, 0.4157351851463318),
-               (0.6913410425186157, 2.9802322387695312e-08, 0.46194005012512207),
-               (0.5975444316864014, 2.9802322387695312e-08, 0.490392804145813)]
-wd.edges = [(1, 0), (2, 1), (3, 2), (4, 3), (5, 4), (6, 5), (7, 6), (8, 7), (9, 8), (10, 9), (11, 10), (12, 11),
-            (13, 12), (14, 13), (15, 14), (16, 15), (17, 16), (18, 17), (19, 18), (20, 19), (21, 20), (22, 21),
-            (23, 22), (24, 23), (25, 24), (26, 25), (27, 26), (28, 27), (29, 28), (30, 29), (31, 30), (0, 31), (33, 32),
-            (34, 33),
-            (35, 34), (36, 35), (37, 36), (38, 37), (39, 38), (40, 39), (41, 40), (42, 41), (43, 42), (44, 43),
-            (45, 44), (46, 45), (47, 46), (48, 47), (49, 48), (50, 49), (51, 50), (52, 51), (53, 52), (54, 53),
-            (55, 54), (56, 55),
-            (57, 56), (58, 57), (59, 58), (60, 59), (61, 60), (62, 61), (63, 62), (32, 63)]
-wd.faces = []
-
-wd = WIDGET_DATA_DEFAULTS[WIDGET_ROOT] = WidgetData()
-wd.vertices = [(0.7071067690849304, 0.7071067690849304, 0.0), (0.7071067690849304, -0.7071067690849304, 0.0),
-               (-0.7071067690849304, 0.7071067690849304, 0.0), (-0.7071067690849304, -0.7071067690849304, 0.0),
-               (0.8314696550369263, 0.5555701851844788, 0.0), (0.8314696550369263, -0.5555701851844788, 0.0),
-               (-0.8314696550369263, 0.5555701851844788, 0.0), (-0.8314696550369263, -0.5555701851844788, 0.0),
-               (0.9238795042037964, 0.3826834261417389, 0.0), (0.9238795042037964, -0.3826834261417389, 0.0),
-               (-0.9238795042037964, 0.3826834261417389, 0.0), (-0.9238795042037964, -0.3826834261417389, 0.0),
-               (0.9807852506637573, 0.19509035348892212, 0.0), (0.9807852506637573, -0.19509035348892212, 0.0),
-               (-0.9807852506637573, 0.19509035348892212, 0.0), (-0.9807852506637573, -0.19509035348892212, 0.0),
-               (0.19509197771549225, 0.9807849526405334, 0.0), (0.19509197771549225, -0.9807849526405334, 0.0),
-               (-0.19509197771549225, 0.9807849526405334, 0.0), (-0.19509197771549225, -0.9807849526405334, 0.0),
-               (0.3826850652694702, 0.9238788485527039, 0.0), (0.3826850652694702, -0.9238788485527039, 0.0),
-               (-0.3826850652694702, 0.9238788485527039, 0.0), (-0.3826850652694702, -0.9238788485527039, 0.0),
-               (0.5555717945098877, 0.8314685821533203, 0.0), (0.5555717945098877, -0.8314685821533203, 0.0),
-               (-0.5555717945098877, 0.8314685821533203, 0.0), (-0.5555717945098877, -0.8314685821533203, 0.0),
-               (0.19509197771549225, 1.2807848453521729, 0.0), (0.19509197771549225, -1.2807848453521729, 0.0),
-               (-0.19509197771549225, 1.2807848453521729, 0.0), (-0.19509197771549225, -1.2807848453521729, 0.0),
-               (1.280785322189331, 0.19509035348892212, 0.0), (1.280785322189331, -0.19509035348892212, 0.0),
-               (-1.280785322189331, 0.19509035348892212, 0.0), (-1.280785322189331, -0.19509035348892212, 0.0),
-               (0.3950919806957245, 1.2807848453521729, 0.0), (0.3950919806957245, -1.2807848453521729, 0.0),
-               (-0.3950919806957245, 1.2807848453521729, 0.0), (-0.3950919806957245, -1.2807848453521729, 0.0),
-               (1.280785322189331, 0.39509034156799316, 0.0), (1.280785322189331, -0.39509034156799316, 0.0),
-               (-1.280785322189331, 0.39509034156799316, 0.0), (-1.280785322189331, -0.39509034156799316, 0.0),
-               (0.0, 1.5807849168777466, 0.0), (0.0, -1.5807849168777466, 0.0), (1.5807852745056152, 0.0, 0.0),
-               (-1.5807852745056152, 0.0, 0.0)]
-wd.edges = [(0, 4), (1, 5), (2, 6), (3, 7), (4, 8), (5, 9), (6, 10), (7, 11), (8, 12), (9, 13), (10, 14), (11, 15),
-            (16, 20), (17, 21), (18, 22), (19, 23), (20, 24), (21, 25), (22, 26), (23, 27), (0, 24), (1, 25), (2, 26),
-            (3, 27), (16, 28), (17, 29), (18, 30), (19, 31), (12, 32), (13, 33), (14, 34), (15, 35), (28, 36), (29, 37),
-            (30, 38), (31, 39), (32, 40), (33, 41), (34, 42), (35, 43), (36, 44), (37, 45), (38, 44), (39, 45),
-            (40, 46),
-            (41, 46), (42, 47), (43, 47)]
-wd.faces = []
-
-wd = WIDGET_DATA_DEFAULTS[WIDGET_BONE] = WidgetData()
-wd.vertices = [(-.1, 0, -.1), (-.1, 1.0, -.1), (.1, 1.0, -.1), (.1, 0, -.1), (-.1, 0, .1), (-.1, 1.0, .1),
-               (.1, 1.0, .1),
-               (.1, 0, .1)]
-wd.edges = [(4, 5), (5, 1), (1, 0), (0, 4), (5, 6), (6, 2), (2, 1), (6, 7), (7, 3), (3, 2), (7, 4), (0, 3)]
-wd.faces = []
-
-wd = WIDGET_DATA_DEFAULTS[WIDGET_STIFF_TRIANGLE] = WidgetData()
-th = .6
-tsl = .2
-wd.vertices = [(-.1, th, -.1), (0, th, .2), (.1, th, -.1), (0, .1, -.1), (0, 1, -.1)]
-wd.edges = [(0, 1), (1, 2), (2, 0), (3, 4)]
-wd.faces = []
-
-wd = WIDGET_DATA_DEFAULTS[WIDGET_STIFF_CIRCLE] = widgetdata_circle(.2)
-wd.transform(Matrix.Translation(Vector((0, .6, 0))))
-num_verts = len(wd.vertices)
-wd.vertices.append((0, .1, -.1))
-wd.vertices.append((0, 1, -.1))
-wd.edges.append((num_verts, num_verts + 1))
-
-wd = WIDGET_DATA_DEFAULTS[WIDGET_STIFF_SWITCH] = WidgetData()
-wd.vertices = [(0, 0, .25), (0, 0, 0), (0, 1, 0), (0, 1, .25)]
-wd.edges = [(0, 1), (1, 2), (2, 3)]
-wd.faces = []
+def widgetdata_cube():
+    widgetdata = WidgetData()
+    widgetdata.vertices = [(-1.0, -1.0, -1.0), (-1.0, 1.0, -1.0), (1.0, 1.0, -1.0), (1.0, -1.0, -1.0),
+                           (-1.0, -1.0, 1.0), (-1.0, 1.0, 1.0), (1.0, 1.0, 1.0), (1.0, -1.0, 1.0)]
+    widgetdata.edges = [(4, 5), (5, 1), (1, 0), (0, 4), (5, 6), (6, 2), (2, 1), (6, 7), (7, 3), (3, 2), (7, 4), (0, 3)]
+    #faces make bmesh wonky? not right format?
+    #[[4, 5, 1, 0], [5, 6, 2, 1], [6, 7, 3, 2], [7, 4, 0, 3], [0, 1, 2, 3], [7, 6, 5, 4]]
+    widgetdata.faces = []
+    return widgetdata
+
+
+def widgetdata_sphere():
+    widgetdata = WidgetData()
+    widgetdata.vertices = [(-0.3826834559440613, 0.0, 0.9238795638084412),
+                           (-0.7071068286895752, 0.0, 0.7071067690849304),
+                           (-0.9238795638084412, 0.0, 0.3826834261417389), (-1.0, 0.0, -4.371138828673793e-08),
+                           (-0.9238795042037964, 0.0, -0.38268351554870605),
+                           (-0.7071067690849304, 0.0, -0.7071067690849304),
+                           (-0.38268348574638367, 0.0, -0.9238795042037964), (-1.5099580252808664e-07, 0.0, -1.0),
+                           (-0.9238795042037964, 0.3826833665370941, -5.960464477539063e-08),
+                           (-0.7071067690849304, 0.7071065902709961, -5.960464477539063e-08),
+                           (-0.3826834559440613, 0.9238792657852173, -5.960464477539063e-08),
+                           (-1.2119348014039133e-07, 0.38268324732780457, 0.9238796234130859),
+                           (-1.5099580252808664e-07, 0.7071065902709961, 0.7071068286895752),
+                           (-1.2119348014039133e-07, 0.9238792657852173, 0.3826833963394165),
+                           (-1.2119348014039133e-07, 0.9999996423721313, -5.960464477539063e-08),
+                           (-1.2119348014039133e-07, 0.9238792657852173, -0.38268351554870605),
+                           (-1.3609464133423899e-07, 0.7071064710617065, -0.7071067690849304),
+                           (-1.3609464133423899e-07, 0.38268327713012695, -0.9238795042037964),
+                           (-2.08779383115143e-07, -1.395019069150294e-07, 1.0),
+                           (0.3826831579208374, 0.9238791465759277, -5.960464477539063e-08),
+                           (0.7071062922477722, 0.7071064710617065, -5.960464477539063e-08),
+                           (0.9238789081573486, 0.3826832175254822, -5.960464477539063e-08),
+                           (0.38268303871154785, -2.9802322387695312e-08, 0.9238796234130859),
+                           (0.7071062922477722, -1.4901161193847656e-08, 0.7071068286895752),
+                           (0.9238789677619934, -8.940696716308594e-08, 0.3826833963394165),
+                           (0.9999992847442627, -2.9802322387695312e-08, -5.960464477539063e-08),
+                           (0.9238789677619934, -8.940696716308594e-08, -0.38268351554870605),
+                           (0.7071061730384827, -2.9802322387695312e-08, -0.7071067690849304),
+                           (0.38268303871154785, -2.9802322387695312e-08, -0.9238795042037964),
+                           (0.9238788485527039, -0.38268324732780457, -5.960464477539063e-08),
+                           (0.7071061730384827, -0.7071064114570618, -5.960464477539063e-08),
+                           (0.38268303871154785, -0.9238789677619934, -5.960464477539063e-08),
+                           (-1.658969637219343e-07, -0.3826831579208374, 0.9238796234130859),
+                           (-1.8079812491578195e-07, -0.707106351852417, 0.7071068286895752),
+                           (-2.4040275548031786e-07, -0.9238789677619934, 0.3826833963394165),
+                           (-1.8079812491578195e-07, -0.9999993443489075, -5.960464477539063e-08),
+                           (-2.4040275548031786e-07, -0.9238789677619934, -0.38268351554870605),
+                           (-1.658969637219343e-07, -0.707106351852417, -0.7071067690849304),
+                           (-1.658969637219343e-07, -0.3826831579208374, -0.9238795042037964),
+                           (-0.3826833665370941, -0.9238789081573486, -5.960464477539063e-08),
+                           (-0.7071065306663513, -0.7071062326431274, -5.960464477539063e-08),
+                           (-0.923879086971283, -0.3826830983161926, -5.960464477539063e-08)]
+    widgetdata.edges = [(0, 1), (1, 2), (2, 3), (3, 4), (4, 5), (5, 6), (6, 7), (3, 8), (8, 9), (9, 10), (11, 12),
+                        (12, 13), (13, 14), (14, 15), (15, 16), (16, 17), (10, 14), (14, 19), (19, 20), (20, 21),
+                        (22, 23), (23, 24), (24, 25), (25, 26), (26, 27), (27, 28), (21, 25), (25, 29), (29, 30),
+                        (30, 31), (32, 33), (33, 34), (34, 35), (35, 36), (36, 37), (37, 38), (31, 35), (35, 39),
+                        (39, 40), (40, 41), (18, 0), (18, 11), (17, 7), (18, 22), (28, 7), (18, 32), (38, 7), (41, 3)]
+    widgetdata.faces = []
+    return widgetdata
+
+
+def widgetdata_eye_target():
+    widgetdata = WidgetData()
+    widgetdata.vertices = [(-0.5, 2.9802322387695312e-08, 0.5),
+                           (-0.5975451469421387, 2.9802322387695312e-08, 0.49039262533187866),
+                           (-0.691341757774353, 2.9802322387695312e-08, 0.4619397819042206),
+                           (-0.7777851223945618, 2.9802322387695312e-08, 0.41573479771614075),
+                           (-0.8535534143447876, 2.9802322387695312e-08, 0.3535533845424652),
+                           (-0.9157347679138184, 2.9802322387695312e-08, 0.2777850925922394),
+                           (-0.961939811706543, 1.4901161193847656e-08, 0.19134171307086945),
+                           (-0.9903926253318787, 7.450580596923828e-09, 0.09754517674446106),
+                           (-1.0, 3.552713678800501e-15, 3.774895063202166e-08),
+                           (-0.9903926849365234, -7.450580596923828e-09, -0.09754510223865509),
+                           (-0.961939811706543, -1.4901161193847656e-08, -0.19134163856506348),
+                           (-0.9157348275184631, -2.9802322387695312e-08, -0.2777850925922394),
+                           (-0.8535534143447876, -2.9802322387695312e-08, -0.3535533845424652),
+                           (-0.777785062789917, -2.9802322387695312e-08, -0.41573482751846313),
+                           (-0.6913416385650635, -2.9802322387695312e-08, -0.4619397819042206),
+                           (-0.5975450277328491, -2.9802322387695312e-08, -0.49039265513420105),
+                           (-0.49999985098838806, -2.9802322387695312e-08, -0.5),
+                           (-0.4024546444416046, -2.9802322387695312e-08, -0.4903925955295563),
+                           (-0.30865806341171265, -2.9802322387695312e-08, -0.4619396924972534),
+                           (-0.22221463918685913, -2.9802322387695312e-08, -0.4157346487045288),
+                           (-0.1464463770389557, -2.9802322387695312e-08, -0.3535531461238861),
+                           (-0.08426499366760254, -2.9802322387695312e-08, -0.2777848243713379),
+                           (-0.03806006908416748, -1.4901161193847656e-08, -0.1913413405418396),
+                           (-0.009607285261154175, -7.450580596923828e-09, -0.09754472970962524),
+                           (0.0, 5.684341886080802e-14, 4.827995780942729e-07),
+                           (-0.009607464075088501, 7.450580596923828e-09, 0.09754567593336105),
+                           (-0.03806045651435852, 1.4901161193847656e-08, 0.19134223461151123),
+                           (-0.08426553010940552, 2.9802322387695312e-08, 0.27778562903404236),
+                           (-0.1464470624923706, 2.9802322387695312e-08, 0.3535538613796234),
+                           (-0.2222154438495636, 2.9802322387695312e-08, 0.4157351851463318),
+                           (-0.3086589574813843, 2.9802322387695312e-08, 0.46194005012512207),
+                           (-0.402455598115921, 2.9802322387695312e-08, 0.490392804145813),
+                           (0.5, 2.9802322387695312e-08, 0.5),
+                           (0.40245485305786133, 2.9802322387695312e-08, 0.49039262533187866),
+                           (0.308658242225647, 2.9802322387695312e-08, 0.4619397819042206),
+                           (0.22221487760543823, 2.9802322387695312e-08, 0.41573479771614075),
+                           (0.1464465856552124, 2.9802322387695312e-08, 0.3535533845424652),
+                           (0.08426523208618164, 2.9802322387695312e-08, 0.2777850925922394),
+                           (0.03806018829345703, 1.4901161193847656e-08, 0.19134171307086945),
+                           (0.009607374668121338, 7.450580596923828e-09, 0.09754517674446106),
+                           (0.0, 3.552713678800501e-15, 3.774895063202166e-08),
+                           (0.009607315063476562, -7.450580596923828e-09, -0.09754510223865509),
+                           (0.03806018829345703, -1.4901161193847656e-08, -0.19134163856506348),
+                           (0.08426517248153687, -2.9802322387695312e-08, -0.2777850925922394),
+                           (0.1464465856552124, -2.9802322387695312e-08, -0.3535533845424652),
+                           (0.222214937210083, -2.9802322387695312e-08, -0.41573482751846313),
+                           (0.3086583614349365, -2.9802322387695312e-08, -0.4619397819042206),
+                           (0.4024549722671509, -2.9802322387695312e-08, -0.49039265513420105),
+                           (0.5000001192092896, -2.9802322387695312e-08, -0.5),
+                           (0.5975453853607178, -2.9802322387695312e-08, -0.4903925955295563),
+                           (0.6913419365882874, -2.9802322387695312e-08, -0.4619396924972534),
+                           (0.7777853608131409, -2.9802322387695312e-08, -0.4157346487045288),
+                           (0.8535536527633667, -2.9802322387695312e-08, -0.3535531461238861),
+                           (0.9157350063323975, -2.9802322387695312e-08, -0.2777848243713379),
+                           (0.9619399309158325, -1.4901161193847656e-08, -0.1913413405418396),
+                           (0.9903926849365234, -7.450580596923828e-09, -0.09754472970962524),
+                           (1.0, 5.684341886080802e-14, 4.827995780942729e-07),
+                           (0.9903925657272339, 7.450580596923828e-09, 0.09754567593336105),
+                           (0.9619395732879639, 1.4901161193847656e-08, 0.19134223461151123),
+                           (0.9157344698905945, 2.9802322387695312e-08, 0.27778562903404236),
+                           (0.8535529375076294, 2.9802322387695312e-08, 0.3535538613796234),
+                           (0.7777845859527588, 2.9802322387695312e-08, 0.4157351851463318),
+                           (0.6913410425186157, 2.9802322387695312e-08, 0.46194005012512207),
+                           (0.5975444316864014, 2.9802322387695312e-08, 0.490392804145813)]
+    widgetdata.edges = [(1, 0), (2, 1), (3, 2), (4, 3), (5, 4), (6, 5), (7, 6), (8, 7), (9, 8), (10, 9), (11, 10),
+                        (12, 11), (13, 12), (14, 13), (15, 14), (16, 15), (17, 16), (18, 17), (19, 18), (20, 19),
+                        (21, 20), (22, 21), (23, 22), (24, 23), (25, 24), (26, 25), (27, 26), (28, 27), (29, 28),
+                        (30, 29), (31, 30), (0, 31), (33, 32), (34, 33), (35, 34), (36, 35), (37, 36), (38, 37),
+                        (39, 38), (40, 39), (41, 40), (42, 41), (43, 42), (44, 43), (45, 44), (46, 45), (47, 46),
+                        (48, 47), (49, 48), (50, 49), (51, 50), (52, 51), (53, 52), (54, 53), (55, 54), (56, 55),
+                        (57, 56), (58, 57), (59, 58), (60, 59), (61, 60), (62, 61), (63, 62), (32, 63)]
+    widgetdata.faces = []
+    return widgetdata
+
+
+def widgetdata_root():
+    widgetdata = WidgetData()
+    widgetdata.vertices = [(0.7071067690849304, 0.7071067690849304, 0.0),
+                           (0.7071067690849304, -0.7071067690849304, 0.0),
+                           (-0.7071067690849304, 0.7071067690849304, 0.0),
+                           (-0.7071067690849304, -0.7071067690849304, 0.0),
+                           (0.8314696550369263, 0.5555701851844788, 0.0),
+                           (0.8314696550369263, -0.5555701851844788, 0.0),
+                           (-0.8314696550369263, 0.5555701851844788, 0.0),
+                           (-0.8314696550369263, -0.5555701851844788, 0.0),
+                           (0.9238795042037964, 0.3826834261417389, 0.0),
+                           (0.9238795042037964, -0.3826834261417389, 0.0),
+                           (-0.9238795042037964, 0.3826834261417389, 0.0),
+                           (-0.9238795042037964, -0.3826834261417389, 0.0),
+                           (0.9807852506637573, 0.19509035348892212, 0.0),
+                           (0.9807852506637573, -0.19509035348892212, 0.0),
+                           (-0.9807852506637573, 0.19509035348892212, 0.0),
+                           (-0.9807852506637573, -0.19509035348892212, 0.0),
+                           (0.19509197771549225, 0.9807849526405334, 0.0),
+                           (0.19509197771549225, -0.9807849526405334, 0.0),
+                           (-0.19509197771549225, 0.9807849526405334, 0.0),
+                           (-0.19509197771549225, -0.9807849526405334, 0.0),
+                           (0.3826850652694702, 0.9238788485527039, 0.0),
+                           (0.3826850652694702, -0.9238788485527039, 0.0),
+                           (-0.3826850652694702, 0.9238788485527039, 0.0),
+                           (-0.3826850652694702, -0.9238788485527039, 0.0),
+                           (0.5555717945098877, 0.8314685821533203, 0.0),
+                           (0.5555717945098877, -0.8314685821533203, 0.0),
+                           (-0.5555717945098877, 0.8314685821533203, 0.0),
+                           (-0.5555717945098877, -0.8314685821533203, 0.0),
+                           (0.19509197771549225, 1.2807848453521729, 0.0),
+                           (0.19509197771549225, -1.2807848453521729, 0.0),
+                           (-0.19509197771549225, 1.2807848453521729, 0.0),
+                           (-0.19509197771549225, -1.2807848453521729, 0.0),
+                           (1.280785322189331, 0.19509035348892212, 0.0),
+                           (1.280785322189331, -0.19509035348892212, 0.0),
+                           (-1.280785322189331, 0.19509035348892212, 0.0),
+                           (-1.280785322189331, -0.19509035348892212, 0.0),
+                           (0.3950919806957245, 1.2807848453521729, 0.0),
+                           (0.3950919806957245, -1.2807848453521729, 0.0),
+                           (-0.3950919806957245, 1.2807848453521729, 0.0),
+                           (-0.3950919806957245, -1.2807848453521729, 0.0),
+                           (1.280785322189331, 0.39509034156799316, 0.0),
+                           (1.280785322189331, -0.39509034156799316, 0.0),
+                           (-1.280785322189331, 0.39509034156799316, 0.0),
+                           (-1.280785322189331, -0.39509034156799316, 0.0), (0.0, 1.5807849168777466, 0.0),
+                           (0.0, -1.5807849168777466, 0.0), (1.5807852745056152, 0.0, 0.0),
+                           (-1.5807852745056152, 0.0, 0.0)]
+    widgetdata.edges = [(0, 4), (1, 5), (2, 6), (3, 7), (4, 8), (5, 9), (6, 10), (7, 11), (8, 12), (9, 13), (10, 14),
+                        (11, 15), (16, 20), (17, 21), (18, 22), (19, 23), (20, 24), (21, 25), (22, 26), (23, 27),
+                        (0, 24), (1, 25), (2, 26), (3, 27), (16, 28), (17, 29), (18, 30), (19, 31), (12, 32), (13, 33),
+                        (14, 34), (15, 35), (28, 36), (29, 37), (30, 38), (31, 39), (32, 40), (33, 41), (34, 42),
+                        (35, 43), (36, 44), (37, 45), (38, 44), (39, 45), (40, 46), (41, 46), (42, 47), (43, 47)]
+    widgetdata.faces = []
+    return widgetdata
+
+
+def widgetdata_bone():
+    widgetdata = WidgetData()
+    widgetdata.vertices = [(-.1, 0, -.1), (-.1, 1.0, -.1), (.1, 1.0, -.1), (.1, 0, -.1), (-.1, 0, .1), (-.1, 1.0, .1),
+                           (.1, 1.0, .1), (.1, 0, .1)]
+    widgetdata.edges = [(4, 5), (5, 1), (1, 0), (0, 4), (5, 6), (6, 2), (2, 1), (6, 7), (7, 3), (3, 2), (7, 4), (0, 3)]
+    widgetdata.faces = []
+    return widgetdata
+
+
+def widgetdata_stiff_triangle():
+    widgetdata = WidgetData()
+    th = .6
+    widgetdata.vertices = [(-.1, th, -.1), (0, th, .2), (.1, th, -.1), (0, .1, -.1), (0, 1, -.1)]
+    widgetdata.edges = [(0, 1), (1, 2), (2, 0), (3, 4)]
+    widgetdata.faces = []
+    return widgetdata
+
+
+def widgetdata_stiff_circle():
+    widgetdata = widgetdata_circle(.2)
+    widgetdata.transform(Matrix.Translation(Vector((0, .6, 0))))
+    num_verts = widgetdata.add_vertices([(0, .1, -.1), (0, 1, -.1)])
+    widgetdata.add_edges([(num_verts, num_verts + 1)])
+    return widgetdata
+
+
+def widgetdata_stiff_switch():
+    widgetdata = WidgetData()
+    widgetdata.vertices = [(0, 0, .25), (0, 0, 0), (0, 1, 0), (0, 1, .25)]
+    widgetdata.edges = [(0, 1), (1, 2), (2, 3)]
+    widgetdata.faces = []
+    return widgetdata
+
+
+#custom shape name -> function making its WidgetData, see WidgetDataDefaults
+WIDGET_DATA_GENERATORS = {WIDGET_CUBE: widgetdata_cube,
+                          WIDGET_SPHERE: widgetdata_sphere,
+                          WIDGET_EYE_TARGET: widgetdata_eye_target,
+                          WIDGET_ROOT: widgetdata_root,
+                          WIDGET_BONE: widgetdata_bone,
+                          WIDGET_STIFF_TRIANGLE: widgetdata_stiff_triangle,
+                          WIDGET_STIFF_CIRCLE: widgetdata_stiff_circle,
+                          WIDGET_STIFF_SWITCH: widgetdata_stiff_switch}
+
+
+class WidgetDataDefaults(dict):
+    """
+    The default widgets by custom shape name, each made by its WIDGET_DATA_GENERATORS function the first time it is
+    looked up, so widgets are only built in sessions that generate rigs and only the ones the rigs use.
+    """
+    def __missing__(self, name):
+        if name not in WIDGET_DATA_GENERATORS:
+            raise KeyError(name)
+
+        widgetdata = self[name] = WIDGET_DATA_GENERATORS[name]()
+        return widgetdata
+
+    def __contains__(self, name):
+        return dict.__contains__(self, name) or name in WIDGET_DATA_GENERATORS
+
+    def get(self, name, default=None):
+        return self[name] if name in self else default
+
 
+WIDGET_DATA_DEFAULTS = WidgetDataDefaults()
 
 #w = WIDGET_DATA_DEFAULTS[WIDGET_FLOOR] = WidgetData()
 #w.vertices = [(-1,-.25,0),(-1,1,0),(1,1,0),(1,-.25,0)]
@@ -577,87 +1063,129 @@ def get_suffix_letter(s):
     return None
 
 
-_blender_struct_attrs = {item[0] for item in inspect.getmembers(bpy.types.Struct)}
+_mirror_name_patterns = {}
+
+
+def mirror_name(name, from_suffixletter='L', to_suffixletter='R'):
+    """
+    Name on the other side of the rig. Suffixes that end the name or a word are replaced, so constraint names like
+    "upleg.L twist limit" are mirrored too. Names without a from_suffixletter suffix are returned unchanged.
+    """
+    pattern = _mirror_name_patterns.get(from_suffixletter)
+
+    if pattern is None:
+        delimiters = re.escape("".join(_recognized_suffix_delimiters))
+        pattern = re.compile(r"(?<=[%s])%s(?= |$)" % (delimiters, re.escape(from_suffixletter)))
+        _mirror_name_patterns[from_suffixletter] = pattern
+
+    return pattern.sub(to_suffixletter, name)
+
+
+#attributes every bpy struct has, looked up on first use of get_rig_relevant_attr_names
+_blender_struct_attrs = None
 
 
 def get_rig_relevant_attr_names(ob):
     global _blender_struct_attrs
+    if _blender_struct_attrs is None:
+        _blender_struct_attrs = {item[0] for item in inspect.getmembers(bpy.types.Struct)}
+
     return {item[0] for item in inspect.getmembers(ob)
             if item[0] not in _blender_struct_attrs | {'__qualname__', '__weakref__', '__dict__'}
             if not hasattr(getattr(ob, item[0]), '__call__')}
 
 
-class MetaBlenderConstraint():
-    def __init__(self, type, name=None):
-        self.type = type
-        self.name = name
+CONSTRAINT_ATTR_VALUE = 0
+CONSTRAINT_ATTR_ANGLE = 1
+CONSTRAINT_ATTR_METABONE = 2
+CONSTRAINT_ATTR_METABONE_AXIS = 3
+CONSTRAINT_ATTR_METABONE_HEAD_TAIL = 4
 
-    def apply_data_to_pchan(self, pbone):
-        constraint = pbone.constraints.new(type=self.type)
+CONSTRAINT_EXCLUDED_ATTR_NAMES = {'name', 'type', 'connection_a', 'connection_b', 'target', 'subtarget', 'rigidity'}
+CONSTRAINT_ANGLE_ATTR_NAMES = {'max_swing', 'max_twist'}
 
-        excluded_attr_names = {'name', 'type', 'connection_a', 'connection_b', 'target', 'subtarget', 'rigidity'}
-        angle_attr_names = {'max_swing', 'max_twist'}
+#setter plans keyed on (constraint type, attribute layout), see ConstraintSetterPlan
+_constraint_setter_plans = {}
 
-        #get the attributes that associate with important attributes in a blender constraint
-        self_attr_names = get_rig_relevant_attr_names(self)
-        self_attr_names -= excluded_attr_names
 
-        constraint.name = self.name
+def constraint_attr_kind(attr_name, val):
+    if attr_name in CONSTRAINT_ANGLE_ATTR_NAMES:
+        return CONSTRAINT_ATTR_ANGLE
+
+    typeofval = type(val)
+    if typeofval is MetaBone:
+        return CONSTRAINT_ATTR_METABONE
+    elif (typeofval is list or typeofval is tuple) and len(val) > 1 and type(val[0]) is MetaBone:
+        val1type = type(val[1])
+        if val1type is str:
+            return CONSTRAINT_ATTR_METABONE_AXIS
+        elif val1type is int or val1type is float:
+            return CONSTRAINT_ATTR_METABONE_HEAD_TAIL
+
+    return CONSTRAINT_ATTR_VALUE
+
 
-        if constraint.is_bepuik:
-            #we know that the bepuik constraint's object targets should always be the context object
-            constraint.connection_target = bpy.context.object
+def constraint_attr_layout(mbc):
+    return tuple(sorted((attr_name, constraint_attr_kind(attr_name, val)) for attr_name, val in vars(mbc).items()
+                        if attr_name not in CONSTRAINT_EXCLUDED_ATTR_NAMES))
+
+
+class ConstraintSetterPlan():
+    """
+    Knows how to copy the attributes of every MetaBlenderConstraint sharing a constraint type and attribute layout
+    onto a blender constraint. Compiled once from the first blender constraint of its kind, then replayed without
+    any introspection.
+    """
+    def __init__(self, constraint, layout, attr_names):
+        self.is_bepuik = constraint.is_bepuik
+        self.has_target = hasattr(constraint, "target")
+        self.has_subtarget = hasattr(constraint, "subtarget")
+
+        if self.is_bepuik:
+            self.setters = [(attr_name, kind) for attr_name, kind in layout if attr_name in attr_names]
+        else:
+            #non bepuik constraints get their values copied over as is
+            self.setters = [(attr_name, CONSTRAINT_ATTR_VALUE) for attr_name, kind in layout if attr_name in attr_names]
+
+    def apply(self, mbc, constraint, pbone, ob):
+        if self.is_bepuik:
+            #bepuik constraints only ever connect bones within the same armature, so every object target is ob
+            constraint.connection_target = ob
 
             #the pchan containing the constraint is always considered connection a
             #therefore the connection subtarget is always connection b
-            constraint.connection_subtarget = self.connection_b.name
+            constraint.connection_subtarget = mbc.connection_b.name
 
-            if hasattr(self, 'rigidity'):
-                constraint.bepuik_rigidity = self.rigidity
+            if hasattr(mbc, 'rigidity'):
+                constraint.bepuik_rigidity = mbc.rigidity
 
-            for attr_name in self_attr_names:
-                dodefault = False
-                val = getattr(self, attr_name)
-                typeofval = type(val)
-                #                print(pbone,constraint,attr_name,val)
-                if attr_name in angle_attr_names:
+            for attr_name, kind in self.setters:
+                val = getattr(mbc, attr_name)
+                if kind == CONSTRAINT_ATTR_ANGLE:
                     #rig generation code always uses degrees, so we need to convert
                     setattr(constraint, attr_name, math.radians(val))
-                elif typeofval is MetaBone:
+                elif kind == CONSTRAINT_ATTR_METABONE:
                     '''
                     Blender constraints use a string to point to bones, but this
                     rig generation code doesn't use strings, it uses a Metabone object.
                     We can get the needed blender bone name from the metabone.name attribute
-                    
+
                     Also, the rig generation code is concise, and leaves off the _subtarget suffix,
                     so it has to be reapplied to set the proper blender python attribute
                     '''
                     setattr(constraint, attr_name + "_subtarget", val.name)
-                    setattr(constraint, attr_name + "_target", bpy.context.object)
-                elif typeofval is list or typeofval is tuple:
-                    mytuple = val
-
-                    if type(val[0]) == MetaBone:
-                        val1type = type(val[1])
-
-                        if val1type == str:
-                            #axis using bone as reference
-                            setattr(constraint, attr_name + "_target", bpy.context.object)
-                            setattr(constraint, attr_name + "_subtarget", val[0].name)
-                            setattr(constraint, attr_name, val[1])
-                        elif val1type == int or val1type == float:
-                            #point using bone as reference
-                            setattr(constraint, attr_name + "_target", bpy.context.object)
-                            setattr(constraint, attr_name + "_subtarget", val[0].name)
-                            setattr(constraint, attr_name + "_head_tail", val[1])
-                        else:
-                            dodefault = True
-                    else:
-                        dodefault = True
+                    setattr(constraint, attr_name + "_target", ob)
+                elif kind == CONSTRAINT_ATTR_METABONE_AXIS:
+                    #axis using bone as reference
+                    setattr(constraint, attr_name + "_target", ob)
+                    setattr(constraint, attr_name + "_subtarget", val[0].name)
+                    setattr(constraint, attr_name, val[1])
+                elif kind == CONSTRAINT_ATTR_METABONE_HEAD_TAIL:
+                    #point using bone as reference
+                    setattr(constraint, attr_name + "_target", ob)
+                    setattr(constraint, attr_name + "_subtarget", val[0].name)
+                    setattr(constraint, attr_name + "_head_tail", val[1])
                 else:
-                    dodefault = True
-
-                if dodefault:
                     try:
                         setattr(constraint, attr_name, val)
                     except:
@@ -666,19 +1194,49 @@ class MetaBlenderConstraint():
                                             constraint:%s
                                             attr:%s
                                             val:%s""" % (pbone.name, constraint.name, attr_name, val))
-
         else:
-            if hasattr(constraint, "target"):
-                if not hasattr(self, "target"):
-                    constraint.target = bpy.context.object
+            if self.has_target:
+                if not hasattr(mbc, "target"):
+                    constraint.target = ob
+
+            if self.has_subtarget:
+                if not hasattr(mbc, "subtarget"):
+                    if hasattr(mbc, "connection_b"):
+                        constraint.subtarget = mbc.connection_b.name
+
+            for attr_name, kind in self.setters:
+                setattr(constraint, attr_name, getattr(mbc, attr_name))
+
+
+def constraint_setter_plan_get(mbc, constraint):
+    layout = constraint_attr_layout(mbc)
+    key = (mbc.type, layout)
+
+    plan = _constraint_setter_plans.get(key)
+    if plan is None:
+        #get the attributes that associate with important attributes in a blender constraint
+        attr_names = get_rig_relevant_attr_names(mbc) - CONSTRAINT_EXCLUDED_ATTR_NAMES
+        plan = _constraint_setter_plans[key] = ConstraintSetterPlan(constraint, layout, attr_names)
 
-            if hasattr(constraint, "subtarget"):
-                if not hasattr(self, "subtarget"):
-                    if hasattr(self, "connection_b"):
-                        constraint.subtarget = self.connection_b.name
+    return plan
 
-            for attr_name in self_attr_names:
-                setattr(constraint, attr_name, getattr(self, attr_name))
+
+def meta_blender_constraint_numbered_name(type, number):
+    """name MetaBone.new_meta_blender_constraint gives to the number-th constraint of a metabone when none is given"""
+    return "%s %s" % (type.lower().replace("_", " "), number)
+
+
+class MetaBlenderConstraint():
+    def __init__(self, type, name=None):
+        self.type = type
+        self.name = name
+
+    def apply_data_to_pchan(self, pbone):
+        constraint = pbone.constraints.new(type=self.type)
+        constraint.name = self.name
+
+        #bepuik constraint object targets are always the armature owning the pose bone
+        constraint_setter_plan_get(self, constraint).apply(self, constraint, pbone, pbone.id_data)
 
 
 def safesetattr(ob, attr, val):
@@ -704,6 +1262,65 @@ def vector3_to_vector4(v3):
     return Vector((v3[0], v3[1], v3[2], 0))
 
 
+#when True, the values cached by metabone_cached are checked against a recomputation every time they are used
+METABONE_CHECK_CACHE = False
+
+
+def metabone_cache_flat(val):
+    if isinstance(val, Matrix):
+        return [co for row in val for co in row]
+    elif isinstance(val, Vector):
+        return list(val)
+
+    return [val]
+
+
+def metabone_cached(compute):
+    """
+    Decorator for MetaBone methods that only depend on head, tail and align_roll. The result is cached until one of
+    them is set again, vectors and matrices are frozen because every caller gets the same one.
+    """
+    name = compute.__name__
+
+    @functools.wraps(compute)
+    def cached(self):
+        cache = self._cache
+        if cache is None:
+            cache = self._cache = {}
+        elif name in cache:
+            if METABONE_CHECK_CACHE:
+                differences = [abs(a - b) for a, b in zip(metabone_cache_flat(cache[name]),
+                                                          metabone_cache_flat(compute(self)))]
+                assert max(differences) < 0.000001, "cached %s of %s is stale" % (name, self.name)
+
+            return cache[name]
+
+        val = compute(self)
+        if isinstance(val, (Vector, Matrix)):
+            val.freeze()
+
+        cache[name] = val
+        return val
+
+    return cached
+
+
+def metabone_cache_source(slot):
+    """Property for a value the metabone_cached methods depend on, setting it drops the cached values"""
+    def fget(self):
+        return getattr(self, slot)
+
+    def fset(self, val):
+        #frozen so that the cached values can't go stale by changing the vector in place
+        if not (isinstance(val, Vector) and val.is_frozen):
+            val = Vector(val).freeze()
+
+        setattr(self, slot, val)
+        self._cache = None
+
+    return property(fget, fset)
+
+
 class MetaBone():
     """ A MetaBone object stores common values between pchans, ebones, and metabones, and helps control how information is copied between them """
     ebone_attrs = {'head': Vector((0, 0, 0)),
@@ -737,6 +1354,9 @@ class MetaBone():
     #can only be accessed thru the bone context for some strange reason
     bone_attrs = {'show_wire': False}
 
+    #ebone attrs under a different name in the rest data of the armature, roll has no counterpart there
+    bone_rest_attr_names = {'head': 'head_local', 'tail': 'tail_local', 'roll': None}
+
     special_attrs = {'align_roll': Vector((0, 0, 1)),
                      'parent': None}
 
@@ -745,15 +1365,31 @@ class MetaBone():
                      list(bone_attrs.items()) +
                      list(special_attrs.items()))
 
+    #attrs that were never set share these, vectors are frozen so they can't be changed in place
+    shared_defaults = {attr: val.copy().freeze() if isinstance(val, Vector) else val for attr, val in all_attrs.items()}
+
+    #what __getattr__ returns for the slots that aren't set
+    slot_defaults = dict(shared_defaults, _cache=None, _head=shared_defaults['head'], _tail=shared_defaults['tail'],
+                         _align_roll=shared_defaults['align_roll'])
+
+    #attributes the finger and toe rig functions set on some metabones, they are only there once set
+    rig_function_attrs = ('swing', 'swing_angle_max', 'swing_angle_min', 'swing_center', 'swing_x', 'swing_y')
+
+    __slots__ = ('name', 'meta_blender_constraints', '_cache', '_head', '_tail', '_align_roll') + \
+                rig_function_attrs + tuple(sorted(set(all_attrs.keys()) - {'head', 'tail', 'align_roll'}))
+
+    head = metabone_cache_source('_head')
+    tail = metabone_cache_source('_tail')
+    align_roll = metabone_cache_source('_align_roll')
+
     def __init__(self, name, metabone=None, transform=None, length=None):
         self.meta_blender_constraints = []
 
         if metabone:
-            for attr in MetaBone.all_attrs.keys():
-                safesetattr(self, attr, getattr(metabone, attr))
-        else:
-            for attr, val in MetaBone.all_attrs.items():
-                safesetattr(self, attr, val)
+            for attr, default in MetaBone.shared_defaults.items():
+                val = getattr(metabone, attr)
+                if val is not default:
+                    safesetattr(self, attr, val)
 
         if transform:
             self.head = transform * self.head
@@ -765,6 +1401,24 @@ class MetaBone():
 
         self.name = name
 
+    def __getattr__(self, attr):
+        #only called for attrs that aren't set
+        try:
+            return MetaBone.slot_defaults[attr]
+        except KeyError:
+            raise AttributeError("'MetaBone' object has no attribute '%s'" % attr)
+
+    def attr_items(self):
+        """all attributes of the metabone but its constraints, including the ones added by the rig functions"""
+        for attr in MetaBone.all_attrs.keys():
+            yield attr, getattr(self, attr)
+
+        yield 'name', self.name
+
+        for attr in MetaBone.rig_function_attrs:
+            if hasattr(self, attr):
+                yield attr, getattr(self, attr)
+
     def copy_pchan_data(self, pchan):
         for attr in MetaBone.pchan_attrs.keys():
             safesetattr(self, attr, getattr(pchan, attr))
@@ -778,6 +1432,17 @@ class MetaBone():
 
         self.align_roll = ebone.z_axis.copy()
 
+    def copy_bone_data(self, bone):
+        """Like copy_ebone_data, from the rest data of the armature so that it works outside of EDIT mode"""
+        for attr in MetaBone.ebone_attrs.keys():
+            bone_attr = MetaBone.bone_rest_attr_names.get(attr, attr)
+            if bone_attr:
+                safesetattr(self, attr, getattr(bone, bone_attr))
+
+        #roll only matters thru align_roll, see apply_data_to_ebone
+        self.roll = 0
+        self.align_roll = bone.matrix_local.to_3x3().col[2].copy()
+
     def is_valid(self):
         return self.length() > 0.0001
 
@@ -785,10 +1450,18 @@ class MetaBone():
         if not self.is_valid():
             return None
 
-        length = (self.tail - self.head).length
         ebone = ob.data.edit_bones.new(name=self.name)
+        self.apply_data_to_ebone(ebone)
 
-        if not self.head_radius:
+        #create editbone selects the tail, but we dont want that
+        ebone.select_tail = False
+
+        return ebone
+
+    def apply_data_to_ebone(self, ebone):
+        length = (self.tail - self.head).length
+
+        if not self.head_radius:
             self.head_radius = length / 10
 
         if not self.tail_radius:
@@ -809,14 +1482,14 @@ class MetaBone():
 
         ebone.align_roll(self.align_roll.normalized())
 
-        #create editbone selects the tail, but we dont want that
-        ebone.select_tail = False
-
-        return ebone
-
-    def apply_data_to_pchan(self, pchan):
+    def apply_data_to_pchan(self, pchan, custom_shapes=None):
         for attr in MetaBone.pchan_attrs.keys():
-            safesetattr(pchan, attr, getattr(self, attr))
+            val = getattr(self, attr)
+            if attr == 'custom_shape' and isinstance(val, str):
+                #custom shapes can be given by widget name, see RigPlan
+                val = custom_shapes[val] if custom_shapes else widgetdata_get(val)
+
+            safesetattr(pchan, attr, val)
 
         for attr in MetaBone.bone_attrs.keys():
             safesetattr(pchan.bone, attr, getattr(self, attr))
@@ -841,7 +1514,7 @@ class MetaBone():
         :rtype: MetaBlenderConstraint
         """
         if not name:
-            name = "%s %s" % (type.lower().replace("_", " "), len(self.meta_blender_constraints) + 1)
+            name = meta_blender_constraint_numbered_name(type, len(self.meta_blender_constraints) + 1)
 
         mbc = MetaBlenderConstraint(type, name)
 
@@ -860,11 +1533,13 @@ class MetaBone():
 
         return metabone
 
+    @metabone_cached
     def y_axis(self):
         v = (self.tail - self.head)
         assert not vector_is_zero(v), "%s has same tail and head" % self.name
         return v.normalized()
 
+    @metabone_cached
     def x_axis(self):
         y = self.y_axis()
         ar = self.align_roll
@@ -875,12 +1550,14 @@ class MetaBone():
 
         return c.normalized()
 
+    @metabone_cached
     def z_axis(self):
         return self.x_axis().cross(self.y_axis()).normalized()
 
     def center(self):
         return (self.head + self.tail) / 2
 
+    @metabone_cached
     def matrix(self):
         m = Matrix.Identity(4)
 
@@ -894,10 +1571,16 @@ class MetaBone():
 
         return m
 
+    @metabone_cached
     def length(self):
         return (self.tail - self.head).length
 
 
+def metabone_set_attrs(metabone, attrs):
+    for attr, val in attrs.items():
+        setattr(metabone, attr, val)
+
+
 def suffixed(name, suffixletter):
     if suffixletter:
         return "%s.%s" % (name, suffixletter)
@@ -905,10 +1588,31 @@ def suffixed(name, suffixletter):
         return name
 
 
+#keys of finger and toe segments, e.g. finger1-2.L
+_phalange_key_pattern = re.compile(r"^(?P<chain>\D+?)(?P<phalange>\d+)-(?P<segment>\d+)(?:\.(?P<suffixletter>\w))?$")
+
+
+@functools.lru_cache(maxsize=None)
+def phalange_key_parse(key):
+    """(chain name, phalange number, segment number, suffix letter) of a phalange segment key, otherwise None"""
+    match = _phalange_key_pattern.match(key)
+    if not match:
+        return None
+
+    return match.group('chain'), int(match.group('phalange')), int(match.group('segment')), \
+           match.group('suffixletter') or ""
+
+
 class MetaBoneDict(dict):
     def __init__(self, *args):
         dict.__init__(self, args)
 
+        #(chain name, suffix letter) -> {phalange number: {segment number: key}}, kept up to date as metabones are
+        #added and removed so that finger and toe segments can be looked up without probing for their keys
+        self.phalange_index = {}
+        for key in self.keys():
+            self.phalange_index_add(key)
+
     def __getitem__(self, key):
         if key in self:
             return dict.__getitem__(self, key)
@@ -919,6 +1623,66 @@ class MetaBoneDict(dict):
         if key in self:
             raise Exception("Cannot add metabone with name %s! Already exists!" % key)
         dict.__setitem__(self, key, val)
+        self.phalange_index_add(key)
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self.phalange_index_remove(key)
+
+    def pop(self, key, *default):
+        if key in self:
+            self.phalange_index_remove(key)
+
+        return dict.pop(self, key, *default)
+
+    def clear(self):
+        dict.clear(self)
+        self.phalange_index.clear()
+
+    def phalange_index_add(self, key):
+        parsed = phalange_key_parse(key)
+        if parsed:
+            chain, phalange, segment, suffixletter = parsed
+            self.phalange_index.setdefault((chain, suffixletter), {}).setdefault(phalange, {})[segment] = key
+
+    def phalange_index_remove(self, key):
+        parsed = phalange_key_parse(key)
+        if parsed:
+            chain, phalange, segment, suffixletter = parsed
+            phalanges = self.phalange_index[chain, suffixletter]
+            del phalanges[phalange][segment]
+
+            if not phalanges[phalange]:
+                del phalanges[phalange]
+
+                if not phalanges:
+                    del self.phalange_index[chain, suffixletter]
+
+    def phalange_numbers(self, chain, suffixletter, max_phalange=None):
+        """numbers of the phalanges of a chain (e.g. the fingers of a hand) that have any segments, in order"""
+        phalanges = self.phalange_index.get((chain, suffixletter), {})
+        return [p for p in sorted(phalanges.keys()) if max_phalange is None or p <= max_phalange]
+
+    def phalange_segment(self, chain, phalange, segment, suffixletter):
+        key = self.phalange_index.get((chain, suffixletter), {}).get(phalange, {}).get(segment)
+        return dict.__getitem__(self, key) if key else None
+
+    def segment_siblings(self, chain, segment, suffixletter, max_phalange=None):
+        """the segment with the same number from every phalange of a chain that has it, in phalange order"""
+        phalanges = self.phalange_index.get((chain, suffixletter), {})
+        return [dict.__getitem__(self, phalanges[p][segment])
+                for p in self.phalange_numbers(chain, suffixletter, max_phalange) if segment in phalanges[p]]
+
+    def final_segments(self, chain, suffixletter, max_segment=None, max_phalange=None):
+        """the last segment of every phalange of a chain, not counting segments after max_segment"""
+        phalanges = self.phalange_index.get((chain, suffixletter), {})
+        final_segments = []
+        for p in self.phalange_numbers(chain, suffixletter, max_phalange):
+            segments = [s for s in phalanges[p].keys() if max_segment is None or s <= max_segment]
+            if segments:
+                final_segments.append(dict.__getitem__(self, phalanges[p][max(segments)]))
+
+        return final_segments
 
     def new_bone(self, name, metabone=None, transform=None, length=None):
         self[name] = MetaBone(name, metabone, transform, length)
@@ -1005,55 +1769,122 @@ class MetaBoneDict(dict):
 
 
     @classmethod
-    def from_ob(cls, ob):
+    def from_ob(cls, ob, profiler=NULL_PROFILER):
+        """
+        Read the metabones of ob without changing its mode. Outside of EDIT mode the rest data comes from the
+        armature bones, in EDIT mode from the edit bones, which are the only up to date ones then.
+        """
         assert ob.type == 'ARMATURE'
-        assert ob.mode == 'POSE'
-        assert ob == bpy.context.object
 
-        metabones = MetaBoneDict()
+        with profiler.phase("from_ob", len(ob.data.bones)):
+            metabones = MetaBoneDict()
 
-        for pchan in ob.pose.bones:
-            metabone = metabones.new_bone(pchan.name)
-            metabone.copy_pchan_data(pchan)
+            if ob.mode == 'EDIT':
+                assert ob == bpy.context.object
+                rest_bones = ob.data.edit_bones
+            else:
+                rest_bones = ob.data.bones
 
-        bpy.ops.object.mode_set(mode='EDIT', toggle=False)
+            for bone in rest_bones:
+                metabone = metabones.new_bone(bone.name)
+                if bone.name in ob.pose.bones:
+                    metabone.copy_pchan_data(ob.pose.bones[bone.name])
 
-        for name, metabone in metabones.items():
-            ebone = ob.data.edit_bones[name]
-            metabone.copy_ebone_data(ebone)
+                if ob.mode == 'EDIT':
+                    metabone.copy_ebone_data(bone)
+                else:
+                    metabone.copy_bone_data(bone)
 
-            if ebone.parent:
-                metabones[ebone.name].parent = metabones[ebone.parent.name]
+            for bone in rest_bones:
+                if bone.parent:
+                    metabones[bone.name].parent = metabones[bone.parent.name]
 
         return metabones
 
-    def to_ob(self, ob):
+    def to_ob(self, ob, custom_widget_data=None, profiler=NULL_PROFILER, mode='POSE'):
+        """
+        Create the missing bones of ob, which must be the context object. All edit bones are created in a single
+        EDIT mode session, which is entered if ob isn't in EDIT mode yet, and left for mode.
+        """
         assert bpy.context.object == ob
         assert ob.type == 'ARMATURE'
-        assert ob.mode == 'EDIT'
+        assert mode != 'EDIT'
 
-        ebone_creators = []
+        with profiler.phase("widgets") as phase:
+            custom_shapes = {}
+            for metabone in self.values():
+                if isinstance(metabone.custom_shape, str) and metabone.custom_shape not in custom_shapes:
+                    custom_shapes[metabone.custom_shape] = widgetdata_get(metabone.custom_shape, custom_widget_data)
 
-        for metabone in self.values():
-            if metabone.name not in ob.data.edit_bones:
-                if metabone.create_ebone(ob):
-                    ebone_creators.append(metabone)
+            phase.objects = len(custom_shapes)
 
-        for metabone in ebone_creators:
-            ebone = ob.data.edit_bones[metabone.name]
-            if metabone.parent and metabone.parent.is_valid():
-                ebone.parent = ob.data.edit_bones[metabone.parent.name]
+        if ob.mode != 'EDIT':
+            with profiler.phase("mode switch"):
+                bpy.ops.object.mode_set(mode='EDIT')
 
-        bpy.ops.object.mode_set(mode='POSE')
+        with profiler.phase("edit bones") as phase:
+            ebone_creators = []
 
-        for metabone in ebone_creators:
-            pchan = ob.pose.bones[metabone.name]
-            metabone.apply_data_to_pchan(pchan)
+            for metabone in self.values():
+                if metabone.name not in ob.data.edit_bones:
+                    if metabone.create_ebone(ob):
+                        ebone_creators.append(metabone)
 
-        for metabone in self.values():
-            if metabone.is_valid():
+            for metabone in ebone_creators:
+                ebone = ob.data.edit_bones[metabone.name]
+                if metabone.parent and metabone.parent.is_valid():
+                    ebone.parent = ob.data.edit_bones[metabone.parent.name]
+
+            phase.objects = len(ebone_creators)
+
+        #leaving EDIT mode creates the pose channels of the new bones, pose data can be written in any other mode
+        with profiler.phase("mode switch"):
+            bpy.ops.object.mode_set(mode=mode)
+
+        with profiler.phase("pchan attributes", len(ebone_creators)):
+            for metabone in ebone_creators:
                 pchan = ob.pose.bones[metabone.name]
-                metabone.apply_data_to_pchan_constraints(pchan)
+                metabone.apply_data_to_pchan(pchan, custom_shapes)
+
+        with profiler.phase("constraints") as phase:
+            for metabone in self.values():
+                if metabone.is_valid():
+                    pchan = ob.pose.bones[metabone.name]
+                    metabone.apply_data_to_pchan_constraints(pchan)
+                    phase.objects += len(metabone.meta_blender_constraints)
+
+    def to_dict(self):
+        """json compatible copy of the metabones and their meta blender constraints, see from_dict"""
+        keys = {id(metabone): key for key, metabone in self.items()}
+
+        d = {}
+        for key, metabone in self.items():
+            d[key] = {'name': metabone.name,
+                      'attrs': {attr: plan_value_encode(getattr(metabone, attr), keys)
+                                for attr in MetaBone.all_attrs.keys()},
+                      'constraints': [meta_blender_constraint_to_dict(mbc, keys)
+                                      for mbc in metabone.meta_blender_constraints]}
+
+        return d
+
+    @classmethod
+    def from_dict(cls, d):
+        metabones = cls()
+
+        for key, mbd in d.items():
+            metabones.new_bone(key).name = mbd['name']
+
+        for key, mbd in d.items():
+            metabone = metabones[key]
+            for attr, val in mbd['attrs'].items():
+                setattr(metabone, attr, plan_value_decode(val, metabones))
+
+            for mbcd in mbd['constraints']:
+                mbc = MetaBlenderConstraint(mbcd['type'], mbcd['name'])
+                meta_blender_constraint_set_attrs(mbc, mbcd, metabones)
+                metabone.meta_blender_constraints.append(mbc)
+
+        return metabones
 
     def get_args_subset(self, local_names, suffixletter):
         arm_metabones = {}
@@ -1068,6 +1899,47 @@ class MetaBoneDict(dict):
         return arm_metabones
 
 
+def plan_value_encode(val, keys):
+    if isinstance(val, MetaBone):
+        return {'metabone': keys[id(val)]}
+    elif isinstance(val, Vector):
+        return {'vector': list(val)}
+    elif isinstance(val, (list, tuple)):
+        return [plan_value_encode(item, keys) for item in val]
+    elif isinstance(val, bpy.types.ID):
+        return {'object': val.name}
+
+    return val
+
+
+def plan_value_decode(val, metabones):
+    if isinstance(val, dict):
+        if 'metabone' in val:
+            return metabones[val['metabone']]
+        elif 'vector' in val:
+            return Vector(val['vector'])
+        elif 'object' in val:
+            #objects are looked up by name when the plan is applied
+            return val['object']
+    elif isinstance(val, list):
+        return tuple(plan_value_decode(item, metabones) for item in val)
+
+    return val
+
+
+def meta_blender_constraint_to_dict(mbc, keys):
+    return {'type': mbc.type,
+            'name': mbc.name,
+            'attrs': {attr: plan_value_encode(val, keys) for attr, val in vars(mbc).items()
+                      if attr not in {'type', 'name'}}}
+
+
+def meta_blender_constraint_set_attrs(mbc, mbcd, metabones):
+    """sets the attrs of a meta_blender_constraint_to_dict result on mbc"""
+    for attr, val in mbcd['attrs'].items():
+        setattr(mbc, attr, plan_value_decode(val, metabones))
+
+
 class MetaBonesBakeData():
     def __init__(self, metabones, transform=None, suffixletter=""):
         self.metabones = metabones
@@ -1080,17 +1952,11 @@ def translation4(vec):
 
 
 def metabones_get_phalange_segment(mbs, name, phalange_num, segment_num, suffixletter):
-    return mbs["%s%s-%s.%s" % (name, phalange_num, segment_num, suffixletter)]
+    return mbs.phalange_segment(name, phalange_num, segment_num, suffixletter)
 
 
 def metabones_get_segment_siblings(mbs, name, s, suffixletter, max_num_phalange=5):
-    segment_siblings = []
-    for p in range(1, max_num_phalange + 1):
-        segment = metabones_get_phalange_segment(mbs, name, p, s, suffixletter)
-        if segment:
-            segment_siblings.append(segment)
-
-    return segment_siblings
+    return mbs.segment_siblings(name, s, suffixletter, max_num_phalange)
 
 
 def metabones_add_hand(mbs, suffixletter, proximal_bones, use_thumb):
@@ -1127,13 +1993,56 @@ def metabones_count_num_fingers(mbs, suffix):
 
     return len(matched_finger_prefixes)
 
-def meta_create_full_body(ob, num_fingers, num_toes, foot_width, wrist_width, wrist_yaw, wrist_pitch, wrist_roll,
-                          use_thumb, finger_curl, toe_curl, finger_splay, thumb_splay, thumb_tilt, arm_yaw,
-                          arm_pitch, arm_roll, shoulder_head_vec,
-                          shoulder_tail_vec, elbow_vec, wrist_vec, spine_start_vec, spine_pitch, spine_lengths,
-                          upleg_vec, knee_vec,
-                          ankle_vec, toe_vec, head_length, head_pitch, eye_center, eye_radius, chin_vec, jaw_vec,
-                          use_simple_toe, num_tail_bones, tail_length, use_ears, use_belly, use_bepuik_tail, use_simple_hand):
+def new_meta_armature_ob(scene, **params):
+    """
+    Create a meta armature object in scene with meta_create_full_body, without depending on the context area,
+    active object or mode. The new meta armature is left selected, active and in OBJECT mode.
+
+    :arg params: the arguments of meta_full_body_metabones
+    """
+    for other_ob in scene.objects:
+        other_ob.select = False
+
+    data = bpy.data.armatures.new(name="MetaBones")
+    ob = bpy.data.objects.new(name="Meta Armature", object_data=data)
+    scene.objects.link(ob)
+    scene.objects.active = ob
+
+    meta_create_full_body(ob, **params)
+
+    ob.select = True
+    ob.show_x_ray = True
+
+    return ob
+
+
+def meta_create_full_body(ob, **params):
+    """
+    Build the metabones of meta_full_body_metabones into ob, which must be the context object. It is left in
+    OBJECT mode.
+
+    :arg params: the arguments of meta_full_body_metabones
+    """
+    combined_metabones = meta_full_body_metabones(**params)
+
+    combined_metabones.to_ob(ob, mode='OBJECT')
+
+    ob.data.layers = [True] * 32
+    ob.bepuik_autorig.is_meta_armature = True
+    ob.bepuik_autorig.use_thumb = params['use_thumb']
+    ob.bepuik_autorig.use_simple_toe = params['use_simple_toe']
+    ob.bepuik_autorig.use_bepuik_tail = params['use_bepuik_tail']
+    ob.bepuik_autorig.use_simple_hand = params['use_simple_hand']
+
+
+def meta_full_body_metabones(num_fingers, num_toes, foot_width, wrist_width, wrist_yaw, wrist_pitch, wrist_roll,
+                             use_thumb, finger_curl, toe_curl, finger_splay, thumb_splay, thumb_tilt, arm_yaw,
+                             arm_pitch, arm_roll, shoulder_head_vec,
+                             shoulder_tail_vec, elbow_vec, wrist_vec, spine_start_vec, spine_pitch, spine_lengths,
+                             upleg_vec, knee_vec,
+                             ankle_vec, toe_vec, head_length, head_pitch, eye_center, eye_radius, chin_vec, jaw_vec,
+                             use_simple_toe, num_tail_bones, tail_length, use_ears, use_belly, use_bepuik_tail,
+                             use_simple_hand):
     spine_meta = meta_init_spine(spine_lengths, use_belly, num_tail_bones, tail_length)
     spine_mat = translation4(spine_start_vec) * Matrix.Rotation(spine_pitch, 4, 'X')
 
@@ -1204,14 +2113,7 @@ def meta_create_full_body(ob, num_fingers, num_toes, foot_width, wrist_width, wr
 
             metabones_add_hand(combined_metabones, suffixletter, proximal_bones, use_thumb)
 
-    combined_metabones.to_ob(ob)
-
-    ob.data.layers = [True] * 32
-    ob.bepuik_autorig.is_meta_armature = True
-    ob.bepuik_autorig.use_thumb = use_thumb
-    ob.bepuik_autorig.use_simple_toe = use_simple_toe
-    ob.bepuik_autorig.use_bepuik_tail = use_bepuik_tail
-    ob.bepuik_autorig.use_simple_hand = use_simple_hand
+    return combined_metabones
 
 
 def meta_init_faceside(eye_center, eye_radius, use_ears, jaw_vec, head_length):
@@ -1331,7 +2233,7 @@ def meta_init_spine(spine_lengths, use_belly, num_tail_bones, tail_length):
             if parent != hips:
                 tail.use_connect = True
             else:
-                tail.inherit_rotation = False
+                tail.use_inherit_rotation = False
 
 
             parent = tail
@@ -1347,7 +2249,7 @@ def meta_init_shoulder(shoulder_tail_vec):
     shoulder.use_deform = True
     shoulder.head = Vector((0, 0, 0))
     shoulder.tail = shoulder_tail_vec.copy()
-    shoulder.use_bepuik_ball_socket_rigidity = BEPUIK_BALL_SOCKET_RIGIDITY_DEFAULT
+    shoulder.bepuik_ball_socket_rigidity = BEPUIK_BALL_SOCKET_RIGIDITY_DEFAULT
 
     return mbg
 
@@ -1391,214 +2293,1194 @@ class Finger(Phalange):
         self.is_thumb = is_thumb
 
 
-class Toe(Phalange):
-    def __init__(self, name, curl, lengths, length_scale):
-        super().__init__(name, curl, lengths, length_scale)
+class Toe(Phalange):
+    def __init__(self, name, curl, lengths, length_scale):
+        super().__init__(name, curl, lengths, length_scale)
+
+
+def meta_init_fingers(num_fingers, finger_curl, wrist_width, use_thumb, finger_splay, thumb_splay, thumb_tilt):
+    thumb_segment_lengths = [.024, .0376, .040, .0339]
+    finger_segment_lengths = [.089, .0318, .02632, .0247]
+
+    #from thumb to pinky
+    finger_scales = [.7, .9, 1, .9, .7]
+
+    fingers = []
+
+    if use_thumb:
+        segment_lengths = thumb_segment_lengths
+    else:
+        segment_lengths = finger_segment_lengths
+
+    fingers.append(Finger("finger1", finger_curl, segment_lengths, finger_scales[0], use_thumb))
+
+    for finger_index in range(1, num_fingers):
+        fingers.append(
+            Finger("finger%s" % (finger_index + 1), finger_curl, finger_segment_lengths, finger_scales[finger_index]))
+
+    fingers_bakedata = []
+
+    if num_fingers > 1:
+        wrist_point = Vector((wrist_width / 2, 0, 0))
+        wrist_delta = wrist_width / (num_fingers - 1)
+    else:
+        wrist_width = 0
+        wrist_delta = 0
+        wrist_point = Vector((0, 0, 0))
+
+    for finger in fingers:
+        metabones = finger.create_metabonedict()
+
+        if wrist_width > 0:
+            wrist_factor = wrist_point[0] / wrist_width / 2
+        else:
+            wrist_factor = wrist_point[0]
+
+        if finger.is_thumb:
+            transform = Matrix.Translation(wrist_point) * Matrix.Rotation(math.radians(90), 4, 'Y') * Matrix.Rotation(
+                thumb_splay, 4, 'X') * Matrix.Rotation(thumb_tilt, 4, 'Z')
+        else:
+            transform = Matrix.Translation(wrist_point) * Matrix.Rotation(wrist_factor * finger_splay, 4, 'Z')
+
+        fingers_bakedata.append(MetaBonesBakeData(metabones, transform))
+        wrist_point[0] -= wrist_delta
+
+    return MetaBoneDict.from_bakedata(fingers_bakedata)
+
+
+def meta_init_toes(num_toes, toe_curl, foot_width, use_simple_toe=True):
+    big_toe_lengths = [.02955, .02653]
+    little_toe_lengths = [.028, .01628, .015]
+
+    if use_simple_toe:
+        big_toe_lengths = [sum(big_toe_lengths), ]
+        little_toe_lengths = [sum(little_toe_lengths), ]
+
+    #from bigtoe to pinky toe
+    toe_scales = []
+    scale = 1
+    for i in range(num_toes):
+        toe_scales.append(scale)
+        scale *= .80
+
+    toes = [Toe("toe1", toe_curl, big_toe_lengths, toe_scales[0])]
+
+    for toe_index in range(1, num_toes):
+        toes.append(Toe("toe%s" % (toe_index + 1), toe_curl, little_toe_lengths, toe_scales[toe_index]))
+
+    toes_bakedata = []
+
+    if num_toes > 1:
+        foot_point = Vector((foot_width / 2, 0, 0))
+        foot_delta = foot_width / (num_toes - 1)
+    else:
+        foot_delta = 0
+        foot_point = Vector((0, 0, 0))
+
+    for toe in toes:
+        metabones = toe.create_metabonedict()
+
+        transform = Matrix.Translation(foot_point)
+
+        toes_bakedata.append(MetaBonesBakeData(metabones, transform))
+        foot_point[0] -= foot_delta
+
+    return MetaBoneDict.from_bakedata(toes_bakedata)
+
+
+def meta_init_leg(upleg_vec, knee_vec, ankle_vec, toe_vec, foot_width):
+    mbg = MetaBoneDict()
+
+    upleg = mbg.new_bone("upleg")
+    upleg.use_deform = True
+    upleg.head = upleg_vec.copy()
+    upleg.tail = knee_vec.copy()
+    upleg.align_roll = Vector((0, -1, 0))
+
+    loleg = mbg.new_bone("loleg")
+    loleg.head = upleg.tail.copy()
+    loleg.tail = ankle_vec.copy()
+    loleg.parent = upleg
+    loleg.align_roll = Vector((0, -1, 0))
+    loleg.use_connect = True
+
+    foot = mbg.new_bone("foot")
+    foot.head = loleg.tail.copy()
+    foot.tail = toe_vec.copy()
+    foot.parent = loleg
+    foot.bepuik_ball_socket_rigidity = 1000
+    foot.use_connect = True
+
+    heel_floor_pos = geometry.intersect_line_plane(loleg.head, loleg.tail, Vector((0, 0, 0)), Vector((0, 0, 1)))
+
+    if heel_floor_pos is None:
+        heel_floor_pos = loleg.tail + (loleg.y_axis() * (foot.length()/2))
+
+    heel_width_axis = Vector((-foot.y_axis()[1], foot.y_axis()[0], 0)).normalized()
+    offest_dir_from_center_of_heel = heel_width_axis * foot_width / 2
+
+    heel_bone = mbg.new_bone("heel")
+    heel_bone.head = heel_floor_pos - offest_dir_from_center_of_heel
+    heel_bone.tail = heel_floor_pos + offest_dir_from_center_of_heel
+
+    return mbg
+
+
+def degrees_between(a, b):
+    if type(a) == MetaBone:
+        a = a.y_axis()
+
+    if type(b) == MetaBone:
+        b = b.y_axis()
+
+    return math.degrees(a.angle(b))
+
+
+def rig_target_affected(target, affected, headtotail=0, position_rigidity=0, orientation_rigidity=0,
+                        hard_rigidity=False, use_rest_offset=False):
+    name, side_suffix = split_suffix(target.name)
+    if name.endswith(" target"):
+        name = name[:-len(" target")]
+
+    metaconstraint = affected.new_meta_blender_constraint('BEPUIK_CONTROL', target,
+                                                          "%s control%s" % (name, side_suffix))
+    metaconstraint.connection_b = target
+    metaconstraint.orientation_rigidity = orientation_rigidity
+    metaconstraint.bepuik_rigidity = position_rigidity
+    metaconstraint.use_hard_rigidity = hard_rigidity
+    metaconstraint.pulled_point = (0, headtotail, 0)
+    metaconstraint.use_rest_offset = use_rest_offset
+    target.show_wire = True
+    target.lock_scale = (True, True, True)
+
+    return metaconstraint
+
+
+def rig_twist_limit(a, b, twist):
+    """
+    create a twist limit with metabone b as the basis for everything
+
+    :param a: a target
+    :param b: b target
+    :param twist: twist amount
+    :return: twist limit meta blender constraint
+    """
+    c = a.new_meta_blender_constraint('BEPUIK_TWIST_LIMIT', b)
+    c.axis_a = b, 'Y'
+    c.axis_b = b, 'Y'
+    c.measurement_axis_a = b, 'Z'
+    c.measurement_axis_b = b, 'Z'
+    c.max_twist = twist
+
+    return c
+
+
+def rig_swing_limit(a, b, swing):
+    c = a.new_meta_blender_constraint('BEPUIK_SWING_LIMIT', b)
+    c.axis_a = b, 'Y'
+    c.axis_b = b, 'Y'
+
+    c.max_swing = swing
+
+
+def sum_vectors(vecs):
+    v_sum = Vector((0, 0, 0))
+    for v in vecs:
+        v_sum += v
+
+    return v_sum
+
+
+#detail levels of a generated rig, from fine to coarse. Coarser levels leave bones out of the solve, and keep the
+#names of the targets they share with finer levels so animation transfers between them.
+RIG_DETAIL_FULL = 'FULL'
+#toes are single segments, further toe segments follow them rigidly, and tails aren't solved
+RIG_DETAIL_MEDIUM = 'MEDIUM'
+#as medium, and hands are mittens whose fingers follow the hand rigidly
+RIG_DETAIL_LOW = 'LOW'
+RIG_DETAIL_LEVELS = (RIG_DETAIL_FULL, RIG_DETAIL_MEDIUM, RIG_DETAIL_LOW)
+
+
+def is_detail_at_least(detail_level, minimum_detail_level):
+    return RIG_DETAIL_LEVELS.index(detail_level) <= RIG_DETAIL_LEVELS.index(minimum_detail_level)
+
+
+#id properties of a generated rig, holding the RigPlan and meta armature snapshot of its last generation
+RIG_PLAN_PROP = "bepuik_autorig_plan"
+RIG_META_SNAPSHOT_PROP = "bepuik_autorig_meta_snapshot"
+RIG_ROLES_PROP = "bepuik_autorig_roles"
+
+#roles of a single bone per side, the bone is named "<role><suffix>"
+RIG_SIDE_ROLES = ("hand", "hand target", "foot", "foot target", "toes target", "foot ball target",
+                  "foot floor target", "floor")
+
+_role_toe_pattern = re.compile(r"toe[0-9]+-[0-9]+")
+_role_finger_pattern = re.compile(r"finger[0-9]+-[0-9]+")
+_role_finger_rotator_pattern = re.compile(r"finger[0-9]+-[0-9]+ rot")
+_role_palm_bone_pattern = re.compile(r"finger[0-9]+-1")
+
+
+class RigPlan():
+    """
+    Pure data description of a rig: the metabones (with their meta blender constraints), the custom widgets they
+    use, custom properties, drivers and the armature layers. A plan is decided without touching blender data and
+    can be serialized with to_dict, apply_rig_plan is the only thing that applies it to an armature.
+    """
+    def __init__(self, metabones=None):
+        if metabones is None:
+            metabones = MetaBoneDict()
+
+        self.metabones = metabones
+
+        #widget name -> WidgetData, metabone.custom_shape refers to widgets by name
+        self.widgets = {}
+
+        #(bone name, property name, value, ui settings)
+        self.custom_props = []
+
+        #(bone name, constraint name, driven attribute, driving data path)
+        self.drivers = []
+
+        self.armature_layers = [True if i in AL_START else False for i in range(32)]
+
+        #(warning level, message) pairs to report once the rig is applied
+        self.messages = []
+
+    def widget_get(self, name):
+        """returns the custom shape value for a metabone, which is resolved into an object by apply_rig_plan"""
+        return name
+
+    def new_custom_prop(self, bone_name, prop_name, value, **ui_settings):
+        self.custom_props.append((bone_name, prop_name, value, ui_settings))
+
+    def new_driver(self, bone_name, constraint_name, attr_name, data_path):
+        self.drivers.append((bone_name, constraint_name, attr_name, data_path))
+
+    def bake_widget_subsurface(self):
+        """
+        Put a WidgetData.subsurface_baked copy in the widgets of the plan for every widget with subsurface levels the
+        metabones use, also for the widgets that come from USER_WIDGET_LIBRARY or WIDGET_DATA_DEFAULTS
+        """
+        names = set(self.widgets.keys())
+        names.update(metabone.custom_shape for metabone in self.metabones.values()
+                     if isinstance(metabone.custom_shape, str))
+
+        for name in sorted(names):
+            widgetdata = widgetdata_resolve(name, self.widgets)
+            if widgetdata and widgetdata.subsurface_levels > 0:
+                self.widgets[name] = widgetdata.subsurface_baked()
+
+    def target_names(self):
+        target_names = set()
+        for metabone in self.metabones.values():
+            for mbc in metabone.meta_blender_constraints:
+                if mbc.type == 'BEPUIK_CONTROL' and hasattr(mbc, 'connection_b'):
+                    target_names.add(mbc.connection_b.name)
+
+        return target_names
+
+    def to_dict(self):
+        return {'metabones': self.metabones.to_dict(),
+                'widgets': {name: widgetdata.to_dict() for name, widgetdata in self.widgets.items()},
+                'custom_props': [list(custom_prop) for custom_prop in self.custom_props],
+                'drivers': [list(driver) for driver in self.drivers],
+                'armature_layers': list(self.armature_layers),
+                'messages': [list(message) for message in self.messages]}
+
+    @classmethod
+    def from_dict(cls, d):
+        plan = cls(MetaBoneDict.from_dict(d['metabones']))
+        plan.widgets = {name: WidgetData.from_dict(wd) for name, wd in d['widgets'].items()}
+        plan.custom_props = [tuple(custom_prop) for custom_prop in d['custom_props']]
+        plan.drivers = [tuple(driver) for driver in d['drivers']]
+        plan.armature_layers = list(d['armature_layers'])
+        plan.messages = [tuple(message) for message in d['messages']]
+        return plan
+
+
+def apply_rig_plan(plan, rig_ob, profiler=NULL_PROFILER):
+    """
+    Build the rig described by plan into the empty armature rig_ob, which must be the context object in EDIT mode.
+    Leaves rig_ob in POSE mode.
+    """
+    plan.metabones.to_ob(rig_ob, plan.widgets, profiler)
+
+    with profiler.phase("drivers", len(plan.drivers)):
+        apply_rig_plan_props(plan, rig_ob)
+
+    with profiler.phase("organize layers", len(rig_ob.pose.bones)):
+        organize_pchan_layers(rig_ob, plan.target_names())
+    rig_ob.bepuik_autorig.is_meta_armature = False
+    rig_ob.bepuik_autorig.is_auto_rig = True
+    rig_ob.use_bepuik_solve_peripheral_bones = False
+    rig_ob.data.layers = plan.armature_layers
+
+
+def apply_rig_plan_props(plan, rig_ob, driven_bone_names=None):
+    """
+    Create the custom properties of the plan that don't exist yet, and the drivers of the plan, optionally only
+    the drivers on constraints of driven_bone_names
+    """
+    for bone_name, prop_name, value, ui_settings in plan.custom_props:
+        pchan = rig_ob.pose.bones[bone_name]
+        if prop_name in pchan:
+            continue
+
+        prop = rna_idprop_ui_prop_get(pchan, prop_name, create=True)
+        for setting, setting_value in ui_settings.items():
+            prop[setting] = setting_value
+
+        pchan[prop_name] = value
+
+    for bone_name, constraint_name, attr_name, data_path in plan.drivers:
+        if driven_bone_names is not None and bone_name not in driven_bone_names:
+            continue
+
+        fcurve = rig_ob.pose.bones[bone_name].constraints[constraint_name].driver_add(attr_name)
+        if fcurve.modifiers:
+            fcurve.modifiers.remove(fcurve.modifiers[0])
+        driver = fcurve.driver
+        driver.type = 'AVERAGE'
+        v = driver.variables.new()
+        v.type = 'SINGLE_PROP'
+        v.targets[0].id = rig_ob
+        v.targets[0].data_path = data_path
+
+
+def plan_dict_drivers_by_bone_name(plan_dict):
+    """bone name -> sorted (constraint name, attr name, data path) of the drivers of a RigPlan.to_dict result"""
+    drivers = {}
+    for bone_name, constraint_name, attr_name, data_path in plan_dict['drivers']:
+        drivers.setdefault(bone_name, []).append((constraint_name, attr_name, data_path))
+
+    return {bone_name: sorted(bone_drivers) for bone_name, bone_drivers in drivers.items()}
+
+
+def plan_dict_by_bone_name(plan_dict):
+    """
+    Index the metabones of a RigPlan.to_dict result by bone name, with metabone references replaced by bone names,
+    leaving out the bones that are too short to be created.
+    """
+    metabones_dict = plan_dict['metabones']
+
+    def named(val):
+        if isinstance(val, dict) and 'metabone' in val:
+            return metabones_dict[val['metabone']]['name']
+        elif isinstance(val, list):
+            return [named(item) for item in val]
+
+        return val
+
+    entries = {}
+    for mbd in metabones_dict.values():
+        attrs = {attr: named(val) for attr, val in mbd['attrs'].items()}
+        head = Vector(attrs['head']['vector'])
+        tail = Vector(attrs['tail']['vector'])
+        if (tail - head).length <= 0.0001:
+            continue
+
+        constraints = [(mbcd['type'], mbcd['name'], {attr: named(val) for attr, val in mbcd['attrs'].items()})
+                       for mbcd in mbd['constraints']]
+        entries[mbd['name']] = (attrs, constraints)
+
+    return entries
+
+
+class RigPlanDiff():
+    """Bone names affected by going from one RigPlan.to_dict result to another"""
+    edit_attrs = set(MetaBone.ebone_attrs.keys()) | {'align_roll', 'parent'}
+    pose_attrs = set(MetaBone.pchan_attrs.keys()) | set(MetaBone.bone_attrs.keys())
+
+    def __init__(self, previous_plan_dict, plan_dict):
+        previous = plan_dict_by_bone_name(previous_plan_dict)
+        current = plan_dict_by_bone_name(plan_dict)
+
+        self.widgets_changed = {name for name, wd in plan_dict['widgets'].items()
+                                if previous_plan_dict['widgets'].get(name) != wd}
+
+        #geometry hashes of USER_WIDGET_LIBRARY, recorded by rig_full_body
+        library = plan_dict.get('widget_library', {})
+        previous_library = previous_plan_dict.get('widget_library', {})
+        self.widgets_changed.update(name for name in set(library.keys()) | set(previous_library.keys())
+                                    if library.get(name) != previous_library.get(name))
+
+        self.removed = set(previous.keys()) - set(current.keys())
+        self.added = set(current.keys()) - set(previous.keys())
+        self.edit_changed = set()
+        self.pose_changed = set()
+
+        #the drivers of a bone are recreated with its constraints
+        drivers = plan_dict_drivers_by_bone_name(plan_dict)
+        self.previous_drivers = plan_dict_drivers_by_bone_name(previous_plan_dict)
+        self.constraints_changed = {name for name in set(drivers.keys()) | set(self.previous_drivers.keys())
+                                    if name in current and name in previous and
+                                    drivers.get(name) != self.previous_drivers.get(name)}
+
+        for name, (attrs, constraints) in current.items():
+            if name not in previous:
+                continue
+
+            previous_attrs, previous_constraints = previous[name]
+            changed_attrs = {attr for attr, val in attrs.items() if previous_attrs.get(attr) != val}
+
+            if changed_attrs & RigPlanDiff.edit_attrs:
+                self.edit_changed.add(name)
+
+            custom_shape = attrs['custom_shape']
+            if changed_attrs & RigPlanDiff.pose_attrs or (isinstance(custom_shape, str) and
+                                                            custom_shape in self.widgets_changed):
+                self.pose_changed.add(name)
+
+            if constraints != previous_constraints:
+                self.constraints_changed.add(name)
+
+        self.previous_constraint_names = {name: [mbc_name for mbc_type, mbc_name, mbc_attrs in constraints]
+                                          for name, (attrs, constraints) in previous.items()}
+
+    def affected(self):
+        return self.added | self.edit_changed | self.pose_changed | self.constraints_changed
+
+    def is_empty(self):
+        return not (self.removed or self.affected() or self.widgets_changed)
+
+
+def update_rig_from_plan(plan, rig_ob, previous_plan_dict, plan_dict=None, profiler=NULL_PROFILER):
+    """
+    Bring a rig built from previous_plan_dict up to date with plan, only touching the bones that changed.
+    Like apply_rig_plan, rig_ob must be the context object in EDIT mode and is left in POSE mode.
+    The rig object itself, and with it its animation data, is kept.
+
+    :rtype: RigPlanDiff
+    """
+    if plan_dict is None:
+        plan_dict = plan.to_dict()
+
+    diff = RigPlanDiff(previous_plan_dict, plan_dict)
+    metabones = {metabone.name: metabone for metabone in plan.metabones.values() if metabone.is_valid()}
+    edit_bones = rig_ob.data.edit_bones
+
+    with profiler.phase("edit bones", len(diff.removed) + len(diff.added) + len(diff.edit_changed)):
+        for name in diff.removed:
+            if name in edit_bones:
+                edit_bones.remove(edit_bones[name])
+
+        for name in diff.added:
+            metabones[name].create_ebone(rig_ob)
+
+        for name in diff.edit_changed:
+            metabones[name].apply_data_to_ebone(edit_bones[name])
+
+        for name in diff.added | diff.edit_changed:
+            metabone = metabones[name]
+            if metabone.parent and metabone.parent.is_valid():
+                edit_bones[name].parent = edit_bones[metabone.parent.name]
+            else:
+                edit_bones[name].parent = None
+
+    with profiler.phase("mode switch"):
+        bpy.ops.object.mode_set(mode='POSE')
+
+    with profiler.phase("widgets") as phase:
+        custom_shapes = {}
+        for name in diff.added | diff.pose_changed:
+            custom_shape = metabones[name].custom_shape
+            if isinstance(custom_shape, str) and custom_shape not in custom_shapes:
+                custom_shapes[custom_shape] = widgetdata_get(custom_shape, plan.widgets)
+
+        phase.objects = len(custom_shapes)
+
+    with profiler.phase("pchan attributes", len(diff.added | diff.pose_changed)):
+        for name in diff.added | diff.pose_changed:
+            metabones[name].apply_data_to_pchan(rig_ob.pose.bones[name], custom_shapes)
+
+    with profiler.phase("constraints") as phase:
+        for name in diff.constraints_changed:
+            pchan = rig_ob.pose.bones[name]
+            for constraint_name in diff.previous_constraint_names[name]:
+                if constraint_name in pchan.constraints:
+                    constraint = pchan.constraints[constraint_name]
+
+                    #driver F-curves outlive their constraint, driver_add would return the old one
+                    for driver_constraint_name, attr_name, data_path in diff.previous_drivers.get(name, ()):
+                        if driver_constraint_name == constraint_name:
+                            constraint.driver_remove(attr_name)
+
+                    pchan.constraints.remove(constraint)
+
+        for name in diff.added | diff.constraints_changed:
+            metabones[name].apply_data_to_pchan_constraints(rig_ob.pose.bones[name])
+            phase.objects += len(metabones[name].meta_blender_constraints)
+
+    with profiler.phase("drivers"):
+        apply_rig_plan_props(plan, rig_ob, diff.added | diff.constraints_changed)
+
+    with profiler.phase("organize layers", len(diff.affected())):
+        target_names = plan.target_names()
+        for name in diff.affected():
+            organize_pchan_layer(rig_ob.pose.bones[name], is_bepuik_target=name in target_names)
+
+    return diff
+
+
+def rig_bone_group_roles(name):
+    """Roles of a bone that a side has several bones of"""
+    roles = []
+    if _role_toe_pattern.match(name):
+        roles.append("toes")
+
+    if _role_finger_pattern.match(name):
+        roles.append("fingers")
+
+    if _role_finger_rotator_pattern.match(name):
+        roles.append("finger rotators")
+    elif _role_palm_bone_pattern.match(name):
+        roles.append("palm bones")
+
+    return roles
+
+
+def rig_roles_build(bone_names, controls):
+    """
+    Role manifest of a rig, json compatible:
+
+        {'num_bones': number of bones the manifest was built from,
+         'sides': {suffix: {role: bone name, or list of bone names for the roles of rig_bone_group_roles}},
+         'controls': {owner bone name: {target bone name: BEPUIK_CONTROL constraint name}}}
+
+    :arg bone_names: all bone names of the rig
+    :arg controls: (owner bone name, constraint name, target bone name) of the BEPUIK_CONTROL constraints
+    """
+    sides = {}
+    for name in bone_names:
+        basename, suffix = split_suffix(name)
+        side = sides.setdefault(suffix, {})
+
+        if basename in RIG_SIDE_ROLES:
+            side[basename] = name
+
+        for role in rig_bone_group_roles(name):
+            side.setdefault(role, []).append(name)
+
+    controls_by_owner = {}
+    for owner_name, constraint_name, target_name in controls:
+        controls_by_owner.setdefault(owner_name, {}).setdefault(target_name, constraint_name)
+
+    return {'num_bones': len(bone_names), 'sides': sides, 'controls': controls_by_owner}
+
+
+def rig_roles_from_plan(plan):
+    metabones = [metabone for metabone in plan.metabones.values() if metabone.is_valid()]
+    controls = [(metabone.name, mbc.name, mbc.connection_b.name) for metabone in metabones
+                for mbc in metabone.meta_blender_constraints
+                if mbc.type == 'BEPUIK_CONTROL' and getattr(mbc, 'connection_b', None)]
+
+    return rig_roles_build([metabone.name for metabone in metabones], controls)
+
+
+def rig_roles_from_ob(ob):
+    controls = [(pchan.name, con.name, con.connection_subtarget) for pchan in ob.pose.bones
+                for con in pchan.constraints if con.type == 'BEPUIK_CONTROL' and con.connection_subtarget]
+
+    return rig_roles_build([pchan.name for pchan in ob.pose.bones], controls)
+
+
+def rig_roles_is_stale(ob, roles):
+    if roles.get('num_bones') != len(ob.pose.bones):
+        return True
+
+    pose_bones = ob.pose.bones
+    for side in roles['sides'].values():
+        for names in side.values():
+            if isinstance(names, str):
+                names = (names,)
+
+            if any(name not in pose_bones for name in names):
+                return True
+
+    return False
+
+
+def rig_roles_get(ob):
+    """The role manifest of ob, see rig_roles_build, rebuilt from its bones when it is missing or stale"""
+    roles = json.loads(ob[RIG_ROLES_PROP]) if RIG_ROLES_PROP in ob else None
+
+    if roles is None or rig_roles_is_stale(ob, roles):
+        roles = rig_roles_from_ob(ob)
+        ob[RIG_ROLES_PROP] = json.dumps(roles, sort_keys=True)
+
+    return roles
+
+
+#constraint rows of each BEPUik constraint type, the degrees of freedom it removes which the solver goes thru once
+#per iteration. A BEPUIK_CONTROL has 3 rows for its position and 3 for its orientation, when they have rigidity.
+BEPUIK_CONSTRAINT_ROWS = {'BEPUIK_BALL_SOCKET_JOINT': 3,
+                          'BEPUIK_ANGULAR_JOINT': 3,
+                          'BEPUIK_REVOLUTE_JOINT': 2,
+                          'BEPUIK_SWIVEL_HINGE_JOINT': 2,
+                          'BEPUIK_POINT_ON_LINE_JOINT': 2,
+                          'BEPUIK_POINT_ON_PLANE_JOINT': 1,
+                          'BEPUIK_TWIST_JOINT': 1,
+                          'BEPUIK_DISTANCE_JOINT': 1,
+                          'BEPUIK_DISTANCE_LIMIT': 1,
+                          'BEPUIK_LINEAR_AXIS_LIMIT': 1,
+                          'BEPUIK_SWING_LIMIT': 1,
+                          'BEPUIK_TWIST_LIMIT': 1}
+
+#slack in degrees before a limit counts as subsumed by another constraint
+PRUNE_EPSILON_DEGREES = .01
+
+#distance below which two points of bones count as the same joint, like the bone lengths of MetaBone.is_valid
+CONNECT_EPSILON = .0001
+
+
+def metabone_axis_get(metabone_axis):
+    """rest direction of a (metabone, 'X'/'Y'/'Z'/'NEGATIVE_X'/...) constraint axis"""
+    metabone, axis = metabone_axis
+    if axis.startswith('NEGATIVE_'):
+        return -metabone_axis_get((metabone, axis[len('NEGATIVE_'):]))
+
+    if axis == 'X':
+        return metabone.x_axis()
+    elif axis == 'Y':
+        return metabone.y_axis()
+
+    return metabone.z_axis()
+
+
+def twist_rest_degrees(twist_axis_a, twist_axis_b, measurement_axis_a, measurement_axis_b):
+    """twist a twist limit measures in the rest pose"""
+    measurement_axis_b = twist_axis_b.rotation_difference(twist_axis_a) * measurement_axis_b
+
+    a = measurement_axis_a - twist_axis_a * measurement_axis_a.dot(twist_axis_a)
+    b = measurement_axis_b - twist_axis_a * measurement_axis_b.dot(twist_axis_a)
+    return math.degrees(a.angle(b))
+
+
+def is_perpendicular(a, b):
+    return abs(math.degrees(a.angle(b)) - 90) <= PRUNE_EPSILON_DEGREES
+
+
+class PlanPruner():
+    """
+    Finds the BEPUik constraints of a RigPlan whose limits are already enforced by the other constraints between the
+    same two bones, and the constraints that never act. Angles are measured in the rest pose, axes are attached to
+    the bones so the angle between two axes of the same bone stays the same in every pose.
+    """
+    def __init__(self, plan):
+        self.plan = plan
+
+        #driven constraints change at animation time, so they never subsume, or are subsumed by, anything
+        self.driven = {(bone_name, constraint_name) for bone_name, constraint_name, attr_name, data_path in plan.drivers}
+
+    def is_fixed(self, metabone, mbc):
+        return (metabone.name, mbc.name) not in self.driven and not hasattr(mbc, 'bepuik_rigidity')
+
+    def pair_constraints(self):
+        """(bone a, bone b) -> [(metabone, mbc, is_swapped)], is_swapped when mbc is owned by b"""
+        pairs = {}
+        for metabone in self.plan.metabones.values():
+            for mbc in metabone.meta_blender_constraints:
+                if mbc.type == 'BEPUIK_CONTROL' or not mbc.type.startswith('BEPUIK_') or \
+                        not hasattr(mbc, 'connection_b') or not self.is_fixed(metabone, mbc):
+                    continue
+
+                is_swapped = mbc.connection_b.name < metabone.name
+                key = (mbc.connection_b.name, metabone.name) if is_swapped else (metabone.name, mbc.connection_b.name)
+                pairs.setdefault(key, []).append((metabone, mbc, is_swapped))
+
+        return pairs
+
+    def redundant_swing_limits(self, swing_limits, free_axes):
+        redundant = []
+        kept = []
+        for metabone, mbc, is_swapped in sorted(swing_limits, key=lambda item: item[1].max_swing):
+            u = metabone_axis_get(mbc.axis_a)
+            v = metabone_axis_get(mbc.axis_b)
+            if is_swapped:
+                u, v = v, u
+
+            if mbc.max_swing >= 180 - PRUNE_EPSILON_DEGREES:
+                redundant.append((metabone, mbc))
+                continue
+
+            #a revolute joint only rotates v around the free axis, which keeps it within alpha + beta of u
+            if any(min(alpha + beta, 360 - alpha - beta) <= mbc.max_swing + PRUNE_EPSILON_DEGREES
+                   for alpha, beta in ((math.degrees(u.angle(f)), math.degrees(v.angle(f))) for f in free_axes)):
+                redundant.append((metabone, mbc))
+                continue
+
+            #a tighter limit keeps u' within max_swing' + angle(u, u') + angle(v, v') of v
+            if any(max_swing + math.degrees(u.angle(kept_u)) + math.degrees(v.angle(kept_v)) <=
+                   mbc.max_swing + PRUNE_EPSILON_DEGREES for kept_u, kept_v, max_swing in kept):
+                redundant.append((metabone, mbc))
+                continue
+
+            kept.append((u, v, mbc.max_swing))
+
+        return redundant
+
+    def redundant_twists(self, twist_joints, twist_limits, free_axes):
+        redundant = []
+
+        #a revolute joint only rotates around its free axis, which doesn't twist axes perpendicular to it
+        def is_twist_free(axis_a, axis_b):
+            return any(is_perpendicular(axis_a, f) and is_perpendicular(axis_b, f) for f in free_axes)
+
+        joint_axes = []
+        for metabone, mbc, is_swapped in twist_joints:
+            axis_a = metabone_axis_get(mbc.axis_a)
+            axis_b = metabone_axis_get(mbc.axis_b)
+            if is_swapped:
+                axis_a, axis_b = axis_b, axis_a
+
+            if is_twist_free(axis_a, axis_b):
+                redundant.append((metabone, mbc))
+            else:
+                joint_axes.append((axis_a, axis_b))
+
+        for metabone, mbc, is_swapped in twist_limits:
+            axes = [metabone_axis_get(getattr(mbc, attr_name)) for attr_name in
+                    ('axis_a', 'axis_b', 'measurement_axis_a', 'measurement_axis_b')]
+            if mbc.max_twist >= 180 - PRUNE_EPSILON_DEGREES:
+                redundant.append((metabone, mbc))
+                continue
+
+            #the twist stays at its rest value under a twist joint on the same axes or a revolute joint
+            if twist_rest_degrees(*axes) > mbc.max_twist + PRUNE_EPSILON_DEGREES:
+                continue
+
+            axis_a, axis_b = (axes[1], axes[0]) if is_swapped else (axes[0], axes[1])
+            if is_twist_free(axis_a, axis_b) or \
+                    any(math.degrees(axis_a.angle(joint_axis_a)) <= PRUNE_EPSILON_DEGREES and
+                        math.degrees(axis_b.angle(joint_axis_b)) <= PRUNE_EPSILON_DEGREES
+                        for joint_axis_a, joint_axis_b in joint_axes):
+                redundant.append((metabone, mbc))
+
+        return redundant
+
+    def is_parent_ball_socket(self, metabone, mbc):
+        """whether a ball socket joint is at the same anchor as the ball socket BEPUik adds between a bone and its parent"""
+        anchor_metabone, head_tail = mbc.anchor
+        anchor = anchor_metabone.head.lerp(anchor_metabone.tail, head_tail)
+
+        other = mbc.connection_b
+        for child, parent in ((metabone, other), (other, metabone)):
+            if child.parent is parent and child.use_bepuik and parent.use_bepuik and \
+                    child.bepuik_ball_socket_rigidity > 0 and (anchor - child.head).length <= CONNECT_EPSILON:
+                return True
+
+        return False
+
+    def prune(self):
+        """
+        Remove the redundant constraints.
+
+        :return: number of removed constraints, number of solver rows saved
+        :rtype: tuple
+        """
+        redundant = []
+        for pair, constraints in self.pair_constraints().items():
+            by_type = {}
+            for item in constraints:
+                by_type.setdefault(item[1].type, []).append(item)
+
+            free_axes = [metabone_axis_get(mbc.free_axis) for metabone, mbc, is_swapped in
+                         by_type.get('BEPUIK_REVOLUTE_JOINT', ())]
+
+            redundant.extend(self.redundant_swing_limits(by_type.get('BEPUIK_SWING_LIMIT', ()), free_axes))
+            redundant.extend(self.redundant_twists(by_type.get('BEPUIK_TWIST_JOINT', ()),
+                                                   by_type.get('BEPUIK_TWIST_LIMIT', ()), free_axes))
+
+            redundant.extend((metabone, mbc) for metabone, mbc, is_swapped in
+                             by_type.get('BEPUIK_BALL_SOCKET_JOINT', ()) if self.is_parent_ball_socket(metabone, mbc))
+
+        num_rows = 0
+        for metabone, mbc in redundant:
+            metabone.meta_blender_constraints.remove(mbc)
+            num_rows += BEPUIK_CONSTRAINT_ROWS[mbc.type]
+
+        return len(redundant), num_rows
+
+
+def plan_prune_constraints(plan):
+    """
+    Remove the BEPUik constraints that are subsumed by other constraints between the same bones, see PlanPruner, and
+    add a message with the number of removed constraints to the plan.
+
+    :return: number of removed constraints, number of solver rows saved
+    :rtype: tuple
+    """
+    num_removed, num_rows = PlanPruner(plan).prune()
+    plan.messages.append(('INFO', "Pruned %s redundant constraints, %s fewer solver rows" % (num_removed, num_rows)))
+    return num_removed, num_rows
+
+
+def rig_find_generated(meta_armature_obj):
+    rig_name = meta_armature_obj.bepuik_autorig.rig_name
+    if rig_name and rig_name in bpy.data.objects:
+        rig_ob = bpy.data.objects[rig_name]
+        if rig_ob.type == 'ARMATURE' and rig_ob.bepuik_autorig.is_auto_rig and RIG_PLAN_PROP in rig_ob:
+            return rig_ob
+
+    return None
+
+
+def rig_full_body(meta_armature_obj, op=None, use_incremental=False, scene=None, profiler=None, use_mirror=True,
+                  use_prune=False, detail_level=RIG_DETAIL_FULL, use_baked_subsurface=False):
+    """
+    Generate a rig from meta_armature_obj, which must be in OBJECT mode. The rig is linked to scene, which defaults to
+    the context scene, and left active in POSE mode.
+
+    :arg use_prune: leave out the constraints that other constraints already enforce, see plan_prune_constraints
+    :type use_prune: bool
+
+    :arg detail_level: one of RIG_DETAIL_LEVELS, coarser rigs solve faster and keep the target names of finer ones
+    :type detail_level: str
+
+    :arg use_baked_subsurface: give widgets subdivided geometry instead of SUBSURF modifiers, which the viewport
+    evaluates on every redraw
+    :type use_baked_subsurface: bool
+
+    :arg profiler: collects the time spent in each phase of the generation
+    :type profiler: profiling.RigProfiler
+    """
+    if scene is None:
+        scene = bpy.context.scene
+
+    if profiler is None:
+        profiler = NULL_PROFILER
+
+    mbs = MetaBoneDict.from_ob(meta_armature_obj, profiler)
+    autorig = meta_armature_obj.bepuik_autorig
+    #these options and the imported widgets change the rig, so an up to date rig has to be generated with the same
+    #choices
+    snapshot = json.dumps({'metabones': mbs.to_dict(), 'use_prune': use_prune, 'detail_level': detail_level,
+                           'use_baked_subsurface': use_baked_subsurface, 'use_thumb': autorig.use_thumb,
+                           'use_simple_hand': autorig.use_simple_hand, 'use_bepuik_tail': autorig.use_bepuik_tail,
+                           'widget_library': widget_library_hashes()},
+                          sort_keys=True)
+
+    rig_ob = rig_find_generated(meta_armature_obj) if use_incremental else None
+
+    if rig_ob and rig_ob.get(RIG_META_SNAPSHOT_PROP) == snapshot:
+        if op:
+            op.report({'INFO'}, "Rig is already up to date")
+
+        return rig_ob
+
+    with profiler.phase("plan"):
+        plan = plan_full_body(mbs, use_thumb=autorig.use_thumb, use_simple_hand=autorig.use_simple_hand,
+                              use_bepuik_tail=autorig.use_bepuik_tail, use_mirror=use_mirror, use_prune=use_prune,
+                              detail_level=detail_level, use_baked_subsurface=use_baked_subsurface, profiler=profiler)
+    plan_dict = plan.to_dict()
+    plan_dict['widget_library'] = widget_library_hashes()
+
+    meta_armature_obj.select = False
+    meta_armature_obj.hide = True
+
+    if rig_ob:
+        rig_ob.hide = False
+    else:
+        rig_ob = bpy.data.objects.new('Rig', bpy.data.armatures.new("Rig Bones"))
+        scene.objects.link(rig_ob)
+        rig_ob.show_x_ray = True
+        rig_ob.data.show_bepuik_controls = True
+        rig_ob.use_bepuik_inactive_targets_follow = True
+        rig_ob.use_bepuik_dynamic = True
+
+    scene.objects.active = rig_ob
+    rig_ob.select = True
+
+    bpy.ops.object.mode_set(mode='EDIT')
+
+    if RIG_PLAN_PROP in rig_ob:
+        diff = update_rig_from_plan(plan, rig_ob, json.loads(rig_ob[RIG_PLAN_PROP]), plan_dict, profiler)
+        plan.messages.append(('INFO', "Updated %s bones, removed %s bones" % (len(diff.affected()),
+                                                                               len(diff.removed))))
+    else:
+        apply_rig_plan(plan, rig_ob, profiler)
+
+    rig_ob[RIG_PLAN_PROP] = json.dumps(plan_dict, sort_keys=True)
+    rig_ob[RIG_ROLES_PROP] = json.dumps(rig_roles_from_plan(plan), sort_keys=True)
+    rig_ob[RIG_META_SNAPSHOT_PROP] = snapshot
+    meta_armature_obj.bepuik_autorig.rig_name = rig_ob.name
 
+    found_error = False
+    found_warning = False
+    for warninglevel, msg in plan.messages:
+        if warninglevel == 'ERROR':
+            found_error = True
+        elif warninglevel == 'WARNING':
+            found_warning = True
 
-def meta_init_fingers(num_fingers, finger_curl, wrist_width, use_thumb, finger_splay, thumb_splay, thumb_tilt):
-    thumb_segment_lengths = [.024, .0376, .040, .0339]
-    finger_segment_lengths = [.089, .0318, .02632, .0247]
+        if op:
+            op.report({warninglevel}, msg)
 
-    #from thumb to pinky
-    finger_scales = [.7, .9, 1, .9, .7]
+    if op and not found_error and not found_warning:
+        op.report({'INFO'}, "Rig Completed successfully!")
 
-    fingers = []
+    return rig_ob
 
-    if use_thumb:
-        segment_lengths = thumb_segment_lengths
-    else:
-        segment_lengths = finger_segment_lengths
 
-    fingers.append(Finger("finger1", finger_curl, segment_lengths, finger_scales[0], use_thumb))
+MIRROR_EPSILON = .0001
 
-    for finger_index in range(1, num_fingers):
-        fingers.append(
-            Finger("finger%s" % (finger_index + 1), finger_curl, finger_segment_lengths, finger_scales[finger_index]))
+#local axes that point the other way on the mirrored side of the rig
+MIRROR_AXES = {'X': 'NEGATIVE_X', 'NEGATIVE_X': 'X'}
 
-    fingers_bakedata = []
+#a revolute free axis is only the line rotated around, rig_side uses the same axis on both sides
+MIRROR_UNSIGNED_AXIS_ATTRS = {'free_axis'}
 
-    if num_fingers > 1:
-        wrist_point = Vector((wrist_width / 2, 0, 0))
-        wrist_delta = wrist_width / (num_fingers - 1)
-    else:
-        wrist_width = 0
-        wrist_delta = 0
-        wrist_point = Vector((0, 0, 0))
 
-    for finger in fingers:
-        metabones = finger.create_metabonedict()
+def metabone_signature(metabone):
+    """comparable copy of the attributes of a metabone, without its constraints"""
+    signature = {}
+    for attr, val in metabone.attr_items():
+        if isinstance(val, MetaBone):
+            val = id(val)
+        elif isinstance(val, Vector):
+            val = tuple(val)
 
-        if wrist_width > 0:
-            wrist_factor = wrist_point[0] / wrist_width / 2
-        else:
-            wrist_factor = wrist_point[0]
+        signature[attr] = val
 
-        if finger.is_thumb:
-            transform = Matrix.Translation(wrist_point) * Matrix.Rotation(math.radians(90), 4, 'Y') * Matrix.Rotation(
-                thumb_splay, 4, 'X') * Matrix.Rotation(thumb_tilt, 4, 'Z')
-        else:
-            transform = Matrix.Translation(wrist_point) * Matrix.Rotation(wrist_factor * finger_splay, 4, 'Z')
+    return signature
 
-        fingers_bakedata.append(MetaBonesBakeData(metabones, transform))
-        wrist_point[0] -= wrist_delta
 
-    return MetaBoneDict.from_bakedata(fingers_bakedata)
+class MetaBonesRecord():
+    """
+    Snapshot of the metabones and widgets of a plan, to find out what was done to them since, see SideMirror
+    """
 
+    def __init__(self, mbs, widgets):
+        self.keys = list(mbs.keys())
+        self.num_constraints = {key: len(metabone.meta_blender_constraints) for key, metabone in mbs.items()}
+        self.signatures = {key: metabone_signature(metabone) for key, metabone in mbs.items()}
+        self.widget_names = set(widgets.keys())
 
-def meta_init_toes(num_toes, toe_curl, foot_width, use_simple_toe=True):
-    big_toe_lengths = [.02955, .02653]
-    little_toe_lengths = [.028, .01628, .015]
+    def added(self, mbs):
+        """keys of the metabones added since, in the order they were added"""
+        return [key for key in mbs.keys() if key not in self.signatures]
 
-    if use_simple_toe:
-        big_toe_lengths = [sum(big_toe_lengths), ]
-        little_toe_lengths = [sum(little_toe_lengths), ]
+    def removed(self, mbs):
+        return [key for key in self.keys if key not in mbs]
 
-    #from bigtoe to pinky toe
-    toe_scales = []
-    scale = 1
-    for i in range(num_toes):
-        toe_scales.append(scale)
-        scale *= .80
+    def new_constraints(self, mbs):
+        """(owner key, number on the owner, meta blender constraint) of the constraints added since"""
+        for key, metabone in mbs.items():
+            first = self.num_constraints.get(key, 0)
+            for number, mbc in enumerate(metabone.meta_blender_constraints[first:], first + 1):
+                yield key, number, mbc
 
-    toes = [Toe("toe1", toe_curl, big_toe_lengths, toe_scales[0])]
+    def added_widget_names(self, widgets):
+        return [name for name in widgets.keys() if name not in self.widget_names]
 
-    for toe_index in range(1, num_toes):
-        toes.append(Toe("toe%s" % (toe_index + 1), toe_curl, little_toe_lengths, toe_scales[toe_index]))
 
-    toes_bakedata = []
+class SideMirrorError(Exception):
+    pass
 
-    if num_toes > 1:
-        foot_point = Vector((foot_width / 2, 0, 0))
-        foot_delta = foot_width / (num_toes - 1)
-    else:
-        foot_delta = 0
-        foot_point = Vector((0, 0, 0))
 
-    for toe in toes:
-        metabones = toe.create_metabonedict()
+class SideMirror(MetaBonesRecord):
+    """
+    Records what rigging one side of a symmetric meta armature does to the metabones and widgets of a plan, so the
+    other side can be derived from it by a mirror transform and name remapping instead of being rigged again.
 
-        transform = Matrix.Translation(foot_point)
+    Mirrored bones are reflected along the x axis, which leaves their local x axis pointing the other way: vectors
+    get x negated, points in bone space get x negated and local X axes become NEGATIVE_X (and the other way round).
+    Local y and z axes, angles and distances stay the same.
+    """
 
-        toes_bakedata.append(MetaBonesBakeData(metabones, transform))
-        foot_point[0] -= foot_delta
+    def __init__(self, mbs, widgets, from_suffixletter='L', to_suffixletter='R'):
+        MetaBonesRecord.__init__(self, mbs, widgets)
+        self.from_suffixletter = from_suffixletter
+        self.to_suffixletter = to_suffixletter
+
+    def mirror_name(self, name):
+        return mirror_name(name, self.from_suffixletter, self.to_suffixletter)
+
+    def is_center(self, name):
+        return self.mirror_name(name) == name and \
+               mirror_name(name, self.to_suffixletter, self.from_suffixletter) == name
+
+    def mirrored_value(self, val, attr, metabone_get):
+        if isinstance(val, MetaBone):
+            return metabone_get(val)
+        elif isinstance(val, Vector):
+            #0 - x keeps x = 0 from turning into -0.0
+            return Vector((0 - val[0], val[1], val[2]))
+        elif isinstance(val, str):
+            return self.mirror_name(val) if attr == 'custom_shape' else val
+        elif isinstance(val, (tuple, list)):
+            if len(val) == 2 and isinstance(val[0], MetaBone):
+                #(metabone, local axis) or (metabone, head to tail fraction)
+                metabone, axis = val
+                if attr not in MIRROR_UNSIGNED_AXIS_ATTRS:
+                    axis = MIRROR_AXES.get(axis, axis)
+
+                return metabone_get(metabone), axis
+            elif len(val) == 3 and all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in val):
+                #point in bone space, e.g. pulled_point. Lock flags are bools and stay the same.
+                return type(val)((0 - val[0], val[1], val[2]))
+
+        return val
+
+    @staticmethod
+    def values_close(a, b):
+        if isinstance(a, Vector) and isinstance(b, Vector):
+            return (a - b).length < MIRROR_EPSILON
+        elif isinstance(a, (tuple, list)) and isinstance(b, (tuple, list)):
+            return len(a) == len(b) and all(SideMirror.values_close(x, y) for x, y in zip(a, b))
+        elif isinstance(a, float) or isinstance(b, float):
+            return isinstance(b, (int, float)) and abs(a - b) < MIRROR_EPSILON
+
+        return a is b if isinstance(a, MetaBone) else a == b
+
+    def is_symmetric(self, mbs):
+        """
+        Whether the to side of mbs is the mirror image of the from side and the center bones lie on the mirror plane,
+        only then the to side can be derived by mirror.
+        """
+        keys = {id(metabone): key for key, metabone in mbs.items()}
 
-    return MetaBoneDict.from_bakedata(toes_bakedata)
+        def metabone_get(metabone):
+            return mbs[self.mirror_name(keys[id(metabone)])] if id(metabone) in keys else None
 
+        for key, metabone in mbs.items():
+            if self.is_center(key):
+                if abs(metabone.head[0]) > MIRROR_EPSILON or abs(metabone.tail[0]) > MIRROR_EPSILON:
+                    return False
 
-def meta_init_leg(upleg_vec, knee_vec, ankle_vec, toe_vec, foot_width):
-    mbg = MetaBoneDict()
+                if metabone.length() > MIRROR_EPSILON and abs(metabone.z_axis()[0]) > MIRROR_EPSILON:
+                    return False
 
-    upleg = mbg.new_bone("upleg")
-    upleg.use_deform = True
-    upleg.head = upleg_vec.copy()
-    upleg.tail = knee_vec.copy()
-    upleg.align_roll = Vector((0, -1, 0))
+                continue
 
-    loleg = mbg.new_bone("loleg")
-    loleg.head = upleg.tail.copy()
-    loleg.tail = ankle_vec.copy()
-    loleg.parent = upleg
-    loleg.align_roll = Vector((0, -1, 0))
-    loleg.use_connect = True
+            mirror_key = self.mirror_name(key)
+            if mirror_key == key:
+                #a bone of the to side, it is checked from its counterpart
+                if not mbs[mirror_name(key, self.to_suffixletter, self.from_suffixletter)]:
+                    return False
 
-    foot = mbg.new_bone("foot")
-    foot.head = loleg.tail.copy()
-    foot.tail = toe_vec.copy()
-    foot.parent = loleg
-    foot.bepuik_ball_socket_rigidity = 1000
-    foot.use_connect = True
+                continue
 
-    heel_floor_pos = geometry.intersect_line_plane(loleg.head, loleg.tail, Vector((0, 0, 0)), Vector((0, 0, 1)))
+            other = mbs[mirror_key]
+            if not other or len(other.meta_blender_constraints) != len(metabone.meta_blender_constraints):
+                return False
 
-    if heel_floor_pos is None:
-        heel_floor_pos = loleg.tail + (loleg.y_axis() * (foot.length()/2))
+            for attr in MetaBone.all_attrs.keys():
+                mirrored = self.mirrored_value(getattr(metabone, attr), attr, metabone_get)
+                if not self.values_close(mirrored, getattr(other, attr)):
+                    return False
 
-    heel_width_axis = Vector((-foot.y_axis()[1], foot.y_axis()[0], 0)).normalized()
-    offest_dir_from_center_of_heel = heel_width_axis * foot_width / 2
+        return True
 
-    heel_bone = mbg.new_bone("heel")
-    heel_bone.head = heel_floor_pos - offest_dir_from_center_of_heel
-    heel_bone.tail = heel_floor_pos + offest_dir_from_center_of_heel
+    def apply(self, mbs, widgets):
+        """
+        Derive the to side from what was done to the from side since this SideMirror was created.
 
-    return mbg
+        :return: False without changing mbs or widgets when the changes can't be mirrored, e.g. because they
+        changed the center bones. The to side then needs to be rigged on its own.
+        :rtype: bool
+        """
+        try:
+            operations = self.plan_operations(mbs, widgets)
+        except SideMirrorError:
+            return False
 
+        for operation in operations:
+            operation()
 
-def degrees_between(a, b):
-    if type(a) == MetaBone:
-        a = a.y_axis()
+        return True
 
-    if type(b) == MetaBone:
-        b = b.y_axis()
+    def plan_operations(self, mbs, widgets):
+        added = self.added(mbs)
+        removed = set(self.removed(mbs))
+        added_widget_names = self.added_widget_names(widgets)
 
-    return math.degrees(a.angle(b))
+        #everything but the from side has to stay the same for the changes to be mirrored
+        for key in self.keys:
+            if self.mirror_name(key) != key:
+                continue
 
+            if key in removed or metabone_signature(mbs[key]) != self.signatures[key]:
+                raise SideMirrorError("%s changed" % key)
 
-def rig_target_affected(target, affected, headtotail=0, position_rigidity=0, orientation_rigidity=0,
-                        hard_rigidity=False, use_rest_offset=False):
-    name, side_suffix = split_suffix(target.name)
-    if name.endswith(" target"):
-        name = name[:-len(" target")]
+            if not self.is_center(key) and len(mbs[key].meta_blender_constraints) != self.num_constraints[key]:
+                raise SideMirrorError("%s got constraints" % key)
 
-    metaconstraint = affected.new_meta_blender_constraint('BEPUIK_CONTROL', target,
-                                                          "%s control%s" % (name, side_suffix))
-    metaconstraint.connection_b = target
-    metaconstraint.orientation_rigidity = orientation_rigidity
-    metaconstraint.bepuik_rigidity = position_rigidity
-    metaconstraint.use_hard_rigidity = hard_rigidity
-    metaconstraint.pulled_point = (0, headtotail, 0)
-    metaconstraint.use_rest_offset = use_rest_offset
-    target.show_wire = True
-    target.lock_scale = (True, True, True)
+        for key in added + list(removed):
+            if self.mirror_name(key) == key:
+                raise SideMirrorError("can't mirror %s" % key)
 
-    return metaconstraint
+            if (self.mirror_name(key) in mbs) != (key in removed):
+                raise SideMirrorError("can't mirror %s" % key)
 
+        for name in added_widget_names:
+            if self.mirror_name(name) == name or self.mirror_name(name) in widgets:
+                raise SideMirrorError("can't mirror widget %s" % name)
 
-def rig_twist_limit(a, b, twist):
-    """
-    create a twist limit with metabone b as the basis for everything
+        keys = {id(metabone): key for key, metabone in mbs.items()}
+        new_metabones = {self.mirror_name(key): MetaBone(self.mirror_name(key)) for key in added}
+        removed_mirror_keys = {self.mirror_name(key) for key in removed}
 
-    :param a: a target
-    :param b: b target
-    :param twist: twist amount
-    :return: twist limit meta blender constraint
-    """
-    c = a.new_meta_blender_constraint('BEPUIK_TWIST_LIMIT', b)
-    c.axis_a = b, 'Y'
-    c.axis_b = b, 'Y'
-    c.measurement_axis_a = b, 'Z'
-    c.measurement_axis_b = b, 'Z'
-    c.max_twist = twist
+        def metabone_get(metabone):
+            mirror_key = self.mirror_name(keys.get(id(metabone), ""))
+            mirrored = new_metabones.get(mirror_key) or mbs[mirror_key]
+            if not mirrored or mirror_key in removed_mirror_keys:
+                raise SideMirrorError("can't mirror reference to %s" % metabone.name)
 
-    return c
+            return mirrored
 
+        operations = [lambda key=key: mbs.pop(key) for key in removed_mirror_keys]
+        operations.extend(lambda key=key: mbs.__setitem__(key, new_metabones[key]) for key in new_metabones.keys())
 
-def rig_swing_limit(a, b, swing):
-    c = a.new_meta_blender_constraint('BEPUIK_SWING_LIMIT', b)
-    c.axis_a = b, 'Y'
-    c.axis_b = b, 'Y'
+        for key, metabone in mbs.items():
+            if self.mirror_name(key) != key:
+                attrs = {attr: self.mirrored_value(val, attr, metabone_get) for attr, val in metabone.attr_items()}
+                attrs['name'] = self.mirror_name(metabone.name)
+                operations.append(lambda owner=metabone_get(metabone), attrs=attrs: metabone_set_attrs(owner, attrs))
 
-    c.max_swing = swing
+        for key, number, mbc in self.new_constraints(mbs):
+            owner = mbs[key] if self.is_center(key) else metabone_get(mbs[key])
+            operations.append(self.constraint_operation(mbc, number, owner, metabone_get))
 
+        for name in added_widget_names:
+            operations.append(lambda name=name: widgets.__setitem__(self.mirror_name(name), widgets[name].mirrored()))
 
-def sum_vectors(vecs):
-    v_sum = Vector((0, 0, 0))
-    for v in vecs:
-        v_sum += v
+        return operations
 
-    return v_sum
+    def constraint_operation(self, mbc, number, owner, metabone_get):
+        attrs = {attr: self.mirrored_value(val, attr, metabone_get) for attr, val in vars(mbc).items()
+                 if attr not in ('type', 'name')}
 
+        #constraints numbered by new_meta_blender_constraint are numbered again on their new owner
+        is_numbered = mbc.name == meta_blender_constraint_numbered_name(mbc.type, number)
+        name = None if is_numbered else self.mirror_name(mbc.name)
 
-def rig_full_body(meta_armature_obj, op=None):
-    custom_widget_data = {}
+        def operation():
+            vars(owner.new_meta_blender_constraint(mbc.type, name=name)).update(attrs)
 
-    printmsgs = []
+        return operation
 
-    def widget_get(name):
-        return widgetdata_get(name, custom_widget_data)
 
-    bpy.ops.object.mode_set(mode='POSE')
-    mbs = MetaBoneDict.from_ob(meta_armature_obj)
+def plan_full_body(mbs, use_thumb=False, use_simple_hand=False, use_bepuik_tail=False, use_mirror=True,
+                   use_prune=False, detail_level=RIG_DETAIL_FULL, use_baked_subsurface=False, profiler=NULL_PROFILER):
+    """
+    Decide the full body rig for the metabones of a meta armature, see meta_create_full_body.
+
+    :arg mbs: metabones of the meta armature, they are modified and become part of the returned plan
+    :type mbs: MetaBoneDict
+    :arg use_mirror: derive the right side from the left side with a SideMirror when the meta armature is symmetric
+    :type use_mirror: bool
+    :arg use_prune: remove the constraints that other constraints already enforce, see plan_prune_constraints
+    :type use_prune: bool
+    :arg detail_level: one of RIG_DETAIL_LEVELS
+    :type detail_level: str
+    :arg use_baked_subsurface: subdivide widget geometry in the plan instead of with SUBSURF modifiers on their objects
+    :type use_baked_subsurface: bool
+    :rtype: RigPlan
+    """
+    plan = RigPlan(mbs)
+    custom_widget_data = plan.widgets
+    widget_get = plan.widget_get
 
     eyel = mbs["eye.L"]
     eyer = mbs["eye.R"]
@@ -1615,15 +3497,6 @@ def rig_full_body(meta_armature_obj, op=None):
     shoulderl = mbs["shoulder.L"]
     shoulderr = mbs["shoulder.R"]
 
-    bpy.ops.object.mode_set(mode='OBJECT')
-    meta_armature_obj.select = False
-    meta_armature_obj.hide = True
-
-    rig_ob = bpy.data.objects.new('Rig', bpy.data.armatures.new("Rig Bones"))
-    bpy.context.scene.objects.link(rig_ob)
-    bpy.context.scene.objects.active = rig_ob
-    rig_ob.select = True
-
     root = mbs.new_bone("root")
     root.head = Vector((0, 0, 0))
     root.tail = Vector((0, 1, 0))
@@ -1708,7 +3581,7 @@ def rig_full_body(meta_armature_obj, op=None):
             tail_bones.append(mbs[name])
 
     if len(tail_bones) > 0:
-        if meta_armature_obj.bepuik_autorig.use_bepuik_tail:
+        if use_bepuik_tail and is_detail_at_least(detail_level, RIG_DETAIL_FULL):
             prev_tail_bone = None
             for t in range(len(tail_bones)):
                 flag_bone_deforming_ballsocket_bepuik(tail_bones[t])
@@ -1764,7 +3637,7 @@ def rig_full_body(meta_armature_obj, op=None):
         width_local = width_world / target.length()
 
         wd = custom_widget_data["widget %s" % target.name] = widgetdata_circle(width_local/2)
-        wd.edges.append((12, 28))
+        wd.add_edges([(12, 28)])
 
         target.custom_shape = widget_get("widget %s" % target.name)
         #end create hips circle widget
@@ -1781,370 +3654,368 @@ def rig_full_body(meta_armature_obj, op=None):
         width = .3
     replace_target_widget_with_circle_widget(width, chest_target)
 
-    hips_down_mat = hips.matrix() * Matrix.Rotation(math.pi, 4, 'Z')
-    hips_forward_mat = hips_down_mat * Matrix.Rotation(math.pi / 2, 4, 'X')
-
-    up = Vector((0, 0, 1))
-    forward = Vector((0, -1, 0))
+    side_mirror = SideMirror(mbs, custom_widget_data) if use_mirror else None
+    if side_mirror and not side_mirror.is_symmetric(mbs):
+        plan.messages.append(('INFO', "Meta armature is not symmetric, rigging both sides"))
+        side_mirror = None
 
-    def rig_side(suffixletter):
-        if suffixletter == "L":
-            relative_x_axis = 'X'
-            leg_relative_x_axis = 'NEGATIVE_X'
-            measurement_axis_mat = hips_forward_mat * Matrix.Rotation(math.pi / 5, 4, 'Z')
-        else:
-            relative_x_axis = 'NEGATIVE_X'
-            leg_relative_x_axis = 'X'
-            measurement_axis_mat = hips_forward_mat * Matrix.Rotation(-math.pi / 5, 4, 'Z')
+    for suffixletter in ("L", "R"):
+        num_bones = len(mbs)
+        with profiler.phase("rig_side %s" % suffixletter) as phase:
+            if suffixletter == "L" or not side_mirror or not side_mirror.apply(mbs, custom_widget_data):
+                plan_side(plan, suffixletter, use_thumb, use_simple_hand, detail_level)
 
-        loleg = mbs["loleg.%s" % suffixletter]
-        upleg = mbs["upleg.%s" % suffixletter]
-        foot = mbs["foot.%s" % suffixletter]
-        eye = mbs["eye.%s" % suffixletter]
-        ear = mbs["ear.%s" % suffixletter]
-        shoulder = mbs["shoulder.%s" % suffixletter]
-        uparm = mbs["uparm.%s" % suffixletter]
-        loarm = mbs["loarm.%s" % suffixletter]
-        heel_bone = mbs["heel.%s" % suffixletter]
+            phase.objects = len(mbs) - num_bones
 
-        def get_phalange_segment(name, p, s):
-            return mbs["%s%s-%s.%s" % (name, p, s, suffixletter)]
+    plan.new_custom_prop("spine", "torso stiffness", 2.0, min=0.0, soft_min=0.0, soft_max=2.0)
 
-        def create_phalange_swingcenter(name, p, s):
-            return mbs.new_bone("MCH-%s%s %s swingcenter.%s" % (name, p, s, suffixletter))
+    torso_stiffness_data_path = r'pose.bones["spine"]["torso stiffness"]'
+    plan.new_driver(hips.name, spine_stiff_angular_joint.name, "bepuik_rigidity", torso_stiffness_data_path)
+    plan.new_driver(spine.name, chest_stiff_angular_joint.name, "bepuik_rigidity", torso_stiffness_data_path)
 
-        def get_final_segments(name):
-            final_segments = []
-            for p in range(1, 6):
-                for s in [3, 2, 1]:
-                    segment = get_phalange_segment(name, p, s)
-                    if segment:
-                        final_segments.append(segment)
-                        break
+    if use_prune:
+        with profiler.phase("prune"):
+            plan_prune_constraints(plan)
 
-            return final_segments
+    if use_baked_subsurface:
+        plan.bake_widget_subsurface()
 
-        def rig_hand():
-            def get_finger_segment(f, s):
-                return get_phalange_segment("finger", f, s)
+    return plan
 
-            def create_finger_swingcenter(f, s):
-                return create_phalange_swingcenter("finger", f, s)
 
-            proximal_bones = metabones_get_segment_siblings(mbs, "finger", 2, suffixletter)
+def plan_side(plan, suffixletter, use_thumb=False, use_simple_hand=False, detail_level=RIG_DETAIL_FULL):
+    """
+    Decide the arm, hand, leg and foot of one side of the full body rig, once plan_full_body has decided the center
+    bones (root, spine and head) of plan.
 
-            hand = mbs["hand.%s" % suffixletter]
-            if not hand:
-                hand = metabones_add_hand(mbs, suffixletter, proximal_bones, meta_armature_obj.bepuik_autorig.use_thumb)
+    :arg suffixletter: 'L' or 'R'
+    :type suffixletter: str
+    :arg detail_level: one of RIG_DETAIL_LEVELS
+    :type detail_level: str
+    """
+    mbs = plan.metabones
+    custom_widget_data = plan.widgets
+    widget_get = plan.widget_get
 
-            hand.use_bepuik = True
-            hand.bepuik_ball_socket_rigidity = BEPUIK_BALL_SOCKET_RIGIDITY_DEFAULT
+    root = mbs["root"]
+    hips = mbs["hips"]
+    chest = mbs["chest"]
+    head = mbs["head"]
+    eye_target = mbs["eye target"]
 
-            if meta_armature_obj.bepuik_autorig.use_simple_hand:
-                hand.use_deform = True
+    hips_down_mat = hips.matrix() * Matrix.Rotation(math.pi, 4, 'Z')
+    hips_forward_mat = hips_down_mat * Matrix.Rotation(math.pi / 2, 4, 'X')
 
-            hand_width_world = max((proximal_bones[0].head - proximal_bones[len(proximal_bones) - 1].head).length, hand.length())
+    up = Vector((0, 0, 1))
 
-            hand_width_local = hand_width_world / hand.length()
+    if suffixletter == "L":
+        relative_x_axis = 'X'
+        leg_relative_x_axis = 'NEGATIVE_X'
+        measurement_axis_mat = hips_forward_mat * Matrix.Rotation(math.pi / 5, 4, 'Z')
+    else:
+        relative_x_axis = 'NEGATIVE_X'
+        leg_relative_x_axis = 'X'
+        measurement_axis_mat = hips_forward_mat * Matrix.Rotation(-math.pi / 5, 4, 'Z')
+
+    loleg = mbs["loleg.%s" % suffixletter]
+    upleg = mbs["upleg.%s" % suffixletter]
+    foot = mbs["foot.%s" % suffixletter]
+    eye = mbs["eye.%s" % suffixletter]
+    ear = mbs["ear.%s" % suffixletter]
+    shoulder = mbs["shoulder.%s" % suffixletter]
+    uparm = mbs["uparm.%s" % suffixletter]
+    loarm = mbs["loarm.%s" % suffixletter]
+    heel_bone = mbs["heel.%s" % suffixletter]
 
-            hand_custom_shape_name = "%s.%s" % (WIDGET_HAND, suffixletter)
+    def get_phalange_segment(name, p, s):
+        return mbs.phalange_segment(name, p, s, suffixletter)
 
-            custom_widget_data[hand_custom_shape_name] = widgetdata_pad(width=hand_width_local * .75, length=.75, mid=0)
-            custom_widget_data[hand_custom_shape_name].subsurface_levels = 1
+    def create_phalange_swingcenter(name, p, s):
+        return mbs.new_bone("MCH-%s%s %s swingcenter.%s" % (name, p, s, suffixletter))
 
-            hand_target_custom_shape_name = "%s target.%s" % (WIDGET_HAND, suffixletter)
-            custom_widget_data[hand_target_custom_shape_name] = widgetdata_pad(width=hand_width_local * 1.4,
-                                                                               length=1.0 * 1.2, mid=.1)
+    def get_final_segments(name):
+        return mbs.final_segments(name, suffixletter, max_segment=3, max_phalange=5)
 
-            hand.custom_shape = widget_get(hand_custom_shape_name)
-            hand.show_wire = True
+    def rig_hand():
+        def get_finger_segment(f, s):
+            return get_phalange_segment("finger", f, s)
 
-            hand_target = mbs.new_bone("hand target.%s" % suffixletter)
-            hand_target.parent = root
-            hand_target.head = hand.head.copy()
-            hand_target.tail = hand.tail.copy()
-            hand_target.custom_shape = widget_get(hand_target_custom_shape_name)
-            hand_target.show_wire = True
-            hand_target.align_roll = hand.align_roll.copy()
+        def create_finger_swingcenter(f, s):
+            return create_phalange_swingcenter("finger", f, s)
 
-            rig_target_affected(hand_target, hand, position_rigidity=1, orientation_rigidity=1)
+        proximal_bones = metabones_get_segment_siblings(mbs, "finger", 2, suffixletter)
 
-            s1_swings = [0, 0, 0, 20, 20]
+        hand = mbs["hand.%s" % suffixletter]
+        if not hand:
+            hand = metabones_add_hand(mbs, suffixletter, proximal_bones, use_thumb)
 
-            for f in range(1, 6):
-                s1 = get_finger_segment(f, 1)
-                s2 = get_finger_segment(f, 2)
-                s3 = get_finger_segment(f, 3)
-                s4 = get_finger_segment(f, 4)
+        hand.use_bepuik = True
+        hand.bepuik_ball_socket_rigidity = BEPUIK_BALL_SOCKET_RIGIDITY_DEFAULT
 
-                if s1: #valid for s1 to not exist if using simple hand
-                    s1.swing = s1_swings[f - 1]
+        if use_simple_hand:
+            hand.use_deform = True
 
-                if not all((s2, s3, s4)):
-                    continue
+        hand_width_world = max((proximal_bones[0].head - proximal_bones[len(proximal_bones) - 1].head).length, hand.length())
 
-                s3.swing_center = create_finger_swingcenter(f, 3)
+        hand_width_local = hand_width_world / hand.length()
 
-                s4.swing_center = create_finger_swingcenter(f, 4)
+        hand_custom_shape_name = "%s.%s" % (WIDGET_HAND, suffixletter)
 
-                if f == 1 and meta_armature_obj.bepuik_autorig.use_thumb:
-                    s2.swing_y = 30
+        custom_widget_data[hand_custom_shape_name] = widgetdata_pad(width=hand_width_local * .75, length=.75, mid=0)
+        custom_widget_data[hand_custom_shape_name].subsurface_levels = 1
 
-                    s3.swing_angle_max = 20
-                    s3.swing_angle_min = -85
+        hand_target_custom_shape_name = "%s target.%s" % (WIDGET_HAND, suffixletter)
+        custom_widget_data[hand_target_custom_shape_name] = widgetdata_pad(width=hand_width_local * 1.4,
+                                                                           length=1.0 * 1.2, mid=.1)
 
-                    s4.swing_angle_max = 80
-                    s4.swing_angle_min = -60
-                else:
-                    s2.swing_x = 30
-                    s2.swing_y = 90
+        hand.custom_shape = widget_get(hand_custom_shape_name)
+        hand.show_wire = True
 
-                    s3.swing_angle_max = 0
-                    s3.swing_angle_min = -135
+        hand_target = mbs.new_bone("hand target.%s" % suffixletter)
+        hand_target.parent = root
+        hand_target.head = hand.head.copy()
+        hand_target.tail = hand.tail.copy()
+        hand_target.custom_shape = widget_get(hand_target_custom_shape_name)
+        hand_target.show_wire = True
+        hand_target.align_roll = hand.align_roll.copy()
 
-                    s4.swing_angle_max = 45
-                    s4.swing_angle_min = -95
+        rig_target_affected(hand_target, hand, position_rigidity=1, orientation_rigidity=1)
 
-                if meta_armature_obj.bepuik_autorig.use_simple_hand:
-                    rig_simple_finger(hand, s2, s3, s4)
+        s1_swings = [0, 0, 0, 20, 20]
 
-                else:
-                    rig_finger(hand, s1, s2, s3, s4)
-
-                    if s1.swing:
-                        rot_target = rig_new_target(mbs, "%s rot.%s" % (split_suffix(s1.name)[0], suffixletter),
-                                                    controlledmetabone=s1,
-                                                    parent=hand_target, lock_location=(True, True, True), lock_rotation= (False, True, True),
-                                                    rotation_mode='XYZ')
-
-                        #limiting the location negates the "Inactive Targets Follow" effect, which doesn't make sense for
-                        #this target
-                        mbc = rot_target.new_meta_blender_constraint('LIMIT_LOCATION')
-                        mbc.use_min_x = True
-                        mbc.use_max_x = True
-                        mbc.use_min_y = True
-                        mbc.use_max_y = True
-                        mbc.use_min_z = True
-                        mbc.use_max_z = True
-                        mbc.owner_space = 'LOCAL'
-                        mbc.use_transform_limit = True
-
-        def rig_foot():
-            def get_toe_segment(f, s):
-                return get_phalange_segment("toe", f, s)
-
-            def create_toe_swingcenter(f, s):
-                return create_phalange_swingcenter("toe", f, s)
-
-            s1_bones = metabones_get_segment_siblings(mbs, "toe", 1, suffixletter)
-
-            if len(s1_bones) > 1:
-                foot_width_world = (s1_bones[0].head - s1_bones[len(s1_bones) - 1].head).length
-            elif heel_bone:
-                foot_width_world = heel_bone.length()
-            else:
-                foot_width_world = foot.length() / 2
-
-            multitarget_segments = s1_bones
-            final_segments = get_final_segments("toe")
-            final_segments_tail_average = sum_vectors([metabone.tail for metabone in final_segments]) / len(
-                final_segments)
-
-            #            heel = mbs.new_bone("MCH-heel.%s" % suffixletter)
-            #            heel.head = foot.head.copy()
-            #            heel.tail = foot_target.head.copy()
-            #            flag_bone_mechanical(heel)
-            #            heel.align_roll = Vector((0,-1,0))
-            #            heel.parent = foot
-
-            foot_target = mbs.new_bone("foot target.%s" % suffixletter)
-            foot_target.head = heel_bone.center()
-            foot_target.tail = Vector((foot.tail[0], foot.tail[1], 0))
-            foot_target_custom_shape_name = "%s target.%s" % (WIDGET_FOOT, suffixletter)
-            custom_widget_data[foot_target_custom_shape_name] = widgetdata_pad(
-                width=foot_width_world / foot_target.length(), length=1.0, mid=.3)
-            foot_target.show_wire = True
-            foot_target.custom_shape = widget_get(foot_target_custom_shape_name)
-            foot_target.parent = root
-
-            rig_target_affected(foot_target, foot, hard_rigidity=True, use_rest_offset=True)
-
-            #the heel bone is only needed as a reference, after it's used
-            #delete it because the final rig doesn't need it.
-            if heel_bone:
-                mbs.pop(heel_bone.name)
-
-            toes_target = mbs.new_bone("toes target.%s" % suffixletter)
-            toes_target.head = foot_target.tail.copy()
-            toes_target.tail = final_segments_tail_average.copy()
-            toes_target.tail = toes_target.head + (foot_target.y_axis() * toes_target.length())
-            toes_target.parent = root
-            toes_target.align_roll = sum_vectors([s1.align_roll for s1 in s1_bones]) / len(s1_bones)
-
-            toes_width_local = foot_width_world / toes_target.length()
-
-            toes_target_custom_shape_name = "%s target.%s" % (WIDGET_TOES, suffixletter)
-            custom_widget_data[toes_target_custom_shape_name] = widgetdata_pad(width=toes_width_local * 1.2, length=1.2,
-                                                                               mid=.1)
-            toes_target.show_wire = True
-            toes_target.custom_shape = widget_get(toes_target_custom_shape_name)
-
-            #            floor = mbs.new_bone("floor.%s" % suffixletter)
-            #            floor.head = foot_target.head.copy()
-            #            floor.tail = foot_target.tail.copy()
-            #            floor.parent = root
-            #            floor.custom_shape = widget_get(WIDGET_FLOOR)#"%s.%s" % (WIDGET_FLOOR,suffixletter))
-            #            floor.use_bepuik = True
-            #
-            #            floor_target = mbs.new_bone("foot floor target.%s" % suffixletter)
-            #            floor_target.head = foot_target.head.copy()
-            #            floor_target.tail = foot_target.tail.copy()
-            #            floor_target.parent = root
-            #            floor_target.custom_shape = widget_get(WIDGET_FLOOR)#"%s.%s" % (WIDGET_FLOOR_TARGET,suffixletter))
-            #            floor_target.show_wire = True
-
-            #            c = rig_target_affected(floor_target, floor)
-
-            #            #floor affect ball of the foot
-            #            c = floor.new_meta_blender_constraint('BEPUIK_LINEAR_AXIS_LIMIT',foot)
-            #            c.line_anchor = floor, 0
-            #            c.line_direction = floor, 'Z'
-            #            c.anchor_b = foot, 1
-            #            c.max_distance = 999999
-            #
-            #            #floor affect heel of the foot
-            #            c = floor.new_meta_blender_constraint('BEPUIK_LINEAR_AXIS_LIMIT',foot)
-            #            c.line_anchor = floor, 0
-            #            c.line_direction = floor, 'Z'
-            #            c.anchor_b = heel, 1
-            #            c.max_distance = 999999
-            #
-            #            def tail_affected_by_floor(segment):
-            #                c = floor.new_meta_blender_constraint('BEPUIK_LINEAR_AXIS_LIMIT',segment)
-            #                c.line_anchor = floor, 0
-            #                c.line_direction = floor, 'Z'
-            #                c.anchor_b = segment, 1
-            #                c.max_distance = 999999
-
-            for f in range(1, 6):
-                s1 = get_toe_segment(f, 1)
-                s2 = get_toe_segment(f, 2)
-                s3 = get_toe_segment(f, 3)
-
-                if not s1:
-                    continue
+        for f in mbs.phalange_numbers("finger", suffixletter, max_phalange=5):
+            s1 = get_finger_segment(f, 1)
+            s2 = get_finger_segment(f, 2)
+            s3 = get_finger_segment(f, 3)
+            s4 = get_finger_segment(f, 4)
 
-                #                tail_affected_by_floor(s1)
+            if not is_detail_at_least(detail_level, RIG_DETAIL_MEDIUM):
+                rig_rigid_chain(hand, (s1, s2, s3, s4))
+                continue
 
-                s1.swing_x = 20
-                s1.swing_y = 90
+            if s1: #valid for s1 to not exist if using simple hand
+                s1.swing = s1_swings[f - 1]
 
-                if s2:
-                    s2.swing_center = create_toe_swingcenter(f, 2)
-                    s2.swing_angle_max = 0
-                    s2.swing_angle_min = -90
+            if not all((s2, s3, s4)):
+                continue
 
-                #                    tail_affected_by_floor(s2)
+            s3.swing_center = create_finger_swingcenter(f, 3)
 
-                if s3:
-                    s3.swing_center = create_toe_swingcenter(f, 3)
-                    s3.swing_angle_max = 70
-                    s3.swing_angle_min = -20
+            s4.swing_center = create_finger_swingcenter(f, 4)
 
-                #                    tail_affected_by_floor(s3)
+            if f == 1 and use_thumb:
+                s2.swing_y = 30
 
-                rig_twist_joint(foot, s1)
-                rig_ballsocket_joint(foot, s1)
-                rig_bone_to_bone_with_2d_swing_info(foot, s1, axis_a_override=s1)
-                rig_toe(s1, s2, s3)
-                s1.parent = foot
+                s3.swing_angle_max = 20
+                s3.swing_angle_min = -85
 
-            for multitarget_segment in multitarget_segments:
-                rig_target_affected(toes_target, multitarget_segment, use_rest_offset=True)
+                s4.swing_angle_max = 80
+                s4.swing_angle_min = -60
+            else:
+                s2.swing_x = 30
+                s2.swing_y = 90
 
-            rig_new_target(mbs, "foot ball target.%s" % suffixletter, foot, root, headtotail=1.0, use_rest_offset=True)
+                s3.swing_angle_max = 0
+                s3.swing_angle_min = -135
 
-        if eye:
-            eye.new_meta_blender_constraint('DAMPED_TRACK', eye_target)
-            eye.use_deform = True
-            eye.parent = head
+                s4.swing_angle_max = 45
+                s4.swing_angle_min = -95
 
-        if ear:
-            ear.parent = head
+            if use_simple_hand:
+                rig_simple_finger(hand, s2, s3, s4)
 
-        rig_arm(shoulder, uparm, loarm, relative_x_axis, up)
-        rig_new_target(mbs, name="loarm target.%s" % suffixletter, controlledmetabone=loarm, parent=root)
-        rig_chest_to_shoulder(chest, shoulder, relative_x_axis)
-        rig_hand()
+            else:
+                rig_finger(hand, s1, s2, s3, s4)
+
+                if s1.swing:
+                    rot_target = rig_new_target(mbs, "%s rot.%s" % (split_suffix(s1.name)[0], suffixletter),
+                                                controlledmetabone=s1,
+                                                parent=hand_target, lock_location=(True, True, True), lock_rotation= (False, True, True),
+                                                rotation_mode='XYZ')
+
+                    #limiting the location negates the "Inactive Targets Follow" effect, which doesn't make sense for
+                    #this target
+                    mbc = rot_target.new_meta_blender_constraint('LIMIT_LOCATION')
+                    mbc.use_min_x = True
+                    mbc.use_max_x = True
+                    mbc.use_min_y = True
+                    mbc.use_max_y = True
+                    mbc.use_min_z = True
+                    mbc.use_max_z = True
+                    mbc.owner_space = 'LOCAL'
+                    mbc.use_transform_limit = True
+
+    def rig_foot():
+        def get_toe_segment(f, s):
+            return get_phalange_segment("toe", f, s)
+
+        def create_toe_swingcenter(f, s):
+            return create_phalange_swingcenter("toe", f, s)
+
+        s1_bones = metabones_get_segment_siblings(mbs, "toe", 1, suffixletter)
+
+        if len(s1_bones) > 1:
+            foot_width_world = (s1_bones[0].head - s1_bones[len(s1_bones) - 1].head).length
+        elif heel_bone:
+            foot_width_world = heel_bone.length()
+        else:
+            foot_width_world = foot.length() / 2
+
+        multitarget_segments = s1_bones
+        final_segments = get_final_segments("toe")
+        final_segments_tail_average = sum_vectors([metabone.tail for metabone in final_segments]) / len(
+            final_segments)
+
+        #            heel = mbs.new_bone("MCH-heel.%s" % suffixletter)
+        #            heel.head = foot.head.copy()
+        #            heel.tail = foot_target.head.copy()
+        #            flag_bone_mechanical(heel)
+        #            heel.align_roll = Vector((0,-1,0))
+        #            heel.parent = foot
+
+        foot_target = mbs.new_bone("foot target.%s" % suffixletter)
+        foot_target.head = heel_bone.center()
+        foot_target.tail = Vector((foot.tail[0], foot.tail[1], 0))
+        foot_target_custom_shape_name = "%s target.%s" % (WIDGET_FOOT, suffixletter)
+        custom_widget_data[foot_target_custom_shape_name] = widgetdata_pad(
+            width=foot_width_world / foot_target.length(), length=1.0, mid=.3)
+        foot_target.show_wire = True
+        foot_target.custom_shape = widget_get(foot_target_custom_shape_name)
+        foot_target.parent = root
+
+        rig_target_affected(foot_target, foot, hard_rigidity=True, use_rest_offset=True)
+
+        #the heel bone is only needed as a reference, after it's used
+        #delete it because the final rig doesn't need it.
+        if heel_bone:
+            mbs.pop(heel_bone.name)
+
+        toes_target = mbs.new_bone("toes target.%s" % suffixletter)
+        toes_target.head = foot_target.tail.copy()
+        toes_target.tail = final_segments_tail_average.copy()
+        toes_target.tail = toes_target.head + (foot_target.y_axis() * toes_target.length())
+        toes_target.parent = root
+        toes_target.align_roll = sum_vectors([s1.align_roll for s1 in s1_bones]) / len(s1_bones)
+
+        toes_width_local = foot_width_world / toes_target.length()
+
+        toes_target_custom_shape_name = "%s target.%s" % (WIDGET_TOES, suffixletter)
+        custom_widget_data[toes_target_custom_shape_name] = widgetdata_pad(width=toes_width_local * 1.2, length=1.2,
+                                                                           mid=.1)
+        toes_target.show_wire = True
+        toes_target.custom_shape = widget_get(toes_target_custom_shape_name)
+
+        #            floor = mbs.new_bone("floor.%s" % suffixletter)
+        #            floor.head = foot_target.head.copy()
+        #            floor.tail = foot_target.tail.copy()
+        #            floor.parent = root
+        #            floor.custom_shape = widget_get(WIDGET_FLOOR)#"%s.%s" % (WIDGET_FLOOR,suffixletter))
+        #            floor.use_bepuik = True
+        #
+        #            floor_target = mbs.new_bone("foot floor target.%s" % suffixletter)
+        #            floor_target.head = foot_target.head.copy()
+        #            floor_target.tail = foot_target.tail.copy()
+        #            floor_target.parent = root
+        #            floor_target.custom_shape = widget_get(WIDGET_FLOOR)#"%s.%s" % (WIDGET_FLOOR_TARGET,suffixletter))
+        #            floor_target.show_wire = True
+
+        #            c = rig_target_affected(floor_target, floor)
+
+        #            #floor affect ball of the foot
+        #            c = floor.new_meta_blender_constraint('BEPUIK_LINEAR_AXIS_LIMIT',foot)
+        #            c.line_anchor = floor, 0
+        #            c.line_direction = floor, 'Z'
+        #            c.anchor_b = foot, 1
+        #            c.max_distance = 999999
+        #
+        #            #floor affect heel of the foot
+        #            c = floor.new_meta_blender_constraint('BEPUIK_LINEAR_AXIS_LIMIT',foot)
+        #            c.line_anchor = floor, 0
+        #            c.line_direction = floor, 'Z'
+        #            c.anchor_b = heel, 1
+        #            c.max_distance = 999999
+        #
+        #            def tail_affected_by_floor(segment):
+        #                c = floor.new_meta_blender_constraint('BEPUIK_LINEAR_AXIS_LIMIT',segment)
+        #                c.line_anchor = floor, 0
+        #                c.line_direction = floor, 'Z'
+        #                c.anchor_b = segment, 1
+        #                c.max_distance = 999999
+
+        for f in mbs.phalange_numbers("toe", suffixletter, max_phalange=5):
+            s1 = get_toe_segment(f, 1)
+            s2 = get_toe_segment(f, 2)
+            s3 = get_toe_segment(f, 3)
+
+            if not s1:
+                continue
 
-        rig_leg(upleg, loleg, foot, leg_relative_x_axis)
-        rig_new_target(mbs, name="loleg target.%s" % suffixletter, controlledmetabone=loleg, parent=root)
+            #                tail_affected_by_floor(s1)
 
-        rig_foot()
+            s1.swing_x = 20
+            s1.swing_y = 90
 
-        measure = mbs.new_bone("MCH-leg twist measure axis.%s" % suffixletter, transform=measurement_axis_mat)
-        rig_hips_to_upleg(hips, upleg, hips, measure, leg_relative_x_axis)
+            if not is_detail_at_least(detail_level, RIG_DETAIL_FULL):
+                rig_rigid_chain(s1, (s2, s3))
+                s2 = s3 = None
 
-    rig_side("L")
-    rig_side("R")
+            if s2:
+                s2.swing_center = create_toe_swingcenter(f, 2)
+                s2.swing_angle_max = 0
+                s2.swing_angle_min = -90
 
-    bpy.ops.object.mode_set(mode='EDIT')
+            #                    tail_affected_by_floor(s2)
 
-    mbs.to_ob(rig_ob)
+            if s3:
+                s3.swing_center = create_toe_swingcenter(f, 3)
+                s3.swing_angle_max = 70
+                s3.swing_angle_min = -20
 
-    prop = rna_idprop_ui_prop_get(rig_ob.pose.bones["spine"], "torso stiffness", create=True)
-    prop["min"] = 0.0
-    prop["soft_min"] = 0.0
-    prop["soft_max"] = 2.0
+            #                    tail_affected_by_floor(s3)
 
-    rig_ob.pose.bones["spine"]["torso stiffness"] = 2.0
+            rig_twist_joint(foot, s1)
+            rig_ballsocket_joint(foot, s1)
+            rig_bone_to_bone_with_2d_swing_info(foot, s1, axis_a_override=s1)
+            rig_toe(s1, s2, s3)
+            s1.parent = foot
 
-    def add_angular_joint_driver(driven_bone_name, driven_constraint_name):
-        fcurve = rig_ob.pose.bones[driven_bone_name].constraints[driven_constraint_name].driver_add("bepuik_rigidity")
-        fcurve.modifiers.remove(fcurve.modifiers[0])
-        driver = fcurve.driver
-        driver.type = 'AVERAGE'
-        v = driver.variables.new()
-        v.type = 'SINGLE_PROP'
-        v.targets[0].id = rig_ob
-        v.targets[0].data_path = r'pose.bones["spine"]["torso stiffness"]'
+        for multitarget_segment in multitarget_segments:
+            rig_target_affected(toes_target, multitarget_segment, use_rest_offset=True)
 
-    add_angular_joint_driver(hips.name, spine_stiff_angular_joint.name)
-    add_angular_joint_driver(spine.name, chest_stiff_angular_joint.name)
+        rig_new_target(mbs, "foot ball target.%s" % suffixletter, foot, root, headtotail=1.0, use_rest_offset=True)
 
-    organize_pchan_layers(rig_ob)
-    rig_ob.bepuik_autorig.is_meta_armature = False
-    rig_ob.bepuik_autorig.is_auto_rig = True
-    rig_ob.use_bepuik_solve_peripheral_bones = False
-    apply_rig_starting_layers(rig_ob)
+    if eye:
+        eye.new_meta_blender_constraint('DAMPED_TRACK', eye_target)
+        eye.use_deform = True
+        eye.parent = head
 
-    found_error = False
-    found_warning = False
-    for warninglevel, msg in printmsgs:
-        if warninglevel == 'ERROR':
-            found_error = True
-        elif warninglevel == 'WARNING':
-            found_warning = True
+    if ear:
+        ear.parent = head
 
-        if op:
-            op.report({warninglevel}, msg)
+    rig_arm(shoulder, uparm, loarm, relative_x_axis, up)
+    rig_new_target(mbs, name="loarm target.%s" % suffixletter, controlledmetabone=loarm, parent=root)
+    rig_chest_to_shoulder(chest, shoulder, relative_x_axis)
+    rig_hand()
 
-    if not found_error and not found_warning:
-        op.report({'INFO'}, "Rig Completed successfully!")
+    rig_leg(upleg, loleg, foot, leg_relative_x_axis)
+    rig_new_target(mbs, name="loleg target.%s" % suffixletter, controlledmetabone=loleg, parent=root)
 
-    return rig_ob
+    rig_foot()
 
+    measure = mbs.new_bone("MCH-leg twist measure axis.%s" % suffixletter, transform=measurement_axis_mat)
+    rig_hips_to_upleg(hips, upleg, hips, measure, leg_relative_x_axis)
 
 def rig_new_target(metabonegroup, name, controlledmetabone, parent, scale=.10, headtotail=0,
                    custom_shape_name=WIDGET_CUBE, lock_location=(False, False, False), lock_rotation_w=False,
-                   lock_rotation=(False, False, False), lock_rotations_4d=False, custom_widget_data=None,
+                   lock_rotation=(False, False, False), lock_rotations_4d=False,
                    use_rest_offset=True, rotation_mode='QUATERNION'):
     targetmetabone = metabonegroup.new_bone_by_fraction(name=name, source_metabone=controlledmetabone,
                                                         start_fraction=headtotail, end_fraction=headtotail + scale)
 
     targetmetabone.parent = parent
     targetmetabone.show_wire = True
-    targetmetabone.custom_shape = widgetdata_get(custom_shape_name, custom_widget_data)
+    #resolved into the widget object when the metabone is applied, see MetaBoneDict.to_ob
+    targetmetabone.custom_shape = custom_shape_name
     targetmetabone.lock_scale = (True, True, True)
     targetmetabone.lock_rotation_w = lock_rotation_w
     targetmetabone.lock_rotation = lock_rotation
@@ -2336,6 +4207,18 @@ def rig_finger(hand, metacarpal, proximal, intermediate, distal):
     distal.parent = intermediate
 
 
+def rig_rigid_chain(parent, segments):
+    """segments that exist follow parent rigidly, each deforming and parented to the one before it"""
+    for segment in segments:
+        if not segment:
+            continue
+
+        segment.use_deform = True
+        segment.use_connect = (segment.head - parent.tail).length <= CONNECT_EPSILON
+        segment.parent = parent
+        parent = segment
+
+
 def rig_toe(s1, s2, s3):
     flag_bone_deforming_ballsocket_bepuik(s1)
 
@@ -2477,50 +4360,110 @@ def get_pchan_target_names(ob):
     return pchan_target_names
 
 
-def organize_pchan_layer(pchan, bone_hint_str=None, is_bepuik_target=False):
-    bone = pchan.bone
-    suffixletter = get_suffix_letter(bone.name)
+#built from SUBSTRING_SETS and MAP_SUBSTRING_SET_TO_ARMATURELAYER on first use, see layer_classifier_compile
+layer_classifier_pattern = None
+layer_classifier_substring_sets = {}
+
+#(bone_hint_str, suffixletter) -> body layer indices
+layer_classifier_cache = {}
+
+#(bone_hint_str, suffixletter, flags...) -> bone layers
+pchan_layers_cache = {}
+
+
+def layer_classifier_compile():
+    """
+    Compile all substrings of SUBSTRING_SETS into one pattern. The lookahead finds the longest substring starting
+    at every position of the bone hint, every substring set containing it or one of its own substrings matches.
+    """
+    global layer_classifier_pattern
+
+    if not MAP_SUBSTRING_SET_TO_ARMATURELAYER:
+        layer_map_build()
+
+    substrings = sorted({substring for substring_set in SUBSTRING_SETS for substring in substring_set},
+                        key=len, reverse=True)
+
+    layer_classifier_substring_sets.clear()
+    for substring in substrings:
+        layer_classifier_substring_sets[substring] = [substring_set for substring_set in SUBSTRING_SETS
+                                                      if any(s in substring for s in substring_set)]
+
+    layer_classifier_pattern = re.compile("(?=(%s))" % "|".join(re.escape(s) for s in substrings))
+    layer_classifier_cache.clear()
+    pchan_layers_cache.clear()
+
+
+def layer_classify(bone_hint_str, suffixletter):
+    """The body layers of MAP_SUBSTRING_SET_TO_ARMATURELAYER for a bone hint"""
+    key = (bone_hint_str, suffixletter)
+    if key in layer_classifier_cache:
+        return layer_classifier_cache[key]
+
+    if layer_classifier_pattern is None:
+        layer_classifier_compile()
+
     layer_indices = set()
-    exclude_from_body_layers = False
+    for match in layer_classifier_pattern.finditer(bone_hint_str):
+        for substring_set in layer_classifier_substring_sets[match.group(1)]:
+            if (substring_set, suffixletter) in MAP_SUBSTRING_SET_TO_ARMATURELAYER:
+                layer_indices.add(MAP_SUBSTRING_SET_TO_ARMATURELAYER[(substring_set, suffixletter)])
 
-    if bone.use_deform:
-        layer_indices.add(AL_DEFORMER)
+    layer_classifier_cache[key] = layer_indices = frozenset(layer_indices)
+    return layer_indices
 
-    if pchan.use_bepuik:
-        layer_indices.add(AL_BEPUIK_BONE)
 
-    if is_bepuik_target or pchan.name.endswith("target"):
-        layer_indices.add(AL_TARGET)
+def pchan_layers_get(pchan, bone_hint_str=None, is_bepuik_target=False):
+    bone = pchan.bone
 
     if (pchan.rotation_mode == 'QUATERNION' or pchan.rotation_mode == 'AXIS_ANGLE') and pchan.lock_rotations_4d:
         lock_rotation = (all(pchan.lock_rotation) and pchan.lock_rotation_w)
     else:
         lock_rotation = (all(pchan.lock_rotation))
 
-    if not lock_rotation or not all(pchan.lock_scale) or not all(pchan.lock_location):
+    is_animatable = not lock_rotation or not all(pchan.lock_scale) or not all(pchan.lock_location)
+
+    if not bone_hint_str:
+        bone_hint_str = bone.basename
+
+    key = (bone_hint_str, get_suffix_letter(bone.name), bone.use_deform, pchan.use_bepuik,
+           is_bepuik_target or pchan.name.endswith("target"), is_animatable)
+
+    if key in pchan_layers_cache:
+        return pchan_layers_cache[key]
+
+    bone_hint_str, suffixletter, use_deform, use_bepuik, is_target, is_animatable = key
+    layer_indices = set()
+
+    if use_deform:
+        layer_indices.add(AL_DEFORMER)
+
+    if use_bepuik:
+        layer_indices.add(AL_BEPUIK_BONE)
+
+    if is_target:
+        layer_indices.add(AL_TARGET)
+
+    if is_animatable:
         layer_indices.add(AL_ANIMATABLE)
+        layer_indices |= layer_classify(bone_hint_str, suffixletter)
     else:
         layer_indices.add(AL_MECHANICAL)
-        exclude_from_body_layers = True
 
-    #    if pchan.name.startswith("MCH-"):
-    #        layer_indices.add(AL_MECHANICAL)
-    #        exclude_from_body_layers = True
+    pchan_layers_cache[key] = layers = tuple(i in layer_indices for i in range(32))
+    return layers
+
 
-    if not exclude_from_body_layers:
-        if not bone_hint_str:
-            bone_hint_str = bone.basename
+def organize_pchan_layer(pchan, bone_hint_str=None, is_bepuik_target=False):
+    pchan.bone.layers = pchan_layers_get(pchan, bone_hint_str, is_bepuik_target)
 
-        for substring_set in SUBSTRING_SETS:
-            if any(substring in bone_hint_str for substring in substring_set):
-                if (substring_set, suffixletter) in MAP_SUBSTRING_SET_TO_ARMATURELAYER:
-                    index_to_add = MAP_SUBSTRING_SET_TO_ARMATURELAYER[(substring_set, suffixletter)]
-                    layer_indices.add(index_to_add)
 
-    bone.layers = [True if i in layer_indices else False for i in range(32)]
+def organize_pchan_layers(ob, pchan_target_names=None):
+    if pchan_target_names is None:
+        pchan_target_names = get_pchan_target_names(ob)
 
+    layers = {pchan.name: pchan_layers_get(pchan, is_bepuik_target=pchan.name in pchan_target_names)
+              for pchan in ob.pose.bones}
 
-def organize_pchan_layers(ob):
-    pchan_target_names = get_pchan_target_names(ob)
-    for pchan in ob.pose.bones:
-        organize_pchan_layer(pchan, is_bepuik_target=pchan.name in pchan_target_names)
+    #one bulk write in the order of the armature bones
+    ob.data.bones.foreach_set("layers", [layer for bone in ob.data.bones for layer in layers[bone.name]])
@@ -0,0 +1,136 @@
+# ====================== BEGIN GPL LICENSE BLOCK ======================
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+#  The Original Code is Copyright (C) 2013 by: 
+#  Harrison Nordby and Ross Nordby
+#  All rights reserved.
+#
+#  The Original Code is: all of this file
+#  
+#  Contributor(s): none yet.
+#
+#
+#======================= END GPL LICENSE BLOCK ========================
+"""
+Rigidity states: the rigidities of the BEPUIK_CONTROL constraints of a rig, or of some of its bones, as flat arrays,
+which can be stored on the rig under a name and switched between.
+
+Constraint collections hold constraints of every type, so foreach_get/foreach_set can't read or write the BEPUik
+rigidities in bulk. Applying a state instead only writes the entries that differ from the rig.
+"""
+import json
+
+RIGIDITY_ATTRS = ('bepuik_rigidity', 'orientation_rigidity', 'use_hard_rigidity')
+RIGIDITY_STATES_PROP = "bepuik_rigidity_states"
+
+
+class RigidityState():
+    """
+    Rigidities of BEPUIK_CONTROL constraints, controls[i] is (owner bone name, constraint name) and
+    values[i * len(RIGIDITY_ATTRS) + j] its RIGIDITY_ATTRS[j]
+    """
+    def __init__(self, controls=None, values=None):
+        self.controls = controls if controls is not None else []
+        self.values = values if values is not None else []
+        self.indices = {control: i for i, control in enumerate(self.controls)}
+
+    @classmethod
+    def capture(cls, ob, owner_names=None):
+        """The controls of ob, or only those owned by the bones named in owner_names"""
+        pose_bones = ob.pose.bones
+        if owner_names is None:
+            pchans = pose_bones
+        else:
+            pchans = [pose_bones[name] for name in sorted(set(owner_names)) if name in pose_bones]
+
+        state = cls()
+        for pchan in pchans:
+            for con in pchan.constraints:
+                if con.type == 'BEPUIK_CONTROL':
+                    state.indices[(pchan.name, con.name)] = len(state.controls)
+                    state.controls.append((pchan.name, con.name))
+                    state.values.extend(float(getattr(con, attr)) for attr in RIGIDITY_ATTRS)
+
+        return state
+
+    def set(self, owner_name, constraint_name, **rigidities):
+        start = self.indices[(owner_name, constraint_name)] * len(RIGIDITY_ATTRS)
+        for j, attr in enumerate(RIGIDITY_ATTRS):
+            if attr in rigidities:
+                self.values[start + j] = float(rigidities[attr])
+
+    def clear(self, owner_name):
+        """Zero all rigidities of the controls of owner_name"""
+        for i, (control_owner_name, constraint_name) in enumerate(self.controls):
+            if control_owner_name == owner_name:
+                start = i * len(RIGIDITY_ATTRS)
+                self.values[start:start + len(RIGIDITY_ATTRS)] = [0.0] * len(RIGIDITY_ATTRS)
+
+    def apply(self, ob, use_keyframe=False, group=""):
+        """
+        Write the rigidities that differ from the rig, controls missing from the rig are skipped, controls
+        missing from the state are left alone. With use_keyframe all rigidities of the state are keyframed at the
+        current frame, in the action group group, so a switch is keyed as one unit.
+
+        :return: the number of rigidities written
+        :rtype: int
+        """
+        num_changed = 0
+        pose_bones = ob.pose.bones
+
+        for i, (owner_name, constraint_name) in enumerate(self.controls):
+            pchan = pose_bones.get(owner_name)
+            con = pchan.constraints.get(constraint_name) if pchan else None
+            if not con or con.type != 'BEPUIK_CONTROL':
+                continue
+
+            for j, attr in enumerate(RIGIDITY_ATTRS):
+                val = self.values[i * len(RIGIDITY_ATTRS) + j]
+                if float(getattr(con, attr)) != val:
+                    setattr(con, attr, bool(val) if attr == 'use_hard_rigidity' else val)
+                    num_changed += 1
+
+                if use_keyframe:
+                    con.keyframe_insert(attr, group=group)
+
+        return num_changed
+
+    def to_dict(self):
+        return {'controls': [list(control) for control in self.controls], 'values': self.values}
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls([tuple(control) for control in d['controls']], list(d['values']))
+
+
+def rigidity_states_get(ob):
+    """Named rigidity states stored on ob, name -> RigidityState.to_dict result"""
+    return json.loads(ob[RIGIDITY_STATES_PROP]) if RIGIDITY_STATES_PROP in ob else {}
+
+
+def rigidity_state_names(ob):
+    return sorted(rigidity_states_get(ob).keys())
+
+
+def rigidity_state_store(ob, name, state):
+    states = rigidity_states_get(ob)
+    states[name] = state.to_dict()
+    ob[RIGIDITY_STATES_PROP] = json.dumps(states, sort_keys=True)
+
+
+def rigidity_state_recall(ob, name):
+    states = rigidity_states_get(ob)
+    return RigidityState.from_dict(states[name]) if name in states else None
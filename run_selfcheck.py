@@ -0,0 +1,49 @@
+# ====================== BEGIN GPL LICENSE BLOCK ======================
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+#  The Original Code is Copyright (C) 2013 by: 
+#  Harrison Nordby and Ross Nordby
+#  All rights reserved.
+#
+#  The Original Code is: all of this file
+#  
+#  Contributor(s): none yet.
+#
+#
+#======================= END GPL LICENSE BLOCK ========================
+"""
+Self check driver, run with:
+
+    blender --background --factory-startup --python run_selfcheck.py -- [CHECK ...]
+
+See selfcheck.py.
+"""
+import addon_utils
+import importlib
+import os
+import sys
+
+ADDON_DIR = os.path.dirname(os.path.abspath(__file__))
+ADDON_MODULE = os.path.basename(ADDON_DIR)
+
+if os.path.dirname(ADDON_DIR) not in sys.path:
+    sys.path.append(os.path.dirname(ADDON_DIR))
+
+addon_utils.enable(ADDON_MODULE, default_set=False)
+selfcheck = importlib.import_module(ADDON_MODULE + ".selfcheck")
+
+argv = sys.argv[sys.argv.index("--") + 1:] if "--" in sys.argv else []
+sys.exit(1 if selfcheck.main(argv) else 0)
@@ -0,0 +1,608 @@
+# ====================== BEGIN GPL LICENSE BLOCK ======================
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+#  The Original Code is Copyright (C) 2013 by: 
+#  Harrison Nordby and Ross Nordby
+#  All rights reserved.
+#
+#  The Original Code is: all of this file
+#  
+#  Contributor(s): none yet.
+#
+#
+#======================= END GPL LICENSE BLOCK ========================
+"""
+Self checks of the rig generation, for use in background blender, see run_selfcheck.py.
+
+The checks compare the optimized paths of the rig planning with a straightforward computation of the same result,
+on meta armatures built as pure data, so they need no scene. Each check returns messages for its mismatches rather
+than stopping at the first.
+"""
+import argparse
+import json
+import random
+import traceback
+
+from collections import OrderedDict
+
+from . import constraintgraph, riggenerator
+from .batch import meta_armature_params
+
+DRIVER_SCRIPT = "run_selfcheck.py"
+
+#mismatches printed per check, the count is always printed
+MAX_REPORTED = 20
+
+#parameter overrides of the meta armatures the checks run on, see batch.meta_armature_params
+CHECK_CONFIGURATIONS = OrderedDict((("default", {}),
+                                    ("complex toes", {'num_toes': 5, 'use_simple_toe': False}),
+                                    ("simple hand", {'use_simple_hand': True}),
+                                    ("three fingers", {'num_fingers': 3}),
+                                    ("no thumb", {'use_thumb': False}),
+                                    ("tail", {'num_tail_bones': 5}),
+                                    ("ears and belly", {'use_ears': True, 'use_belly': True}),
+                                    ("one finger three toes", {'num_fingers': 1, 'num_toes': 3,
+                                                               'use_simple_toe': False})))
+
+#name -> function returning a list of mismatch messages, filled by the check decorator
+CHECKS = OrderedDict()
+
+
+def check(function):
+    CHECKS[function.__name__[len("check_"):]] = function
+    return function
+
+
+def metabones_for(overrides):
+    return riggenerator.meta_full_body_metabones(**meta_armature_params(overrides))
+
+
+def plan_for(overrides, **options):
+    """The RigPlan of the meta armature of overrides, options are passed on to plan_full_body"""
+    params = meta_armature_params(overrides)
+    return riggenerator.plan_full_body(riggenerator.meta_full_body_metabones(**params),
+                                       use_thumb=params['use_thumb'], use_simple_hand=params['use_simple_hand'],
+                                       use_bepuik_tail=params['use_bepuik_tail'], **options)
+
+
+def differences(a, b, path="", tolerance=1e-5):
+    """Paths at which two json like values differ, floats are compared with tolerance"""
+    if isinstance(a, dict) and isinstance(b, dict):
+        messages = []
+        for key in sorted(set(a.keys()) | set(b.keys()), key=str):
+            if key not in a or key not in b:
+                messages.append("%s/%s only in the %s" % (path, key, "first" if key in a else "second"))
+            else:
+                messages.extend(differences(a[key], b[key], "%s/%s" % (path, key), tolerance))
+
+        return messages
+
+    if isinstance(a, (list, tuple)) and isinstance(b, (list, tuple)):
+        if len(a) != len(b):
+            return ["%s has %s items instead of %s" % (path, len(b), len(a))]
+
+        messages = []
+        for i, (item_a, item_b) in enumerate(zip(a, b)):
+            messages.extend(differences(item_a, item_b, "%s[%s]" % (path, i), tolerance))
+
+        return messages
+
+    if isinstance(a, float) or isinstance(b, float):
+        if isinstance(a, (int, float)) and isinstance(b, (int, float)) and abs(a - b) <= tolerance:
+            return []
+
+    elif a == b:
+        return []
+
+    return ["%s: %r != %r" % (path, a, b)]
+
+
+def swing_limits_canonical(plan_dict):
+    """
+    Negate both axes of swing limits between two X axes that start at NEGATIVE_X. rig_side flips both axes of
+    some of these limits on the right side and neither of others, which keeps the angle between the axes.
+    """
+    x_axes = {'X': 'NEGATIVE_X', 'NEGATIVE_X': 'X'}
+    for metabone_dict in plan_dict['metabones'].values():
+        for constraint_dict in metabone_dict['constraints']:
+            attrs = constraint_dict['attrs']
+            if constraint_dict['type'] == 'BEPUIK_SWING_LIMIT' and attrs['axis_a'][1] == 'NEGATIVE_X' and \
+                    attrs['axis_b'][1] in x_axes:
+                attrs['axis_a'][1] = 'X'
+                attrs['axis_b'][1] = x_axes[attrs['axis_b'][1]]
+
+    return plan_dict
+
+
+@check
+def check_mirror():
+    """The right side derived by SideMirror matches the right side rigged by plan_side"""
+    messages = []
+    for name, overrides in CHECK_CONFIGURATIONS.items():
+        mirrored = plan_for(overrides, use_mirror=True).to_dict()
+        rigged = plan_for(overrides, use_mirror=False).to_dict()
+        for plan_dict in (mirrored, rigged):
+            plan_dict.pop('messages')
+
+        messages.extend("%s: %s" % (name, message) for message in
+                        differences(swing_limits_canonical(rigged), swing_limits_canonical(mirrored)))
+
+    return messages
+
+
+@check
+def check_metabone_defaults():
+    """
+    Metabones read the same values as when every default was copied into them: unset attributes give the
+    MetaBone.all_attrs defaults, a metabone copied from another has all of its values and planning leaves the shared
+    defaults untouched
+    """
+    messages = []
+    for name, overrides in CHECK_CONFIGURATIONS.items():
+        for metabone in plan_for(overrides).metabones.values():
+            copied = riggenerator.MetaBone(metabone.name, metabone)
+            for attr in riggenerator.MetaBone.all_attrs.keys():
+                val = getattr(metabone, attr)
+                if getattr(copied, attr) != val:
+                    messages.append("%s: %s of the copy of %s is %r instead of %r" %
+                                    (name, attr, metabone.name, getattr(copied, attr), val))
+
+    for attr, default in riggenerator.MetaBone.all_attrs.items():
+        if riggenerator.MetaBone.shared_defaults[attr] != default:
+            messages.append("shared default %s changed to %r" % (attr, riggenerator.MetaBone.shared_defaults[attr]))
+
+    fresh = riggenerator.MetaBone("fresh")
+    if dict(fresh.attr_items()) != dict(riggenerator.MetaBone.all_attrs, name="fresh"):
+        messages.append("a new metabone doesn't read the MetaBone.all_attrs defaults")
+
+    return messages
+
+
+#MetaBone methods cached by metabone_cached
+METABONE_CACHED_METHODS = ('y_axis', 'x_axis', 'z_axis', 'matrix', 'length')
+
+
+def metabone_cache_differences(metabone, label):
+    """The cached values of metabone that differ from a recomputation without the cache"""
+    messages = []
+    for method in METABONE_CACHED_METHODS:
+        try:
+            cached = riggenerator.metabone_cache_flat(getattr(metabone, method)())
+        except AssertionError as ex:
+            #raised by the METABONE_CHECK_CACHE comparison
+            messages.append("%s: %s" % (label, ex))
+            continue
+
+        computed = riggenerator.metabone_cache_flat(getattr(riggenerator.MetaBone, method).__wrapped__(metabone))
+        if max(abs(a - b) for a, b in zip(cached, computed)) > 1e-6:
+            messages.append("%s: cached %s of %s is stale" % (label, method, metabone.name))
+
+    return messages
+
+
+@check
+def check_metabone_cache():
+    """
+    Planning with METABONE_CHECK_CACHE, which compares every cache hit with a recomputation, and the cached values
+    after planning and after moving the bones
+    """
+    messages = []
+    check_cache = riggenerator.METABONE_CHECK_CACHE
+    riggenerator.METABONE_CHECK_CACHE = True
+    try:
+        for name, overrides in CHECK_CONFIGURATIONS.items():
+            try:
+                plan = plan_for(overrides)
+            except AssertionError as ex:
+                messages.append("%s: %s" % (name, ex))
+                continue
+
+            for metabone in plan.metabones.values():
+                if not metabone.is_valid():
+                    continue
+
+                messages.extend(metabone_cache_differences(metabone, name))
+
+                moved = riggenerator.MetaBone(metabone.name, metabone)
+                moved.matrix()
+                moved.head = moved.head + riggenerator.Vector((0, 0, -.1))
+                moved.tail = moved.tail * 2
+                moved.align_roll = -moved.align_roll
+                if moved.is_valid():
+                    messages.extend(metabone_cache_differences(moved, name + " moved"))
+    finally:
+        riggenerator.METABONE_CHECK_CACHE = check_cache
+
+    return messages
+
+
+#ranges the phalange lookups are probed in, wider than any meta armature
+PHALANGE_CHAINS = ('finger', 'toe')
+PHALANGE_SUFFIX_LETTERS = ('L', 'R', '')
+MAX_PHALANGE = 6
+MAX_SEGMENT = 5
+
+
+def phalange_probed(metabones, chain, phalange, segment, suffixletter):
+    """the phalange segment looked up by its key, like before MetaBoneDict.phalange_index"""
+    return metabones[riggenerator.suffixed("%s%s-%s" % (chain, phalange, segment), suffixletter)]
+
+
+def phalange_index_differences(metabones, label):
+    """The phalange lookups of metabones that don't find what probing every key finds"""
+    try:
+        return phalange_lookup_differences(metabones, label)
+    except KeyError as ex:
+        return ["%s: the index still has %s" % (label, ex)]
+
+
+def phalange_lookup_differences(metabones, label):
+    messages = []
+    for chain in PHALANGE_CHAINS:
+        for suffixletter in PHALANGE_SUFFIX_LETTERS:
+            for phalange in range(1, MAX_PHALANGE + 1):
+                for segment in range(1, MAX_SEGMENT + 1):
+                    if metabones.phalange_segment(chain, phalange, segment, suffixletter) is not \
+                            phalange_probed(metabones, chain, phalange, segment, suffixletter):
+                        messages.append("%s: phalange_segment%r" % (label, (chain, phalange, segment, suffixletter)))
+
+            for segment in range(1, MAX_SEGMENT + 1):
+                probed = [phalange_probed(metabones, chain, phalange, segment, suffixletter)
+                          for phalange in range(1, MAX_PHALANGE + 1)]
+                if metabones.segment_siblings(chain, segment, suffixletter) != [mb for mb in probed if mb]:
+                    messages.append("%s: segment_siblings%r" % (label, (chain, segment, suffixletter)))
+
+            for max_segment in (None, 1, 2, 3):
+                probed = []
+                for phalange in range(1, MAX_PHALANGE + 1):
+                    segments = [phalange_probed(metabones, chain, phalange, segment, suffixletter)
+                                for segment in range(1, (max_segment or MAX_SEGMENT) + 1)]
+                    segments = [mb for mb in segments if mb]
+                    if segments:
+                        probed.append(segments[-1])
+
+                if metabones.final_segments(chain, suffixletter, max_segment) != probed:
+                    messages.append("%s: final_segments%r" % (label, (chain, suffixletter, max_segment)))
+
+    return messages
+
+
+@check
+def check_phalange_index():
+    """
+    The phalange lookups of MetaBoneDict against probing every key, on meta armatures and rig plans and after
+    randomly removing and adding segments
+    """
+    messages = []
+    rng = random.Random(0)
+    for name, overrides in CHECK_CONFIGURATIONS.items():
+        for label, metabones in ((name, metabones_for(overrides)), (name + " plan", plan_for(overrides).metabones)):
+            messages.extend(phalange_index_differences(metabones, label))
+
+            for step in range(100):
+                chain = rng.choice(PHALANGE_CHAINS)
+                key = riggenerator.suffixed("%s%s-%s" % (chain, rng.randint(1, MAX_PHALANGE),
+                                                         rng.randint(1, MAX_SEGMENT)),
+                                            rng.choice(PHALANGE_SUFFIX_LETTERS))
+                if key not in metabones:
+                    metabones.new_bone(key)
+                elif rng.random() < .5:
+                    metabones.pop(key)
+                else:
+                    del metabones[key]
+
+                if step % 10 == 9:
+                    messages.extend(phalange_index_differences(metabones, "%s after %s changes" % (label, step + 1)))
+
+    return messages
+
+
+#swing limits added between uparm.L and loarm.L of the default plan: name, owner, axis_a, axis_b, max_swing and
+#whether the pruner removes it. The plan limits uparm.L X against loarm.L Y to 87 degrees, uparm.L Y against loarm.L Y
+#to 160 degrees and has a revolute joint around uparm.L Z
+PRUNE_SWING_CASES = (("wider", 'uparm.L', ('uparm.L', 'X'), ('loarm.L', 'Y'), 100, True),
+                     ("wider swapped", 'loarm.L', ('loarm.L', 'Y'), ('uparm.L', 'X'), 90, True),
+                     ("vacuous", 'uparm.L', ('uparm.L', 'Y'), ('loarm.L', 'Y'), 180, True),
+                     ("within the revolute joint", 'uparm.L', ('uparm.L', 'Z'), ('loarm.L', 'X'), 95, True),
+                     ("tighter", 'uparm.L', ('uparm.L', 'Y'), ('loarm.L', 'Y'), 120, False))
+
+
+def constraint_joined_pairs(plan):
+    """pairs of bones joined by a constraint other than a control, including the ball socket to the parent"""
+    return {frozenset((edge.owner, edge.other)) for edge in constraintgraph.ConstraintGraph.from_plan(plan).edges
+            if not edge.is_control() and edge.other}
+
+
+@check
+def check_prune():
+    """
+    PlanPruner on constraints it must and must not remove, pruning keeps every pair of bones joined and pruning a
+    pruned plan removes nothing
+    """
+    messages = []
+    plan = plan_for({})
+    metabones = plan.metabones
+    expected_redundant = {}
+    for name, owner, axis_a, axis_b, max_swing, is_redundant in PRUNE_SWING_CASES:
+        other = 'loarm.L' if owner == 'uparm.L' else 'uparm.L'
+        mbc = metabones[owner].new_meta_blender_constraint('BEPUIK_SWING_LIMIT', metabones[other], name=name)
+        mbc.axis_a = metabones[axis_a[0]], axis_a[1]
+        mbc.axis_b = metabones[axis_b[0]], axis_b[1]
+        mbc.max_swing = max_swing
+        expected_redundant[name] = is_redundant
+
+    #the revolute joint doesn't twist loarm.L around its Y axis
+    mbc = metabones['uparm.L'].new_meta_blender_constraint('BEPUIK_TWIST_LIMIT', metabones['loarm.L'], name="twist")
+    mbc.axis_a = mbc.axis_b = metabones['loarm.L'], 'Y'
+    mbc.measurement_axis_a = mbc.measurement_axis_b = metabones['loarm.L'], 'Z'
+    mbc.max_twist = 10
+    expected_redundant["twist"] = True
+
+    riggenerator.PlanPruner(plan).prune()
+    kept = {mbc.name for owner in ('uparm.L', 'loarm.L') for mbc in metabones[owner].meta_blender_constraints}
+    for name, is_redundant in sorted(expected_redundant.items()):
+        if (name in kept) == is_redundant:
+            messages.append("%s was %s" % (name, "kept" if is_redundant else "removed"))
+
+    for name, overrides in CHECK_CONFIGURATIONS.items():
+        pruned = plan_for(overrides, use_prune=True)
+        separated = constraint_joined_pairs(plan_for(overrides)) - constraint_joined_pairs(pruned)
+        if separated:
+            messages.append("%s: pruning separated %s" %
+                            (name, ", ".join(sorted(" and ".join(sorted(pair)) for pair in separated))))
+
+        num_removed, num_rows = riggenerator.PlanPruner(pruned).prune()
+        if num_removed:
+            messages.append("%s: pruning again removed %s constraints" % (name, num_removed))
+
+    return messages
+
+
+#suffix letters bone hints are classified with, get_suffix_letter gives None for names without a suffix
+LAYER_SUFFIX_LETTERS = ('L', 'R', '', None)
+
+#characters between the substrings of the random bone hints
+LAYER_FILLERS = ('', ' ', '-', '.', '_', 'x', 'MCH-')
+
+
+def layer_probed(bone_hint_str, suffixletter):
+    """the body layers of a bone hint found by trying every substring set, like before layer_classifier_compile"""
+    layer_indices = set()
+    for substring_set in riggenerator.SUBSTRING_SETS:
+        if any(substring in bone_hint_str for substring in substring_set):
+            if (substring_set, suffixletter) in riggenerator.MAP_SUBSTRING_SET_TO_ARMATURELAYER:
+                layer_indices.add(riggenerator.MAP_SUBSTRING_SET_TO_ARMATURELAYER[(substring_set, suffixletter)])
+
+    return layer_indices
+
+
+@check
+def check_layer_classifier():
+    """
+    layer_classify against trying every substring set, on the bone names of the rig plans and on random bone hints
+    made of the substrings, also overlapping ones like 'hipalm'
+    """
+    riggenerator.layer_classifier_compile()
+
+    bone_hints = set()
+    for overrides in CHECK_CONFIGURATIONS.values():
+        for name in plan_for(overrides).metabones.keys():
+            bone_hints.add(riggenerator.split_suffix(name)[0])
+            bone_hints.add(name)
+
+    substrings = sorted({substring for substring_set in riggenerator.SUBSTRING_SETS for substring in substring_set})
+    for a in substrings:
+        for b in substrings:
+            #the end of a is the start of b, a pattern without lookahead would match only one of them
+            bone_hints.update(a + b[k:] for k in range(1, min(len(a), len(b))) if a.endswith(b[:k]))
+
+    rng = random.Random(0)
+    for i in range(1000):
+        bone_hints.add("".join(rng.choice(LAYER_FILLERS) + rng.choice(substrings)[:rng.randint(2, 12)]
+                               for j in range(rng.randint(1, 3))))
+
+    messages = []
+    for bone_hint_str in sorted(bone_hints):
+        for suffixletter in LAYER_SUFFIX_LETTERS:
+            layer_indices = layer_probed(bone_hint_str, suffixletter)
+            if riggenerator.layer_classify(bone_hint_str, suffixletter) != layer_indices:
+                messages.append("%r %r: layers %s instead of %s" %
+                                (bone_hint_str, suffixletter,
+                                 sorted(riggenerator.layer_classify(bone_hint_str, suffixletter)),
+                                 sorted(layer_indices)))
+
+    return messages
+
+
+def plan_dict_copy(plan_dict):
+    return json.loads(json.dumps(plan_dict))
+
+
+def plan_diff_differences(previous_plan_dict, plan_dict, label, **expected):
+    """
+    The RigPlanDiff attributes of going from previous_plan_dict to plan_dict that aren't the expected sets, attributes
+    that aren't given are expected to be empty
+    """
+    diff = riggenerator.RigPlanDiff(previous_plan_dict, plan_dict)
+    messages = []
+    for attr in ('removed', 'added', 'edit_changed', 'pose_changed', 'constraints_changed', 'widgets_changed'):
+        if getattr(diff, attr) != expected.get(attr, set()):
+            messages.append("%s: %s is %s instead of %s" %
+                            (label, attr, sorted(getattr(diff, attr)), sorted(expected.get(attr, set()))))
+
+    affected = set().union(*(expected.get(attr, set()) for attr in
+                             ('added', 'edit_changed', 'pose_changed', 'constraints_changed')))
+    if diff.affected() != affected:
+        messages.append("%s: affected is %s instead of %s" % (label, sorted(diff.affected()), sorted(affected)))
+
+    return messages
+
+
+@check
+def check_plan_diff():
+    """
+    RigPlanDiff of a plan and copies of it with a bone moved, removed or added, with a pose attribute, a constraint,
+    a driven constraint, a driver or a widget changed and with a widget imported
+    """
+    messages = []
+    for name, overrides in CHECK_CONFIGURATIONS.items():
+        plan_dict = plan_dict_copy(plan_for(overrides).to_dict())
+        by_bone_name = riggenerator.plan_dict_by_bone_name(plan_dict)
+        keys = {mbd['name']: key for key, mbd in plan_dict['metabones'].items()}
+        messages.extend(plan_diff_differences(plan_dict, plan_dict_copy(plan_dict), name + " copy"))
+
+        bone_name = next(bone_name for bone_name, (attrs, constraints) in sorted(by_bone_name.items()) if constraints)
+        changed = plan_dict_copy(plan_dict)
+        attrs = changed['metabones'][keys[bone_name]]['attrs']
+        attrs['tail']['vector'] = [val * 1.5 for val in attrs['tail']['vector']]
+        messages.extend(plan_diff_differences(plan_dict, changed, name + " moved", edit_changed={bone_name}))
+
+        changed = plan_dict_copy(plan_dict)
+        changed['metabones'][keys[bone_name]]['attrs']['bepuik_rotational_heaviness'] += 1
+        messages.extend(plan_diff_differences(plan_dict, changed, name + " pose attribute", pose_changed={bone_name}))
+
+        changed = plan_dict_copy(plan_dict)
+        changed['metabones'][keys[bone_name]]['constraints'].pop()
+        messages.extend(plan_diff_differences(plan_dict, changed, name + " constraint removed",
+                                              constraints_changed={bone_name}))
+
+        #a bone with a constraint driven by a custom property, its drivers have to go with the old constraint
+        bone_name, constraint_name, attr_name, data_path = plan_dict['drivers'][0]
+        changed = plan_dict_copy(plan_dict)
+        for mbcd in changed['metabones'][keys[bone_name]]['constraints']:
+            if mbcd['name'] == constraint_name:
+                mbcd['attrs']['use_rest_offset'] = not mbcd['attrs'].get('use_rest_offset', False)
+
+        messages.extend(plan_diff_differences(plan_dict, changed, name + " driven constraint",
+                                              constraints_changed={bone_name}))
+        if (constraint_name, attr_name, data_path) not in \
+                riggenerator.RigPlanDiff(plan_dict, changed).previous_drivers.get(bone_name, ()):
+            messages.append("%s driven constraint: the driver of %s isn't removed" % (name, constraint_name))
+
+        changed = plan_dict_copy(plan_dict)
+        changed['drivers'][0][3] = 'pose.bones["%s"]["changed"]' % bone_name
+        messages.extend(plan_diff_differences(plan_dict, changed, name + " driver", constraints_changed={bone_name}))
+
+        widget_users = {}
+        for bone_name, (attrs, constraints) in by_bone_name.items():
+            if attrs['custom_shape'] in plan_dict['widgets']:
+                widget_users.setdefault(attrs['custom_shape'], set()).add(bone_name)
+
+        widget_name = max(sorted(widget_users.keys()), key=lambda widget_name: len(widget_users[widget_name]))
+        changed = plan_dict_copy(plan_dict)
+        changed['widgets'][widget_name]['subsurface_levels'] += 1
+        messages.extend(plan_diff_differences(plan_dict, changed, name + " widget",
+                                              pose_changed=widget_users[widget_name], widgets_changed={widget_name}))
+
+        changed = plan_dict_copy(plan_dict)
+        changed['widget_library'] = {widget_name: "imported"}
+        messages.extend(plan_diff_differences(plan_dict, changed, name + " widget imported",
+                                              pose_changed=widget_users[widget_name], widgets_changed={widget_name}))
+
+        #a bone no other bone refers to
+        metabones_json = json.dumps(plan_dict['metabones'])
+        bone_name = next(bone_name for bone_name in sorted(by_bone_name.keys())
+                         if json.dumps({'metabone': keys[bone_name]}) not in metabones_json)
+        changed = plan_dict_copy(plan_dict)
+        del changed['metabones'][keys[bone_name]]
+        messages.extend(plan_diff_differences(plan_dict, changed, name + " removed", removed={bone_name}))
+
+        changed = plan_dict_copy(plan_dict)
+        added = plan_dict_copy(plan_dict['metabones'][keys[bone_name]])
+        added['name'] = "added"
+        changed['metabones']["added"] = added
+        messages.extend(plan_diff_differences(plan_dict, changed, name + " added", added={"added"}))
+
+    return messages
+
+
+@check
+def check_baked_subsurface():
+    """
+    Plans with use_baked_subsurface leave no widget their metabones use with subsurface levels, also with a widget of
+    the user widget library in place of a default one
+    """
+    messages = []
+    library_widget = riggenerator.widgetdata_circle(.5)
+    library_widget.subsurface_levels = 2
+    library = dict(riggenerator.USER_WIDGET_LIBRARY)
+    riggenerator.USER_WIDGET_LIBRARY[riggenerator.WIDGET_ROOT] = library_widget
+    try:
+        for name, overrides in CHECK_CONFIGURATIONS.items():
+            plan = plan_for(overrides, use_baked_subsurface=True)
+            for metabone in plan.metabones.values():
+                widgetdata = riggenerator.widgetdata_resolve(metabone.custom_shape, plan.widgets) \
+                    if isinstance(metabone.custom_shape, str) else None
+                if widgetdata and widgetdata.subsurface_levels > 0:
+                    messages.append("%s: %s of %s isn't baked" % (name, metabone.custom_shape, metabone.name))
+
+            baked = plan.widgets.get(riggenerator.WIDGET_ROOT)
+            if baked is None or baked.geometry_hash() != library_widget.subsurface_baked().geometry_hash():
+                messages.append("%s: the library widget isn't baked" % name)
+    finally:
+        riggenerator.USER_WIDGET_LIBRARY.clear()
+        riggenerator.USER_WIDGET_LIBRARY.update(library)
+
+    return messages
+
+
+def run(names=None, log=print):
+    """
+    Run the checks in names, all by default
+
+    :return: the names of the failed checks
+    :rtype: list of str
+    """
+    failed = []
+    for name, function in CHECKS.items():
+        if names and name not in names:
+            continue
+
+        try:
+            messages = function()
+        except Exception:
+            messages = ["raised " + traceback.format_exc()]
+
+        log("%-24s %s" % (name, "%s mismatches" % len(messages) if messages else "ok"))
+        for message in messages[:MAX_REPORTED]:
+            log("    %s" % message)
+
+        if messages:
+            failed.append(name)
+
+    return failed
+
+
+def main(argv):
+    """
+    Entry point of run_selfcheck.py
+
+    :return: the number of failed checks
+    """
+    parser = argparse.ArgumentParser(prog="blender --background --python %s --" % DRIVER_SCRIPT,
+                                     description="Check the optimized rig planning against straightforward "
+                                                 "computations of the same results")
+    parser.add_argument("checks", nargs="*", help="names of the checks to run, all by default: %s" %
+                                                  ", ".join(CHECKS.keys()))
+    args = parser.parse_args(argv)
+
+    unknown = set(args.checks) - set(CHECKS.keys())
+    if unknown:
+        parser.error("unknown checks: %s" % ", ".join(sorted(unknown)))
+
+    failed = run(args.checks)
+    print("%s checks failed" % len(failed))
+    return len(failed)